@@ -0,0 +1,510 @@
+import asyncio
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from email_agent.config import CFG
+
+
+# Application types stored in the agent state, allowed to be deserialized from checkpoints
+CHECKPOINT_TYPES = [
+    ("email_agent.models.gmail", "EmailMessage"),
+    ("email_agent.models.conversation", "Conversation"),
+]
+
+
+class LatestCheckpointSaver(BaseCheckpointSaver, ABC):
+    """
+    Base of the agent graph checkpointers, keeping only the latest checkpoint of every thread.
+
+    Agent runs are keyed by the message ID and only ever resumed from their last completed node,
+    so older checkpoints are not needed. Subclasses store one record per thread: the serialized
+    checkpoint and the pending writes of the nodes that completed (or failed) after it.
+    Only the async interface is implemented, the graph is always run asynchronously.
+    """
+
+    def __init__(self):
+        super().__init__(
+            serde=JsonPlusSerializer(allowed_msgpack_modules=CHECKPOINT_TYPES)
+        )
+
+    @abstractmethod
+    async def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[dict]:
+        """Returns the stored record of a thread, None if there is none."""
+
+    @abstractmethod
+    async def _store(self, thread_id: str, checkpoint_ns: str, record: dict) -> None:
+        """Replaces the stored record of a thread (dropping its pending writes)."""
+
+    @abstractmethod
+    async def _store_writes(
+        self, thread_id: str, checkpoint_ns: str, writes: List[dict]
+    ) -> None:
+        """Adds pending writes to the stored record of a thread."""
+
+    @abstractmethod
+    async def adelete_thread(self, thread_id: str) -> None:
+        """Deletes the stored records of a thread."""
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        record = await self._load(thread_id, checkpoint_ns)
+        if record is None:
+            return None
+
+        checkpoint_id = get_checkpoint_id(config)
+        if checkpoint_id and checkpoint_id != record["checkpoint_id"]:
+            return None  # Older checkpoints are not kept
+
+        writes = sorted(
+            (
+                w
+                for w in record["writes"]
+                if w["checkpoint_id"] == record["checkpoint_id"]
+            ),
+            key=lambda w: (w["task_path"], w["task_id"], w["idx"]),
+        )
+        parent_id = record.get("parent_checkpoint_id")
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": record["checkpoint_id"],
+                }
+            },
+            checkpoint=self.serde.loads_typed(
+                (record["checkpoint_type"], record["checkpoint"])
+            ),
+            metadata=self.serde.loads_typed(
+                (record["metadata_type"], record["metadata"])
+            ),
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_id,
+                    }
+                }
+                if parent_id
+                else None
+            ),
+            pending_writes=[
+                (
+                    w["task_id"],
+                    w["channel"],
+                    self.serde.loads_typed((w["type"], w["value"])),
+                )
+                for w in writes
+            ],
+        )
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        if config is None or before is not None or limit == 0:
+            return
+
+        checkpoint_tuple = await self.aget_tuple(config)
+        if checkpoint_tuple is not None and all(
+            checkpoint_tuple.metadata.get(k) == v for k, v in (filter or {}).items()
+        ):
+            yield checkpoint_tuple
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_type, checkpoint_data = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_data = self.serde.dumps_typed(
+            get_checkpoint_metadata(config, metadata)
+        )
+
+        await self._store(
+            thread_id,
+            checkpoint_ns,
+            {
+                "checkpoint_id": checkpoint["id"],
+                "parent_checkpoint_id": config["configurable"].get("checkpoint_id"),
+                "checkpoint_type": checkpoint_type,
+                "checkpoint": checkpoint_data,
+                "metadata_type": metadata_type,
+                "metadata": metadata_data,
+            },
+        )
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        records = []
+        for idx, (channel, value) in enumerate(writes):
+            value_type, value_data = self.serde.dumps_typed(value)
+            records.append(
+                {
+                    "checkpoint_id": config["configurable"]["checkpoint_id"],
+                    "task_id": task_id,
+                    "task_path": task_path,
+                    "idx": WRITES_IDX_MAP.get(channel, idx),
+                    "channel": channel,
+                    "type": value_type,
+                    "value": value_data,
+                }
+            )
+
+        await self._store_writes(
+            config["configurable"]["thread_id"],
+            config["configurable"].get("checkpoint_ns", ""),
+            records,
+        )
+
+
+class SQLiteCheckpointSaver(LatestCheckpointSaver):
+    """
+    Checkpointer for local development, stored in a SQLite file.
+    """
+
+    def __init__(self, path: str = CFG.checkpoint_sqlite_path):
+        super().__init__()
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # The file is created on first use, not when the graph module is imported
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                checkpoint_type TEXT NOT NULL,
+                checkpoint BLOB NOT NULL,
+                metadata_type TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                task_path TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            """
+        )
+        # Runs that were never resumed nor discarded expire
+        expired = time.time() - CFG.checkpoint_ttl_days * 86400
+        conn.execute("DELETE FROM checkpoints WHERE updated_at < ?", (expired,))
+        conn.execute(
+            "DELETE FROM checkpoint_writes WHERE thread_id NOT IN (SELECT thread_id FROM checkpoints)"
+        )
+        conn.commit()
+        return conn
+
+    async def _execute(self, fn: Callable[[sqlite3.Connection], object]):
+        async with self._lock:
+            if self._conn is None:
+                self._conn = await asyncio.to_thread(self._connect)
+            return await asyncio.to_thread(fn, self._conn)
+
+    async def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[dict]:
+        def _select(conn: sqlite3.Connection) -> Optional[dict]:
+            row = conn.execute(
+                "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns),
+            ).fetchone()
+            if row is None:
+                return None
+
+            writes = conn.execute(
+                "SELECT * FROM checkpoint_writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, row["checkpoint_id"]),
+            ).fetchall()
+            return {**dict(row), "writes": [dict(w) for w in writes]}
+
+        return await self._execute(_select)
+
+    async def _store(self, thread_id: str, checkpoint_ns: str, record: dict) -> None:
+        def _upsert(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO checkpoints (
+                    thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,
+                    checkpoint_type, checkpoint, metadata_type, metadata, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    record["checkpoint_id"],
+                    record["parent_checkpoint_id"],
+                    record["checkpoint_type"],
+                    record["checkpoint"],
+                    record["metadata_type"],
+                    record["metadata"],
+                    time.time(),
+                ),
+            )
+            conn.execute(
+                "DELETE FROM checkpoint_writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                (thread_id, checkpoint_ns, record["checkpoint_id"]),
+            )
+            conn.commit()
+
+        await self._execute(_upsert)
+
+    async def _store_writes(
+        self, thread_id: str, checkpoint_ns: str, writes: List[dict]
+    ) -> None:
+        def _insert(conn: sqlite3.Connection) -> None:
+            for w in writes:
+                # Special writes (errors, interrupts) replace their previous value
+                verb = "INSERT OR REPLACE" if w["idx"] < 0 else "INSERT OR IGNORE"
+                conn.execute(
+                    f"""
+                    {verb} INTO checkpoint_writes (
+                        thread_id, checkpoint_ns, checkpoint_id, task_id, task_path, idx, channel, type, value
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        thread_id,
+                        checkpoint_ns,
+                        w["checkpoint_id"],
+                        w["task_id"],
+                        w["task_path"],
+                        w["idx"],
+                        w["channel"],
+                        w["type"],
+                        w["value"],
+                    ),
+                )
+            conn.commit()
+
+        await self._execute(_insert)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        def _delete(conn: sqlite3.Connection) -> None:
+            conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+            conn.execute(
+                "DELETE FROM checkpoint_writes WHERE thread_id = ?", (thread_id,)
+            )
+            conn.commit()
+
+        await self._execute(_delete)
+
+
+class FirestoreCheckpointSaver(LatestCheckpointSaver):
+    """
+    Checkpointer for production, stored in a Firestore collection with one document per thread.
+    Documents carry an 'expires_at' field, deleted by the collection's Firestore TTL policy.
+
+    Firestore documents are limited to 1 MiB, so serialized values above 'checkpoint_inline_max_bytes'
+    (e.g. a state with long attachment texts) are split over the documents of the thread's
+    'checkpoint_blobs' subcollection, and the thread document refers to them.
+    """
+
+    def __init__(self, collection: str = CFG.checkpoint_collection):
+        super().__init__()
+        from email_agent.services.firestore import db
+
+        self.collection = db.collection(collection)
+        # Threads whose values were offloaded by this instance, their stale blobs are deleted on the next checkpoint
+        self._offloaded: Set[Tuple[str, str]] = set()
+
+    def _doc_ref(self, thread_id: str, checkpoint_ns: str):
+        doc_id = f"{thread_id}:{checkpoint_ns}" if checkpoint_ns else thread_id
+        return self.collection.document(doc_id.replace("/", "_"))
+
+    def _blobs(self, thread_id: str, checkpoint_ns: str):
+        return self._doc_ref(thread_id, checkpoint_ns).collection("checkpoint_blobs")
+
+    @staticmethod
+    def _expires_at() -> datetime:
+        return datetime.now(timezone.utc) + timedelta(days=CFG.checkpoint_ttl_days)
+
+    async def _offload(
+        self,
+        thread_id: str,
+        checkpoint_ns: str,
+        checkpoint_id: str,
+        name: str,
+        data: bytes,
+    ) -> Union[bytes, dict]:
+        """
+        Returns the value to be stored in the thread document: small data itself, otherwise a reference
+        to the blob documents the data was split into.
+        """
+        if len(data) <= CFG.checkpoint_inline_max_bytes:
+            return data
+
+        part_size = CFG.checkpoint_blob_part_bytes
+        blobs = self._blobs(thread_id, checkpoint_ns)
+        parts = range(0, len(data), part_size)
+        await asyncio.gather(
+            *(
+                blobs.document(f"{name}:{index}").set(
+                    {
+                        "checkpoint_id": checkpoint_id,
+                        "data": data[start : start + part_size],
+                        "expires_at": self._expires_at(),
+                    }
+                )
+                for index, start in enumerate(parts)
+            )
+        )
+        self._offloaded.add((thread_id, checkpoint_ns))
+        return {"blob": name, "parts": len(parts)}
+
+    async def _restore(
+        self, thread_id: str, checkpoint_ns: str, value: Union[bytes, dict]
+    ) -> bytes:
+        if not isinstance(value, dict):
+            return value
+
+        blobs = self._blobs(thread_id, checkpoint_ns)
+        docs = await asyncio.gather(
+            *(
+                blobs.document(f"{value['blob']}:{index}").get()
+                for index in range(value["parts"])
+            )
+        )
+        return b"".join(doc.get("data") for doc in docs)
+
+    async def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[dict]:
+        doc = await self._doc_ref(thread_id, checkpoint_ns).get()
+        if not doc.exists:
+            return None
+
+        data = doc.to_dict()
+        data["checkpoint"] = await self._restore(
+            thread_id, checkpoint_ns, data["checkpoint"]
+        )
+        writes = list(data.get("writes", {}).values())
+        for w in writes:
+            w["value"] = await self._restore(thread_id, checkpoint_ns, w["value"])
+        return {**data, "writes": writes}
+
+    async def _store(self, thread_id: str, checkpoint_ns: str, record: dict) -> None:
+        checkpoint_id = record["checkpoint_id"]
+        checkpoint = await self._offload(
+            thread_id,
+            checkpoint_ns,
+            checkpoint_id,
+            f"{checkpoint_id}:checkpoint",
+            record["checkpoint"],
+        )
+        await self._doc_ref(thread_id, checkpoint_ns).set(
+            {
+                **record,
+                "checkpoint": checkpoint,
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "writes": {},
+                "expires_at": self._expires_at(),
+            }
+        )
+
+        if (thread_id, checkpoint_ns) in self._offloaded:
+            from google.cloud.firestore_v1.base_query import FieldFilter
+
+            # The blobs of the replaced checkpoint and its writes
+            stale = self._blobs(thread_id, checkpoint_ns).where(
+                filter=FieldFilter("checkpoint_id", "!=", checkpoint_id)
+            )
+            async for blob in stale.stream():
+                await blob.reference.delete()
+
+    async def _store_writes(
+        self, thread_id: str, checkpoint_ns: str, writes: List[dict]
+    ) -> None:
+        from google.cloud.firestore_v1.field_path import FieldPath
+
+        for w in writes:
+            w["value"] = await self._offload(
+                thread_id,
+                checkpoint_ns,
+                w["checkpoint_id"],
+                f"{w['checkpoint_id']}:{w['task_id']}:{w['idx']}",
+                w["value"],
+            )
+        await self._doc_ref(thread_id, checkpoint_ns).update(
+            {
+                FieldPath("writes", f"{w['task_id']}:{w['idx']}").to_api_repr(): w
+                for w in writes
+            }
+        )
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        query = self.collection.where(filter=FieldFilter("thread_id", "==", thread_id))
+        async for doc in query.stream():
+            async for blob in doc.reference.collection("checkpoint_blobs").stream():
+                await blob.reference.delete()
+            await doc.reference.delete()
+            self._offloaded.discard((thread_id, doc.get("checkpoint_ns")))
+
+
+def create_checkpointer() -> LatestCheckpointSaver:
+    """
+    Creates the agent graph checkpointer, using the same kind of backend as the work queue.
+    """
+    if CFG.work_queue_backend == "firestore":
+        return FirestoreCheckpointSaver()
+    return SQLiteCheckpointSaver()
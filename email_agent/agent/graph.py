@@ -1,6 +1,10 @@
+import time
+from typing import Optional
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
 
+from email_agent.agent.checkpoint import create_checkpointer
 from email_agent.agent.nodes import (
     process_attachments_node,
     call_model,
@@ -10,11 +14,20 @@ from email_agent.agent.nodes import (
     should_filter_or_continue,
 )
 from email_agent.agent.state import AgentState
+from email_agent.config import CFG
+from email_agent.models.gmail import EmailMessage
+from email_agent.models.inbox import Inbox
+from email_agent.services.attachments import prepare_image_parts
+from email_agent.services.conversation import conversation_store
+from email_agent.utils.logger import logger
 
 
-def build_graph() -> CompiledStateGraph:
+def build_graph(
+    checkpointer: Optional[BaseCheckpointSaver] = None,
+) -> CompiledStateGraph:
     """
     Uses nodes to create the agent execution graph.
+    With a checkpointer, the state is saved after every node so that failed runs can be resumed.
     """
     workflow = StateGraph(AgentState)
 
@@ -46,7 +59,7 @@ def build_graph() -> CompiledStateGraph:
     workflow.add_edge("execute_tools", "call_llm")
 
     # Compile the graph into an executable agent
-    agent_executor = workflow.compile()
+    agent_executor = workflow.compile(checkpointer=checkpointer)
 
     # from IPython.display import Image, display
     # from langchain_core.runnables.graph import CurveStyle, MermaidDrawMethod, NodeStyles
@@ -56,4 +69,52 @@ def build_graph() -> CompiledStateGraph:
     return agent_executor
 
 
-agent_executor = build_graph()
+agent_executor = build_graph(create_checkpointer())
+
+
+async def run_agent(email: EmailMessage, inbox: Optional[Inbox] = None) -> AgentState:
+    """
+    Runs the agent on an email, within a deadline counted from now (the email was admitted for processing).
+    The run is checkpointed under the message ID: a retry of a failed run resumes after its last completed
+    node with a fresh deadline, a retry of a finished run returns its final state.
+    The run and the thread's conversation are scoped to the inbox the email was received in.
+
+    Attachment contents are passed in the run config only, the (checkpointed) state holds
+    the email without them.
+    """
+    image_parts = await prepare_image_parts(email) if CFG.image_mode == "inline" else []
+    config = {
+        "configurable": {
+            "thread_id": inbox.scoped(email.id) if inbox else email.id,
+            "email": email,
+            "image_parts": image_parts,
+            "deadline": time.time() + CFG.agent_deadline_s,
+        }
+    }
+
+    snapshot = await agent_executor.aget_state(config)
+    if snapshot.values and snapshot.next:
+        logger.info(f"Resuming the agent run of message {email.id} at {snapshot.next}.")
+        return await agent_executor.ainvoke(None, config)
+    if snapshot.values:
+        logger.info(f"Agent run of message {email.id} already finished, reusing it.")
+        return snapshot.values
+
+    return await agent_executor.ainvoke(
+        {
+            "email": email.without_attachment_data(),
+            "conversation": await conversation_store.load(
+                inbox.scoped(email.thread_id) if inbox else email.thread_id
+            ),
+        },
+        config,
+    )
+
+
+async def discard_run(message_id: str, inbox: Optional[Inbox] = None) -> None:
+    """
+    Deletes the checkpoints of an agent run whose result was stored.
+    """
+    await agent_executor.checkpointer.adelete_thread(
+        inbox.scoped(message_id) if inbox else message_id
+    )
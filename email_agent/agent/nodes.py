@@ -1,5 +1,8 @@
-from typing import Any, Dict, Literal, List
+import asyncio
+import time
+from typing import Any, Dict, Literal, List, Optional
 from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig
 
 from langsmith import traceable
 from email_agent.agent.state import AgentState, RelevanceAssessment
@@ -8,14 +11,30 @@ from langchain_core.prompts import PromptTemplate
 from email_agent.services.attachments import process_attachments
 from email_agent.utils.logger import logger
 from langchain_core.messages import HumanMessage, AIMessage
-from email_agent.services.llm import llm
+from email_agent.services.llm import MODELS, RoutingFeatures, model_router
+from email_agent.services.limiter import Priority, estimate_tokens, gemini_limiter
+from email_agent.services.gmail import extract_sender_email
+from email_agent.services.reputation import reputation_service
+from email_agent.services.work_queue import DeferredError
 
 from email_agent.tools.vector_search import knowledge_base_search
 
 
 TOOLS = [knowledge_base_search]
-LLM_WITH_TOOLS = llm.bind_tools(TOOLS)
-RELEVENCE_LLM = llm.with_structured_output(RelevanceAssessment)
+LLMS_WITH_TOOLS = {route: model.bind_tools(TOOLS) for route, model in MODELS.items()}
+# Tools stay declared (the history contains tool calls) but cannot be called anymore
+LLMS_FINAL_ANSWER = {
+    route: model.bind_tools(TOOLS, tool_choice="none")
+    for route, model in MODELS.items()
+}
+FINAL_ANSWER_INSTRUCTION = (
+    "\n\n**BUDGET EXHAUSTED:** No more tool calls are available. You MUST output the complete, "
+    "final email draft text now, based only on the context above."
+)
+# Classification always runs on the fast model, raw output included for token accounting
+RELEVENCE_LLM = MODELS["fast"].with_structured_output(
+    RelevanceAssessment, include_raw=True
+)
 
 # Load initial Jinja2-templated prompt
 with open(CFG.sys_prompt_path, "r", encoding="utf-8") as file:
@@ -27,6 +46,7 @@ with open(CFG.sys_prompt_path, "r", encoding="utf-8") as file:
             "body",
             "attachments",
             "retrievals",
+            "conversation",
         ],
         template=file.read(),
         template_format="jinja2",
@@ -40,29 +60,116 @@ with open(CFG.relevence_prompt, "r", encoding="utf-8") as file:
     )
 
 
+def _remaining_s(config: RunnableConfig) -> float:
+    """
+    Returns the seconds left until the deadline of the run (infinite without a deadline).
+    The deadline is passed in the run config, every (resumed) run of an email gets a fresh one.
+    """
+    deadline = config.get("configurable", {}).get("deadline")
+    return deadline - time.time() if deadline else float("inf")
+
+
+def _call_timeout_s(config: RunnableConfig) -> Optional[float]:
+    """
+    Returns the timeout of an LLM or tool call, which keeps the final answer reserve before the deadline.
+    """
+    remaining = _remaining_s(config)
+    if remaining == float("inf"):
+        return None
+    return max(remaining - CFG.agent_final_answer_reserve_s, 0.0)
+
+
+def _get_exhausted_budget(state: AgentState, config: RunnableConfig) -> Optional[str]:
+    """
+    Returns a description of the exhausted budget of the email, None if there is budget left.
+    """
+    if state.get("tool_rounds", 0) >= CFG.agent_max_tool_rounds:
+        return f"{state['tool_rounds']} tool rounds"
+    if state.get("tokens_used", 0) >= CFG.agent_max_tokens:
+        return f"{state['tokens_used']} tokens"
+    if _call_timeout_s(config) == 0:
+        return "deadline"
+    return None
+
+
+def _count_tokens(usage: Optional[dict]) -> int:
+    if not usage:
+        return 0
+    return usage.get("total_tokens") or (
+        usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+    )
+
+
+def _get_image_parts(config: RunnableConfig) -> List[dict]:
+    """
+    Returns the preprocessed image content blocks passed in the run config (when 'image_mode=inline').
+    Like the attachment contents, they are kept out of the checkpointed state.
+    """
+    return config.get("configurable", {}).get("image_parts") or []
+
+
 @traceable(run_type="chain", name="Process Attachments")
-async def process_attachments_node(state: AgentState) -> Dict[str, Any]:
+async def process_attachments_node(
+    state: AgentState, config: RunnableConfig
+) -> Dict[str, Any]:
     """
     Extract or transcribe attachments (using specialized models) into text and store in state.
+    The attachment contents are read from the email passed in the run config.
     """
-    email = state.get("email")
+    email = config.get("configurable", {}).get("email") or state.get("email")
     if not email:
         raise ValueError("AgentState must include 'email' key with EmailMessage")
 
-    texts = await process_attachments(email)
+    try:
+        texts = await asyncio.wait_for(
+            process_attachments(email), timeout=_call_timeout_s(config)
+        )
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Attachment processing exceeded the deadline, continuing without attachments."
+        )
+        texts = []
     state["attachments_text"] = texts
+
     return {"attachments_text": texts}
 
 
+def _build_human_message(prompt_content: str, image_parts: List[dict]) -> HumanMessage:
+    """
+    Creates the human message for the LLM, attaching image content blocks directly if there are any.
+    """
+    if not image_parts:
+        return HumanMessage(content=prompt_content)
+
+    return HumanMessage(
+        content=[{"type": "text", "text": prompt_content}, *image_parts]
+    )
+
+
 @traceable(run_type="chain", name="Decide Email Relevance")
-async def decide_relevance_node(state: AgentState) -> Dict[str, bool]:
+async def decide_relevance_node(
+    state: AgentState, config: RunnableConfig
+) -> Dict[str, bool]:
     """
     Uses the LLM to determine if the email is relevant or spam/inappropriate.
+    Senders with a long and consistent relevance history are decided from their reputation instead.
+
+    The classification may use the final answer reserve, so a spent budget never skips it. If it still
+    times out, the run is deferred and resumes here, other failures classify the email as relevant.
     """
     email = state.get("email")
     if not email:
         raise ValueError("AgentState must include 'email' key with EmailMessage")
 
+    sender_email = extract_sender_email(email.headers.sender)
+    known_relevance = await reputation_service.decide(sender_email)
+    if known_relevance is not None:
+        logger.info(
+            f"Email relevance determined from sender reputation: is_relevant={known_relevance}"
+        )
+        state["is_relevant"] = known_relevance
+        return {"is_relevant": known_relevance}
+
     attachments_text = state.get("attachments_text", [])
 
     prompt_content = RELEVENCE_PROMPT.format_prompt(
@@ -73,27 +180,51 @@ async def decide_relevance_node(state: AgentState) -> Dict[str, bool]:
         ],  # Limit body length for classification (in case it's purposefully very long)
         attachments="\n".join(attachments_text),
     ).to_string()
-    human_message = HumanMessage(content=prompt_content)
+    human_message = _build_human_message(prompt_content, _get_image_parts(config))
 
+    timeout = max(_remaining_s(config), CFG.agent_final_answer_reserve_s)
     try:
-        classification = await RELEVENCE_LLM.ainvoke(
-            [human_message]
-        )  # Structured output included
+        start = time.perf_counter()
+        result = await asyncio.wait_for(
+            gemini_limiter.run(
+                lambda: RELEVENCE_LLM.ainvoke([human_message]),
+                priority=Priority.REPLY,
+                tokens=estimate_tokens(prompt_content),
+            ),  # Structured output included
+            timeout=None if timeout == float("inf") else timeout,
+        )
+        usage = getattr(result["raw"], "usage_metadata", None)
+        model_router.record_call("fast", time.perf_counter() - start, usage)
+        state["tokens_used"] = state.get("tokens_used", 0) + _count_tokens(usage)
+        classification = result["parsed"]
+        if classification is None:
+            raise ValueError(f"Unparsable classification: {result['parsing_error']}")
+
         state["is_relevant"] = classification.is_relevant
         logger.info(
             f"Email relevance determined: is_relevant={classification.is_relevant}, reason={classification.reason}"
         )
+        await reputation_service.record(sender_email, classification.is_relevant)
+    except asyncio.TimeoutError:
+        raise DeferredError(
+            f"Relevance classification of {email.id} timed out.",
+            CFG.admission_defer_delay_s,
+        )
     except Exception as e:
+        # Failing open: a customer email is rather answered than silently dropped
         logger.error(
             f"Failed to determine relevence: {e}. Defaulting to relevant=True."
         )
         state["is_relevant"] = True
 
-    return {"is_relevant": state.get("is_relevant", True)}
+    return {
+        "is_relevant": state["is_relevant"],
+        "tokens_used": state.get("tokens_used", 0),
+    }
 
 
 @traceable(run_type="chain", name="Call LLM for Reply")
-async def call_model(state: AgentState) -> AgentState:
+async def call_model(state: AgentState, config: RunnableConfig) -> AgentState:
     """
     Generate a reply or function call based on current state.
     """
@@ -102,6 +233,7 @@ async def call_model(state: AgentState) -> AgentState:
         raise ValueError("AgentState must include 'email' key with EmailMessage")
 
     history = state.get("history", [])
+    conversation = state.get("conversation")
     attachments_text = state.get("attachments_text", [])
     tool_results_context = state.get(
         "tool_results_context", "No previous tool results."
@@ -114,11 +246,53 @@ async def call_model(state: AgentState) -> AgentState:
         body=email.body.body_text,
         attachments=attachments_text,
         tool_results_context=tool_results_context,
+        conversation=conversation.to_prompt_text() if conversation else "",
     ).to_string()
     human_message = HumanMessage(content=prompt_content)
 
-    response_message: AIMessage = await LLM_WITH_TOOLS.ainvoke(
-        history + [human_message]
+    # Once a budget of the email is exhausted, force the best answer with the context gathered so far
+    exhausted_budget = _get_exhausted_budget(state, config)
+    if exhausted_budget:
+        logger.warning(
+            f"Budget exhausted ({exhausted_budget}), forcing the final answer."
+        )
+        state["budget_exhausted"] = exhausted_budget
+        human_message = HumanMessage(content=prompt_content + FINAL_ANSWER_INSTRUCTION)
+
+    # Pick the model for this round, later rounds may escalate once the retrieval score is known (never back)
+    route = model_router.route(
+        RoutingFeatures.from_email(email, state.get("retrieval_score")),
+        state.get("model_route"),
+    )
+    model_router.record_routing(route, state.get("model_route"))
+    state["model_route"] = route
+
+    start = time.perf_counter()
+    messages = history + [human_message]
+    # Images are attached to the first prompt only, and are not stored in the (checkpointed) history
+    messages[0] = _build_human_message(messages[0].content, _get_image_parts(config))
+    try:
+        response_message = await _invoke_llm(
+            route, messages, final_answer=bool(exhausted_budget), config=config
+        )
+    except asyncio.TimeoutError:
+        if exhausted_budget:
+            raise
+        logger.warning("LLM call exceeded the deadline, forcing the final answer.")
+        state["budget_exhausted"] = "deadline"
+        human_message = HumanMessage(content=prompt_content + FINAL_ANSWER_INSTRUCTION)
+        messages[-1] = human_message
+        messages[0] = _build_human_message(
+            messages[0].content, _get_image_parts(config)
+        )
+        response_message = await _invoke_llm(
+            route, messages, final_answer=True, config=config
+        )
+    model_router.record_call(
+        route, time.perf_counter() - start, response_message.usage_metadata
+    )
+    state["tokens_used"] = state.get("tokens_used", 0) + _count_tokens(
+        response_message.usage_metadata
     )
 
     tool_calls = response_message.tool_calls
@@ -150,8 +324,32 @@ async def call_model(state: AgentState) -> AgentState:
     return state
 
 
+async def _invoke_llm(
+    route: str, messages: List[Any], final_answer: bool, config: RunnableConfig
+) -> AIMessage:
+    """
+    Calls the reply LLM within the deadline of the email. The final answer call may use the reserve
+    (and gets at least the reserve even past the deadline, to still send a reply).
+    """
+    if final_answer:
+        llm = LLMS_FINAL_ANSWER[route]
+        timeout = max(_remaining_s(config), CFG.agent_final_answer_reserve_s)
+    else:
+        llm = LLMS_WITH_TOOLS[route]
+        timeout = _call_timeout_s(config)
+
+    return await asyncio.wait_for(
+        gemini_limiter.run(
+            lambda: llm.ainvoke(messages),
+            priority=Priority.REPLY,
+            tokens=estimate_tokens([m.content for m in messages]),
+        ),
+        timeout=None if timeout == float("inf") else timeout,
+    )
+
+
 @traceable(run_type="tool", name="Execute Tools")
-async def execute_tools(state: AgentState) -> AgentState:
+async def execute_tools(state: AgentState, config: RunnableConfig) -> AgentState:
     """
     Executes the requested tools and formats the output for the next LLM call.
     """
@@ -175,16 +373,20 @@ async def execute_tools(state: AgentState) -> AgentState:
             )
             continue
 
-        # Execute the function
+        # Execute the function (invoking with the whole tool call returns a 'ToolMessage' including its artifact)
         try:
-            output = await tool_func.ainvoke(tool_call["args"])
-            tool_messages.append(
-                ToolMessage(
-                    content=str(output),
-                    name=tool_call["name"],
-                    tool_call_id=tool_call["id"],
-                )
+            output: ToolMessage = await asyncio.wait_for(
+                tool_func.ainvoke({**tool_call, "type": "tool_call"}),
+                timeout=_call_timeout_s(config),
             )
+            tool_messages.append(output)
+
+            # Retrieval tools report the scores of the retrieved documents as their artifact
+            scores = output.artifact or []
+            if scores:
+                state["retrieval_score"] = max(
+                    [*scores, state.get("retrieval_score", float("-inf"))]
+                )
             logger.info(f"Tool {tool_call['name']} executed successfully.")
 
         except Exception as e:
@@ -211,6 +413,7 @@ async def execute_tools(state: AgentState) -> AgentState:
 
     # Reset tool_calls
     state["tool_calls"] = []
+    state["tool_rounds"] = state.get("tool_rounds", 0) + 1
 
     return state
 
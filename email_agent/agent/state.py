@@ -1,5 +1,6 @@
 from typing import List, TypedDict
 from pydantic import BaseModel, Field
+from email_agent.models.conversation import Conversation
 from email_agent.models.gmail import EmailMessage
 from langchain_core.messages import BaseMessage
 
@@ -8,22 +9,34 @@ class AgentState(TypedDict, total=False):
     """
     Agent state dictionary.
 
-    - email: the incoming `EmailMessage` to reply to
+    - email: the incoming `EmailMessage` to reply to (without attachment contents, which are passed in the run config)
+    - conversation: memory of the email thread (summary and latest turns) before this email
     - attachments_text: extracted text from attachments (PDF/image/audio)
     - is_relevant: whether or not the email message is relevant or to be filtered out
     - tool_results_context: concatenated strings returned from RAG search
+    - retrieval_score: best score of the documents returned from RAG search
+    - model_route: the route ('fast'/'strong') of the model that answered last
     - tool_calls: stores requested tool calls
     - reply: the generated reply text
     - history: history of messages
+    - tool_rounds: number of executed tool rounds
+    - tokens_used: number of LLM tokens spent on the email
+    - budget_exhausted: the exhausted budget that forced the final answer, if any
     """
 
     email: EmailMessage
+    conversation: Conversation
     attachments_text: List[str]
     is_relevant: bool
     tool_results_context: str
+    retrieval_score: float
+    model_route: str
     tool_calls: List[dict]
     reply: str
     history: List[BaseMessage]
+    tool_rounds: int
+    tokens_used: int
+    budget_exhausted: str
 
 
 class RelevanceAssessment(BaseModel):
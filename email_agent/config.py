@@ -1,5 +1,7 @@
+from typing import Dict, List, Literal
 from pydantic_settings import BaseSettings
 from pydantic import SecretStr
+from email_agent.models.inbox import Inbox
 from email_agent.utils.logger import logger
 
 
@@ -16,17 +18,193 @@ class Config(BaseSettings):
     pubsub_topic: str = f"projects/{project_id}/topics/gmail-inbox-topic"
     gmail_service_acc_json: SecretStr
 
+    # Further inboxes answered next to the primary 'user_email' one (JSON list in EXTRA_INBOXES), each with
+    # its own credentials, cursor, labels and work queue. Their keys are prefixed by a namespace derived
+    # from the address unless one is given
+    extra_inboxes: List[Inbox] = []
+
     # Firestore
     firestore_name: str = "email-agent-db"
     firestore_config_collection: str = "agent_config"
     gmail_state_doc_id: str = "gmail_watch_state"
+    history_lease_ttl_s: float = 300.0
+    history_flush_delay_s: float = 2.0
+
+    # Message deduplication
+    dedup_collection: str = "processed_messages"
+    dedup_cache_size: int = 10_000
+    dedup_ttl_days: float = 30.0
+
+    # Streaming history processing: history.list page size, message workers and the
+    # capacity of the queue between them (the page reader blocks while it is full).
+    # The workers of one inbox outnumber 'admission_max_in_flight', so even a single busy
+    # inbox has emails waiting for admission by lane and reaches 'admission_defer_emails'
+    history_page_size: int = 100
+    history_workers: int = 8
+    history_queue_size: int = 16
+
+    # Catch-up of the unread backlog (full sync when the history ID has expired)
+    catchup_query: str = "is:unread"
+    catchup_concurrency: int = 8
+    catchup_page_size: int = 500
+
+    # Background work queue draining the Gmail push notifications
+    work_queue_backend: Literal["sqlite", "firestore"] = "sqlite"
+    work_queue_sqlite_path: str = "work_queue.sqlite3"
+    work_queue_collection: str = "work_queue"
+    work_queue_max_size: int = 1000
+    # Per inbox (times its weight). The history pass of an inbox is single-flight, one worker runs it
+    # and another registers the newer notifications meanwhile, so that the running pass picks them up
+    work_queue_workers: int = 2
+    work_queue_lease_s: float = 600.0
+    work_queue_poll_interval_s: float = 5.0
+    work_queue_max_attempts: int = 5
+    work_queue_retry_delay_s: float = 30.0
+    # Deferrals of an item beyond this count as attempts, so an item deferred forever is dead-lettered
+    work_queue_max_deferrals: int = 40
+    work_queue_shutdown_timeout_s: float = 8.0
+
+    # Outbox of replies and label changes, delivered in Gmail batch requests
+    # (stored in the same kind of backend as the work queue)
+    outbox_collection: str = "outbox"
+    outbox_sqlite_path: str = "outbox.sqlite3"
+    outbox_batch_size: int = 50
+    outbox_lease_s: float = 120.0
+    outbox_poll_interval_s: float = 2.0
+    outbox_max_attempts: int = 8
+    outbox_retry_delay_s: float = 5.0
+    # Delivered items are kept this long, so the same message is never answered twice
+    outbox_tombstone_ttl_days: float = 7.0
+
+    # Checkpoints of the agent graph runs, keyed by message ID so that retries resume from
+    # the last completed node (stored in the same kind of backend as the work queue)
+    checkpoint_collection: str = "agent_checkpoints"
+    checkpoint_sqlite_path: str = "checkpoints.sqlite3"
+    checkpoint_ttl_days: float = 7.0
+    # Firestore documents are limited to 1 MiB, larger serialized values are split into blob documents
+    checkpoint_inline_max_bytes: int = 64 * 1024
+    checkpoint_blob_part_bytes: int = 900 * 1024
+
+    # Admission control of the message processing (all inboxes): at most this many emails and estimated
+    # bytes are processed at once, waiting emails are admitted by lane (short text-only emails of known
+    # customers first, multimedia last). Once the emails in flight and waiting exceed a defer watermark, no further
+    # history pages are read, the remaining messages stay in the history and the notification is retried after a delay
+    admission_max_in_flight: int = 6
+    admission_max_in_flight_bytes: int = 64 * 1024 * 1024
+    admission_defer_emails: int = 8
+    admission_defer_bytes: int = 192 * 1024 * 1024
+    admission_defer_delay_s: float = 30.0
+    admission_light_max_bytes: int = 50_000
+
+    # Bulk / auto-generated mail rejection (evaluated on headers only, before the full fetch)
+    bulk_filter_enabled: bool = True
+    bulk_filter_label: str = "Auto-generated"
+    bulk_filter_presence_headers: List[str] = [
+        "List-Unsubscribe",
+        "List-Id",
+        "X-Autoreply",
+        "X-Autorespond",
+    ]
+    bulk_filter_header_values: Dict[str, List[str]] = {
+        "Precedence": ["bulk", "list", "junk", "auto_reply"],
+        "Auto-Submitted": ["auto-"],  # auto-replied, auto-generated, auto-notified
+    }
+    bulk_filter_sender_patterns: List[str] = [
+        r"^mailer-daemon@",
+        r"^postmaster@",
+        r"^no-?reply@",
+        r"^do-?not-?reply@",
+    ]
+
+    # Sender reputation (skips the relevance LLM for senders with a long consistent history)
+    reputation_enabled: bool = True
+    reputation_collection: str = "sender_reputation"
+    reputation_min_observations: float = 5.0
+    reputation_consistency: float = 0.95
+    reputation_half_life_hours: float = 24.0 * 7
+    reputation_ttl_days: float = 30.0
+    reputation_cache_size: int = 10_000  # Entries held in memory
+    reputation_flush_interval_seconds: float = 30.0
+    # Shared mailbox providers are only rated per sender address, never per domain
+    reputation_ignored_domains: List[str] = [
+        "gmail.com",
+        "googlemail.com",
+        "outlook.com",
+        "hotmail.com",
+        "yahoo.com",
+        "icloud.com",
+        "seznam.cz",
+        "email.cz",
+        "centrum.cz",
+    ]
 
     # LLM settings
     model_name: str = "gemini-2.5-flash"
     temperature: float = 0.0
+
+    # Model routing between a cheap/fast model (classification, short and simple emails)
+    # and the strong 'model_name' (long, attachment-heavy, multi-question or poorly grounded emails)
+    routing_enabled: bool = True
+    fast_model_name: str = "gemini-2.5-flash-lite"
+    routing_max_body_chars: int = 1500
+    routing_max_attachments: int = 0
+    routing_max_questions: int = 2
+    routing_min_retrieval_score: float = 0.75
+    # USD per 1M input/output tokens, used for the per-route cost estimate
+    routing_token_prices: Dict[str, List[float]] = {
+        "fast": [0.10, 0.40],
+        "strong": [0.30, 2.50],
+    }
+
+    # Per-email budget of the agent run: a deadline counted from the admission of the email (every
+    # retry of the run gets a fresh one), a cap on tool rounds and on spent tokens. Once exhausted, the
+    # model is forced to answer with the context gathered so far (the reserve is kept for that final
+    # call and for the relevance classification)
+    agent_deadline_s: float = 120.0
+    agent_final_answer_reserve_s: float = 20.0
+    agent_max_tool_rounds: int = 3
+    agent_max_tokens: int = 60000
+
+    # Multi-turn conversation memory per thread: the last raw turns are kept (truncated), older ones
+    # are folded into a rolling summary, so the prompt size stays bounded however long the thread gets
+    conversation_collection: str = "conversations"
+    conversation_max_turns: int = 6
+    conversation_max_turn_chars: int = 2000
+    conversation_summary_max_words: int = 200
+    conversation_max_references: int = 20
+
     sys_prompt_path: str = "email_agent/prompts/system_prompt.txt"
     description_prompt_path: str = "email_agent/prompts/image_description.txt"
     relevence_prompt: str = "email_agent/prompts/relevence_prompt.txt"
+    conversation_summary_prompt: str = "email_agent/prompts/conversation_summary.txt"
+
+    # Email bodies are taken from the text/plain part (or the converted text/html part if there is none),
+    # without the quoted history of replies and the signature (searched within the last lines)
+    body_normalizer_enabled: bool = True
+    body_signature_max_lines: int = 10
+
+    # Attachment contents are spooled to temporary files beyond the threshold (kept in memory below it).
+    # Attachments exceeding the per-message or per-process byte cap are not downloaded
+    attachment_spool_threshold_bytes: int = 1024 * 1024
+    attachment_max_message_bytes: int = 40 * 1024 * 1024
+    attachment_max_process_bytes: int = 512 * 1024 * 1024
+
+    # Images are either described by a separate LLM call ("describe") or attached directly
+    # to the multimodal relevance and reply messages ("inline")
+    image_mode: Literal["describe", "inline"] = "describe"
+    image_max_dimension: int = 1024
+    image_jpeg_quality: int = 85
+
+    # Rate limiting of Vertex AI calls (Gemini, Speech-to-Text, Vector Search),
+    # per service: requests per minute, tokens per minute and the adaptive concurrency bounds
+    limiter_rpm: Dict[str, float] = {"gemini": 300, "speech": 60, "vector_search": 600}
+    limiter_tpm: Dict[str, float] = {"gemini": 400_000}
+    limiter_min_concurrency: int = 1
+    limiter_max_concurrency: int = 16
+    limiter_target_latency_s: float = 20.0
+    limiter_max_retries: int = 5
+    limiter_base_backoff_s: float = 1.0
+    limiter_max_backoff_s: float = 30.0
 
     # RAG
     index_id: str = (
@@ -36,8 +214,51 @@ class Config(BaseSettings):
     index_name: str = "rag_index_deployment2"
     vector_dimensions: int = 384
     embedding_model_name: str = "intfloat/multilingual-e5-small"
+    # ONNX runtime of the embedding model, the int8 variant is a dynamically quantized export of the same model.
+    # Threads and batch sizes are per workload: query embedding is latency-bound (one text per reply),
+    # ingestion is throughput-bound and should leave cores to the replies (0 threads = all cores)
+    embedding_model_file: str = "onnx/model.onnx"
+    embedding_quantized: bool = False
+    embedding_quantized_model_source: str = "Xenova/multilingual-e5-small"
+    embedding_quantized_model_file: str = "onnx/model_quantized.onnx"
+    embedding_intra_op_threads: Dict[str, int] = {"query": 0, "ingestion": 2}
+    embedding_inter_op_threads: Dict[str, int] = {"query": 1, "ingestion": 1}
+    embedding_batch_size: Dict[str, int] = {"query": 1, "ingestion": 32}
     retriever_k: int = 1
+    # Optional post-retrieval stage: 'rerank_candidates' chunks are re-ranked by a local ONNX cross-encoder,
+    # near-duplicates (embedding cosine >= 'rerank_duplicate_similarity') are dropped and the best ones
+    # returned within a token budget. The default cross-encoder is English only,
+    # 'BAAI/bge-reranker-v2-m3-int8' is a larger multilingual one
+    rerank_enabled: bool = False
+    rerank_model_name: str = "Xenova/ms-marco-MiniLM-L-6-v2"
+    rerank_candidates: int = 20
+    rerank_top_n: int = 5
+    rerank_batch_size: int = 16
+    rerank_threads: int = 2
+    rerank_duplicate_similarity: float = 0.95
+    rerank_token_budget: int = 1024
     bucket_name: str = "vector-data-source-alza-email-agent"
+    # Chunks are measured in tokens of the embedding model (e5 embeds at most 512 tokens, special tokens included).
+    # Plain text and markdown objects are streamed into the chunker, other formats go through 'unstructured'
+    chunk_max_tokens: int = 256
+    chunk_overlap_tokens: int = 32
+    plain_text_extensions: List[str] = [".txt", ".md", ".markdown"]
+    ingest_stream_block_bytes: int = 1024 * 1024
+    # Per source object: the ingested GCS generation and chunk hashes, to re-embed changed chunks only
+    ingest_manifest_collection: str = "ingest_manifests"
+    # Per chunk datapoint: its text, looked up by the retrieval (the index stores no text)
+    ingest_chunk_collection: str = "ingest_chunks"
+
+    # Bulk ingestion of whole buckets or directories: a bounded pipeline of concurrent loaders, one embedder
+    # and concurrent upserts, checkpointed to Firestore every few documents so that a rerun resumes
+    ingest_checkpoint_collection: str = "ingest_checkpoints"
+    ingest_checkpoint_every: int = 25
+    ingest_list_page_size: int = 500
+    ingest_queue_size: int = 16
+    ingest_load_concurrency: int = 4
+    ingest_embed_batch_size: int = 64
+    ingest_upsert_batch_size: int = 100
+    ingest_upsert_concurrency: int = 4
 
     # model_config = SettingsConfigDict(env_file=".env")
 
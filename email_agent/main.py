@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 import langsmith
@@ -6,6 +7,10 @@ from fastapi import FastAPI
 from google.cloud import aiplatform
 from email_agent.config import CFG
 from email_agent.routes import router
+from email_agent.services.reputation import reputation_service
+from email_agent.services.outbox import outbox
+from email_agent.services.inboxes import inbox_registry
+from email_agent.services.processing import work_queues
 from email_agent.utils.logger import logger
 
 langsmith_client = langsmith.Client()
@@ -16,10 +21,19 @@ aiplatform.init(project=CFG.project_id, location=CFG.region)
 async def lifespan(app: FastAPI):
     # Startup actions
     logger.info("Starting up...")
+    reputation_service.start()
+    outbox.start()
+    for inbox in inbox_registry.all():
+        work_queues[inbox.email].start(CFG.work_queue_workers * inbox.inbox.weight)
 
     yield
     # Shutdown actions
     logger.info("Shutting down...")
+    await asyncio.gather(*(work_queue.stop() for work_queue in work_queues.values()))
+    await outbox.stop()
+    for inbox in inbox_registry.all():
+        await inbox.state.flush_history_id()
+    await reputation_service.stop()
 
 
 app = FastAPI(
@@ -0,0 +1,16 @@
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Literal, Optional
+
+
+class CatchUpProgress(BaseModel):
+    """Represents the progress of a backlog catch-up run."""
+
+    status: Literal["idle", "running", "completed", "failed"] = "idle"
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    total: int = 0
+    processed: int = 0
+    failed: int = 0
+    messages_per_s: float = 0.0
+    error: Optional[str] = None
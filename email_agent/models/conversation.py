@@ -0,0 +1,34 @@
+from pydantic import BaseModel
+from typing import List, Literal
+
+
+class ConversationTurn(BaseModel):
+    """Represents one message of a conversation, written either by the customer or by the agent."""
+
+    role: Literal["customer", "agent"]
+    message_id: str
+    date: str
+    text: str
+
+
+class Conversation(BaseModel):
+    """Represents the memory of an email thread: a rolling summary of the older turns and the latest raw turns."""
+
+    thread_id: str
+    summary: str = ""
+    turns: List[ConversationTurn] = []
+    summarized_turns: int = 0
+    references: List[str] = []  # Message-IDs of the customer messages, oldest first
+
+    def to_prompt_text(self) -> str:
+        """
+        Renders the conversation for the LLM prompt (empty for a new conversation).
+        """
+        lines = []
+        if self.summary:
+            lines.append(
+                f"Summary of the {self.summarized_turns} earlier messages: {self.summary}"
+            )
+        for turn in self.turns:
+            lines.append(f"[{turn.date}] {turn.role.capitalize()}: {turn.text}")
+        return "\n\n".join(lines)
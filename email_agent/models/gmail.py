@@ -1,14 +1,19 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, List, Optional
+from email_agent.utils.spool import AttachmentContent
 
 
 class EmailAttachment(BaseModel):
-    """Represents an email attachment and its headers and content."""
+    """Represents an email attachment and its headers and (lazily accessed) content."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
 
     filename: str
     mime_type: str
     size: int
-    data: bytes
+    # None once dropped, or if the attachment exceeded a byte cap and was not downloaded
+    content: Optional[AttachmentContent] = Field(default=None, exclude=True)
+    skipped_reason: Optional[str] = None
 
 
 class EmailBody(BaseModel):
@@ -34,3 +39,31 @@ class EmailMessage(BaseModel):
     thread_id: str
     headers: EmailHeaders
     body: EmailBody
+
+    def without_attachment_data(self) -> "EmailMessage":
+        """
+        Returns a copy with the attachment contents dropped (their metadata is kept).
+        """
+        attachments = [
+            att.model_copy(update={"content": None})
+            for att in self.body.attachments or []
+        ]
+        return self.model_copy(
+            update={"body": self.body.model_copy(update={"attachments": attachments})}
+        )
+
+    def close_attachments(self) -> None:
+        """
+        Releases the attachment contents (spooled files and their reserved bytes).
+        """
+        for att in self.body.attachments or []:
+            if att.content is not None:
+                att.content.close()
+
+
+class HistoryPage(BaseModel):
+    """Represents the newly added message IDs (and their thread IDs) of one page of the inbox history."""
+
+    message_ids: List[str]
+    thread_ids: Dict[str, str] = {}
+    checkpoint_history_id: str
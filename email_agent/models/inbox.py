@@ -0,0 +1,42 @@
+import os
+import re
+from pydantic import BaseModel, SecretStr
+
+
+class Inbox(BaseModel):
+    """Represents a Gmail inbox answered by the agent, with its credentials and labels."""
+
+    email: str
+    credentials_json: SecretStr
+    # Prefix of the inbox's keys in the shared stores, empty for the primary inbox (keeps its existing keys)
+    namespace: str = ""
+    state_doc_id: str = ""
+    answered_label: str = "Answered by Agent"
+    irrelevant_label: str = "Irrelevant"
+    # Relative share of the worker pools, an inbox with weight 2 runs twice as many workers
+    weight: int = 1
+
+    def model_post_init(self, __context) -> None:
+        self.email = self.email.lower()
+
+    @staticmethod
+    def namespace_of(email: str) -> str:
+        """
+        Returns a namespace usable in document IDs, collection names and file names.
+        """
+        return re.sub(r"[^a-z0-9]+", "_", email.lower()).strip("_")
+
+    def scoped(self, key: str) -> str:
+        """
+        Scopes a key (message, thread or work item ID) to the inbox.
+        """
+        return f"{self.namespace}:{key}" if self.namespace else key
+
+    def scoped_name(self, name: str) -> str:
+        """
+        Scopes a collection name or a file path to the inbox.
+        """
+        if not self.namespace:
+            return name
+        root, ext = os.path.splitext(name)
+        return f"{root}_{self.namespace}{ext}"
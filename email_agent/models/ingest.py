@@ -1,4 +1,6 @@
+from datetime import datetime
 from pydantic import BaseModel
+from typing import List, Literal, Optional
 
 
 class PubSubMessage(BaseModel):
@@ -14,3 +16,63 @@ class GCSMessageData(BaseModel):
     bucket: str
     name: str
     timeCreated: str
+    generation: Optional[str] = None
+    contentType: Optional[str] = None
+
+
+class IngestionManifest(BaseModel):
+    """Represents the ingested state of one source object: its GCS generation and chunk hashes."""
+
+    source: str
+    generation: Optional[str] = None
+    chunk_hashes: List[str] = []
+    # Whether the chunk texts are stored for retrieval (older manifests only kept the hashes)
+    chunk_texts: bool = False
+    # Datapoints of removed chunks not yet deleted from the index, drained by the next update
+    removed_ids: List[str] = []
+    updated_at: Optional[datetime] = None
+
+    def is_current(self, generation: Optional[str]) -> bool:
+        return (
+            self.chunk_texts
+            and not self.removed_ids
+            and generation is not None
+            and self.generation == generation
+        )
+
+
+class BulkIngestionRequest(BaseModel):
+    """Represents a request to ingest all objects of the RAG bucket (or a prefix of it)."""
+
+    # 'gs://<bucket_name>/prefix', the whole RAG bucket by default
+    source: Optional[str] = None
+    restart: bool = False  # Ignore the checkpoint of a previous run
+
+
+class IngestionCheckpoint(BaseModel):
+    """Represents the resumable state of a bulk ingestion of one source."""
+
+    source: str
+    # Every object up to this name (in listing order) is settled
+    watermark: Optional[str] = None
+    done: List[str] = []  # Objects ingested beyond the watermark
+    failed: List[str] = []  # Objects that failed, retried by the next run
+
+
+class BulkIngestionProgress(BaseModel):
+    """Represents the progress of a bulk ingestion run."""
+
+    status: Literal["idle", "running", "completed", "failed"] = "idle"
+    source: Optional[str] = None
+    resumed_after: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    listed: int = 0
+    skipped: int = 0
+    unchanged: int = 0
+    deleted: int = 0  # Objects gone since they were listed or failed
+    documents: int = 0
+    chunks: int = 0
+    failed: int = 0
+    documents_per_s: float = 0.0
+    error: Optional[str] = None
@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class WorkItem(BaseModel):
+    """Represents a unit of background work claimed from the work queue."""
+
+    id: str
+    payload: dict
+    attempts: int = 0
+    deferrals: int = 0
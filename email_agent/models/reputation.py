@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+
+
+class SenderReputation(BaseModel):
+    """Represents the decayed history of relevance decisions for a sender address or domain."""
+
+    key: str
+    relevant: float = 0.0
+    irrelevant: float = 0.0
+    updated_at: float
+
+    @property
+    def observations(self) -> float:
+        return self.relevant + self.irrelevant
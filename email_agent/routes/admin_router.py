@@ -0,0 +1,63 @@
+from fastapi import APIRouter, HTTPException
+from email_agent.services.admission import admission_controller
+from email_agent.services.llm import model_router
+from email_agent.services.reranker import passage_reranker
+from email_agent.services.reputation import reputation_service
+
+
+router = APIRouter(prefix="/admin")
+
+
+@router.get("/reputation")
+async def list_reputations():
+    """
+    Lists the sender and domain reputation entries currently held in memory.
+    """
+    entries = await reputation_service.list_entries()
+    return {"entries": [entry.model_dump() for entry in entries]}
+
+
+@router.get("/reputation/{key}")
+async def get_reputation(key: str):
+    """
+    Returns the reputation of a sender address (e.g. 'john@example.com') or domain (e.g. '@example.com').
+    """
+    entry = await reputation_service.get(key.lower())
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"No reputation found for {key}.")
+
+    return entry.model_dump()
+
+
+@router.delete("/reputation/{key}")
+async def reset_reputation(key: str):
+    """
+    Resets the reputation of a sender address or domain.
+    """
+    await reputation_service.reset(key.lower())
+    return {"status": "success", "message": f"Reputation of {key} reset."}
+
+
+@router.get("/model-routes")
+async def get_model_route_stats():
+    """
+    Returns the per-route latency, token cost and escalation rate of the model routing.
+    """
+    return model_router.stats()
+
+
+@router.get("/retrieval")
+async def get_retrieval_stats():
+    """
+    Returns the latency of every retrieval stage (embedding, search, and the fetch, re-ranking,
+    deduplication and token budget of the re-ranking).
+    """
+    return passage_reranker.stats()
+
+
+@router.get("/admission")
+async def get_admission_stats():
+    """
+    Returns the emails and bytes in flight, the waiting emails per lane and the number of deferrals.
+    """
+    return admission_controller.stats()
@@ -1,14 +1,18 @@
 from fastapi import APIRouter, HTTPException
+from email_agent.config import CFG
 from email_agent.utils.logger import logger
+import asyncio
 import base64
 import json
 from typing import Optional
-from email_agent.models.ingest import PubSubMessage, GCSMessageData
-from email_agent.services.ingestion import (
-    load_and_chunk_gcs_file,
-    get_multilingual_embeddings,
-    upsert_to_vector_search,
+from email_agent.models.ingest import (
+    BulkIngestionRequest,
+    GCSMessageData,
+    PubSubMessage,
 )
+from email_agent.services.bulk_ingestion import bulk_ingestion_service
+from email_agent.services.ingestion import ingest_chunks, load_and_chunk_gcs_file
+from email_agent.services.manifest import manifest_store
 
 
 router = APIRouter()
@@ -35,6 +39,7 @@ def decode_message(message: dict) -> Optional[GCSMessageData]:
 async def ingest_gcs_file(pubsub_data: PubSubMessage):
     """
     Handles the ingestion of documents uploaded to the watched GCS bucket into the deployed Vector Search index.
+    Concurrent events of one object are serialized and reconciled by the compare-and-set of its manifest (see 'ingest_chunks').
     """
     gcs_event_data = decode_message(pubsub_data.message)
 
@@ -43,25 +48,75 @@ async def ingest_gcs_file(pubsub_data: PubSubMessage):
 
     bucket = gcs_event_data.bucket
     name = gcs_event_data.name
+    generation = gcs_event_data.generation
     gcs_file_path = f"gs://{bucket}/{name}"
 
+    # Redelivered events of an already ingested generation are acknowledged without any work
+    manifest = await manifest_store.get(gcs_file_path)
+    if manifest and manifest.is_current(generation):
+        logger.info(
+            f"Generation {generation} of {gcs_file_path} already ingested, skipping."
+        )
+        return {"status": "skipped", "message": "Generation already ingested."}
+
     logger.info(f"Processing new file for ingestion: {gcs_file_path}")
 
     try:
-        # Split document into chunks and embed them
-        chunks = load_and_chunk_gcs_file(bucket, name)
-        embeddings = get_multilingual_embeddings(chunks)
+        # Download and split the document into chunks (blocking, in a worker thread)
+        chunks = await asyncio.to_thread(
+            load_and_chunk_gcs_file,
+            bucket,
+            name,
+            gcs_event_data.contentType,
+            generation,
+        )
 
     except Exception as e:
         logger.error(f"Ingestion pipeline failed for {gcs_file_path}: {e}")
         # Return 200 OK to stop PubSub retrying on bad document data
         return {"status": "error", "message": f"Processing failed: {e}"}
 
-    # Upsert new chunks and embeddings to the Vector Search index
+    # Embed and upsert the new or changed chunks to the Vector Search index, remove the deleted ones
     try:
-        await upsert_to_vector_search(embeddings, chunks)
+        update = await ingest_chunks(gcs_file_path, generation, chunks)
     except Exception as e:
         logger.error(f"Vector Search upsert failed for {gcs_file_path}: {e}")
         raise HTTPException(status_code=500, detail="Vertex AI Upsert failed.")
 
+    if update is None:
+        return {
+            "status": "skipped",
+            "message": "The generation is not newer than the ingested one.",
+        }
+
+    logger.info(
+        f"{len(update.new_chunks)} of {len(update.chunk_hashes)} chunks of {gcs_file_path} new or changed, "
+        f"{len(update.removed_ids)} datapoints removed."
+    )
     return HTTPException(status_code=200)
+
+
+@router.post("/ingest/bulk")
+async def start_bulk_ingestion(request: BulkIngestionRequest):
+    """
+    Starts ingesting all objects of the RAG bucket (or a prefix of it) in the background, resuming
+    the previous run of the same source unless restarted. Local directories are ingested by the CLI only.
+    """
+    bucket_uri = f"gs://{CFG.bucket_name}"
+    if request.source is not None and not (
+        request.source == bucket_uri or request.source.startswith(f"{bucket_uri}/")
+    ):
+        raise HTTPException(
+            status_code=400, detail=f"Only {bucket_uri}/<prefix> can be ingested."
+        )
+
+    progress = await bulk_ingestion_service.start(request.source, request.restart)
+    return progress.model_dump()
+
+
+@router.get("/ingest/bulk")
+async def get_bulk_ingestion_progress():
+    """
+    Returns the progress and throughput of the current or last bulk ingestion run.
+    """
+    return bulk_ingestion_service.progress.model_dump()
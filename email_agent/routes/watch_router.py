@@ -1,46 +1,104 @@
+from typing import List, Optional
 from fastapi import APIRouter, HTTPException
 from email_agent.config import CFG
-from email_agent.services.gmail import get_gmail_service
 from email_agent.utils.logger import logger
-from email_agent.services.firestore import firestore_service
+from email_agent.services.inboxes import InboxContext, inbox_registry
+from email_agent.services.catchup import CatchUpService, catch_up_services
+from email_agent.services.processing import work_queues
 
 
 router = APIRouter()
 
 
-@router.post("/renew-watch")
-async def renew_watch_instruction():
+def _get_inboxes(inbox: Optional[str]) -> List[InboxContext]:
     """
-    Handles the renewal of a watch request on the configured Gmail inbox.
+    Returns the requested inbox, or all answered inboxes if none is given.
     """
-    gmail_service = get_gmail_service()
+    if inbox is None:
+        return inbox_registry.all()
+
+    context = inbox_registry.get(inbox)
+    if context is None:
+        raise HTTPException(status_code=404, detail=f"Unknown inbox {inbox}.")
+    return [context]
+
 
+def _get_catch_up_service(inbox: Optional[str]) -> CatchUpService:
+    if inbox is None:
+        return catch_up_services[inbox_registry.primary.email]
+    return catch_up_services[_get_inboxes(inbox)[0].email]
+
+
+@router.post("/renew-watch")
+async def renew_watch_instruction(inbox: Optional[str] = None):
+    """
+    Handles the renewal of a watch request on the given Gmail inbox, or on all configured inboxes.
+
+    The returned history ID only becomes the cursor of an inbox without one. Otherwise it is queued
+    like a notification, so the history up to it is processed (and the cursor moved) under the lease.
+    """
     # Define the watch request body
     watch_request = {
         "labelIds": ["UNREAD"],  # Watch the UNREAD messages in the Inbox
         "topicName": CFG.pubsub_topic,
     }
 
-    try:
-        # Execute the watch command to renew the subscription
-        response = (
-            gmail_service.users()
-            .watch(userId=CFG.user_email, body=watch_request)
-            .execute()
-        )
-
-        new_history_id = response.get("historyId")
-        if new_history_id:
-            await firestore_service.set_last_history_id(new_history_id)
-            logger.info(f"Renewed historyId saved: {new_history_id}")
-        else:
-            logger.warning("Watch command did not return a historyId.")
-
-        logger.info(f"Watch renewed. New expiration: {response.get('expiration')}")
-
-        return {"status": "success", "message": "Gmail watch successfully renewed."}
-
-    except Exception as e:
-        msg = f"Error renewing watch: {e}"
-        logger.error(msg)
-        raise HTTPException(status_code=500, detail=msg)
+    for context in _get_inboxes(inbox):
+        gmail_service = context.get_gmail_service()
+
+        try:
+            # Execute the watch command to renew the subscription
+            response = (
+                gmail_service.users()
+                .watch(userId=context.email, body=watch_request)
+                .execute()
+            )
+
+            new_history_id = response.get("historyId")
+            if new_history_id and await context.state.initialize_history_id(
+                new_history_id
+            ):
+                logger.info(
+                    f"Initial historyId of {context.email} saved: {new_history_id}"
+                )
+            elif new_history_id:
+                await work_queues[context.email].enqueue(
+                    item_id=f"history-{context.inbox.scoped(str(new_history_id))}",
+                    payload={"history_id": str(new_history_id)},
+                )
+                logger.info(
+                    f"Renewed historyId of {context.email} queued: {new_history_id}"
+                )
+            else:
+                logger.warning(
+                    f"Watch command of {context.email} did not return a historyId."
+                )
+
+            logger.info(
+                f"Watch of {context.email} renewed. New expiration: {response.get('expiration')}"
+            )
+
+        except Exception as e:
+            msg = f"Error renewing watch of {context.email}: {e}"
+            logger.error(msg)
+            raise HTTPException(status_code=500, detail=msg)
+
+    return {"status": "success", "message": "Gmail watch successfully renewed."}
+
+
+@router.post("/catch-up")
+async def start_catch_up(inbox: Optional[str] = None):
+    """
+    Starts answering all unread messages of an inbox (the primary one by default, oldest first),
+    independently of the stored history ID.
+    """
+    progress = await _get_catch_up_service(inbox).start()
+    return progress.model_dump()
+
+
+@router.get("/catch-up")
+async def get_catch_up_progress(inbox: Optional[str] = None):
+    """
+    Returns the progress and throughput of the current or last catch-up run of an inbox.
+    """
+    return _get_catch_up_service(inbox).progress.model_dump()
@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import AsyncIterator, Dict, List, Tuple
+from email_agent.config import CFG
+from email_agent.services.gmail import extract_sender_email
+from email_agent.services.reputation import reputation_service
+from email_agent.utils.logger import logger
+
+
+class Lane(IntEnum):
+    """Priority lane of an email waiting for admission, lower values are served first."""
+
+    LIGHT = 0  # Short text-only emails of known customers
+    STANDARD = 1  # Other text-only emails
+    HEAVY = 2  # Emails with attachments or large bodies
+
+
+async def classify(metadata: List[dict]) -> Tuple[Lane, int]:
+    """
+    Assigns the lane of a group of messages (answered together) from their metadata and returns it
+    together with their estimated size in bytes, before their bodies and attachments are downloaded.
+    """
+    size = sum(int(message.get("sizeEstimate", 0)) for message in metadata)
+    headers = [
+        {
+            header["name"].lower(): header["value"]
+            for header in message["payload"]["headers"]
+        }
+        for message in metadata
+        if "payload" in message
+    ]
+
+    # multipart/mixed (or related) messages carry attachments or inline images
+    if size > CFG.admission_light_max_bytes or any(
+        h.get("content-type", "")
+        .lower()
+        .startswith(("multipart/mixed", "multipart/related"))
+        for h in headers
+    ):
+        return Lane.HEAVY, size
+
+    for h in headers:
+        if await reputation_service.decide(extract_sender_email(h.get("from", ""))):
+            return Lane.LIGHT, size
+    return Lane.STANDARD, size
+
+
+class AdmissionController:
+    """
+    Bounds the emails (and their estimated bytes) processed at once by all inboxes of this instance.
+
+    Emails waiting for admission are served by lane, so short text-only emails of known customers
+    overtake heavy multimedia ones. Once the tracked work (in flight and waiting) exceeds the defer
+    watermarks, callers are told to stop taking new work, which stays in the Gmail history until later.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.waiting_bytes = 0
+        self._waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._admitted: Dict[str, int] = {lane.name.lower(): 0 for lane in Lane}
+        self._deferred = 0
+
+    def _fits(self, size: int) -> bool:
+        # An email larger than the byte limit is admitted alone, it would never fit otherwise
+        return self.in_flight < CFG.admission_max_in_flight and (
+            self.in_flight == 0
+            or self.in_flight_bytes + size <= CFG.admission_max_in_flight_bytes
+        )
+
+    def _dispatch(self) -> None:
+        """
+        Admits the waiters in lane order while the limits allow it.
+        """
+        while self._waiters:
+            _, _, size, waiter = self._waiters[0]
+            if waiter.done():  # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                self.waiting_bytes -= size
+                continue
+            if not self._fits(size):
+                return
+
+            heapq.heappop(self._waiters)
+            self.waiting_bytes -= size
+            self.in_flight += 1
+            self.in_flight_bytes += size
+            waiter.set_result(None)
+
+    def _release(self, size: int) -> None:
+        self.in_flight -= 1
+        self.in_flight_bytes -= size
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, lane: Lane, size: int) -> AsyncIterator[None]:
+        """
+        Waits until an email of the given lane and estimated size may be processed.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._sequence), size, waiter))
+        self.waiting_bytes += size
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(size)
+            raise
+
+        self._admitted[lane.name.lower()] += 1
+        try:
+            yield
+        finally:
+            self._release(size)
+
+    def should_defer(self) -> bool:
+        """
+        Checks whether the tracked work exceeds a defer watermark, i.e. no new work should be taken.
+        """
+        emails = self.in_flight + sum(
+            1 for *_, waiter in self._waiters if not waiter.done()
+        )
+        size = self.in_flight_bytes + self.waiting_bytes
+        if emails < CFG.admission_defer_emails and size < CFG.admission_defer_bytes:
+            return False
+
+        self._deferred += 1
+        logger.warning(
+            f"Admission watermark exceeded ({emails} emails, {size} bytes), deferring new work."
+        )
+        return True
+
+    def stats(self) -> dict:
+        waiting: Dict[str, int] = {lane.name.lower(): 0 for lane in Lane}
+        for lane, _, _, waiter in self._waiters:
+            if not waiter.done():
+                waiting[Lane(lane).name.lower()] += 1
+
+        return {
+            "in_flight": self.in_flight,
+            "in_flight_bytes": self.in_flight_bytes,
+            "waiting": waiting,
+            "waiting_bytes": self.waiting_bytes,
+            "admitted": dict(self._admitted),
+            "deferred": self._deferred,
+        }
+
+
+admission_controller = AdmissionController()
@@ -1,9 +1,18 @@
 from typing import List
+import asyncio
+import base64
 import io
 from langsmith import traceable
-from email_agent.models.gmail import EmailMessage
+from email_agent.models.gmail import EmailAttachment, EmailMessage
+from email_agent.utils.spool import AttachmentContent
 from email_agent.utils.logger import logger
 from email_agent.config import CFG
+from email_agent.services.limiter import (
+    Priority,
+    estimate_tokens,
+    gemini_limiter,
+    speech_limiter,
+)
 
 
 image_model = None
@@ -11,17 +20,19 @@ with open(CFG.description_prompt_path, "r", encoding="utf-8") as file:
     img_description_prompt = file.read()
 
 
-def _extract_pdf_text(data: bytes) -> str:
+def _extract_pdf_text(content: AttachmentContent) -> str:
     """
     Extracts text from PDFs attached to the email, to be used as further context for the agent.
     """
     try:
         import PyPDF2
 
-        reader = PyPDF2.PdfReader(io.BytesIO(data))
-        texts = []
-        for page in reader.pages:
-            texts.append(page.extract_text() or "")
+        # The reader seeks in the (possibly disk spooled) file instead of a copy of its bytes
+        with content.stream() as stream:
+            reader = PyPDF2.PdfReader(stream)
+            texts = []
+            for page in reader.pages:
+                texts.append(page.extract_text() or "")
 
         pdf_text = "\n".join(texts).strip()
         logger.info(f"PDF text:\n{pdf_text}")
@@ -31,7 +42,7 @@ def _extract_pdf_text(data: bytes) -> str:
 
 
 @traceable
-async def _extract_image_text(data: bytes) -> str:
+async def _extract_image_text(content: AttachmentContent) -> str:
     """
     Uses LLM to generate an image description of images attached to the email, to be used as further context for the agent.
     """
@@ -44,17 +55,22 @@ async def _extract_image_text(data: bytes) -> str:
             Image,
         )
 
-        image_part = Part.from_image(Image.from_bytes(data))
+        # The request is built from bytes, the only copy of the image held during the call
+        image_part = Part.from_image(Image.from_bytes(content.read()))
 
         if image_model is None:
             image_model = GenerativeModel("gemini-2.5-flash")
 
-        response = await image_model.generate_content_async(
-            [image_part, Part.from_text(img_description_prompt)],
-            generation_config=GenerationConfig(
-                response_mime_type="text/plain",
-                temperature=CFG.temperature,
+        response = await gemini_limiter.run(
+            lambda: image_model.generate_content_async(
+                [image_part, Part.from_text(img_description_prompt)],
+                generation_config=GenerationConfig(
+                    response_mime_type="text/plain",
+                    temperature=CFG.temperature,
+                ),
             ),
+            priority=Priority.REPLY,
+            tokens=estimate_tokens(img_description_prompt) + 258,  # Tokens per image
         )
 
         description = response.candidates[0].content.parts[0].text
@@ -67,7 +83,47 @@ async def _extract_image_text(data: bytes) -> str:
         return "[Extraction of image content failed]"
 
 
-def _extract_audio_text(data: bytes, mime: str) -> str:
+def _prepare_image_part(content: AttachmentContent) -> dict:
+    """
+    Downscales and re-encodes an image attachment into a content block for a multimodal chat message.
+    """
+    from PIL import Image
+
+    with content.stream() as stream:
+        image = Image.open(stream)
+        image.draft("RGB", (CFG.image_max_dimension, CFG.image_max_dimension))
+        image.thumbnail((CFG.image_max_dimension, CFG.image_max_dimension))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=CFG.image_jpeg_quality)
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{encoded}"},
+    }
+
+
+async def prepare_image_parts(email_message: EmailMessage) -> List[dict]:
+    """
+    Return preprocessed image content blocks for all image attachments (used with 'image_mode=inline').
+    """
+    parts: List[dict] = []
+    for att in email_message.body.attachments or []:
+        if not (att.mime_type or "").lower().startswith("image/") or not att.content:
+            continue
+
+        try:
+            parts.append(await asyncio.to_thread(_prepare_image_part, att.content))
+        except Exception as e:
+            logger.error(f"Failed to preprocess image {att.filename}: {e}")
+
+    return parts
+
+
+async def _extract_audio_text(content: AttachmentContent, mime: str) -> str:
     """
     Transcribes audio files attached to the email using Google's Speech-to-Text API, to be used as further context for the agent.
     """
@@ -87,7 +143,7 @@ def _extract_audio_text(data: bytes, mime: str) -> str:
         }
 
         client = speech.SpeechClient()
-        audio = speech.RecognitionAudio(content=data)
+        audio = speech.RecognitionAudio(content=content.read())
 
         mime_lower = mime.lower().split(";")[0].strip()
         enc = MIME_TO_ENCODING.get(mime_lower)
@@ -108,7 +164,10 @@ def _extract_audio_text(data: bytes, mime: str) -> str:
             enable_automatic_punctuation=True,
         )
 
-        response = client.recognize(config=config, audio=audio)
+        response = await speech_limiter.run(
+            lambda: asyncio.to_thread(client.recognize, config=config, audio=audio),
+            priority=Priority.REPLY,
+        )
 
         # Get the most likely alternatives for each sentence
         transcription = " ".join(
@@ -122,6 +181,11 @@ def _extract_audio_text(data: bytes, mime: str) -> str:
         return "[Extraction of audio content failed]"
 
 
+def _describe_skipped(att: EmailAttachment) -> str:
+    reason = att.skipped_reason or "its content is not available"
+    return f"[Attachment {att.filename} ({att.size} bytes) was not processed: {reason}]"
+
+
 async def process_attachments(email_message: EmailMessage) -> List[str]:
     """
     Return a list of extracted text summaries for all attachments.
@@ -129,14 +193,18 @@ async def process_attachments(email_message: EmailMessage) -> List[str]:
     out: List[str] = []
     for att in email_message.body.attachments or []:
         mime = (att.mime_type or "").lower()
-        if "pdf" in mime or att.filename.lower().endswith(".pdf"):
-            pdf_text = _extract_pdf_text(att.data)
+        if att.content is None:
+            out.append(_describe_skipped(att))
+        elif "pdf" in mime or att.filename.lower().endswith(".pdf"):
+            pdf_text = await asyncio.to_thread(_extract_pdf_text, att.content)
             out.append(f"PDF ({att.filename}) content:\n{pdf_text}")
+        elif mime.startswith("image/") and CFG.image_mode == "inline":
+            out.append(f"Image ({att.filename}) is attached to this message.")
         elif mime.startswith("image/"):
-            image_text = await _extract_image_text(att.data)
+            image_text = await _extract_image_text(att.content)
             out.append(f"Image ({att.filename}) content:\n{image_text}")
         elif mime.startswith("audio/"):
-            audio_text = _extract_audio_text(att.data, mime)
+            audio_text = await _extract_audio_text(att.content, mime)
             out.append(f"Audio ({att.filename}) content:\n{audio_text}")
         else:
             out.append(
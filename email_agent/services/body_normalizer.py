@@ -0,0 +1,252 @@
+import base64
+import re
+from html import unescape
+from html.parser import HTMLParser
+from typing import List, Optional
+from email_agent.config import CFG
+
+
+# Tags whose content is never shown to the reader
+_HIDDEN_TAGS = {"head", "script", "style", "title", "template", "noscript"}
+# Tags that start a new line of text
+_BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "footer",
+    "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol",
+    "p", "pre", "section", "table", "tr", "ul",
+}  # fmt: skip
+# Elements of the quoted history inserted by common mail clients (Gmail, Outlook, Apple Mail, Thunderbird)
+_QUOTE_CLASSES = re.compile(
+    r"gmail_quote|gmail_extra|OutlookMessageHeader|divRplyFwdMsg|moz-cite-prefix|yahoo_quoted"
+)
+
+# Attribution lines opening a quoted reply, e.g. 'On Mon, 1 Jan 2024 John <j@x.com> wrote:'
+# or the Czech 'Dne 1. 1. 2024 v 10:00 Jan <j@x.cz> napsal(a):'
+_ATTRIBUTION = re.compile(
+    r"^\s*(On\s.{0,300}?\swrote|Dne\s.{0,300}?\snapsal(\(a\)|a)?|Am\s.{0,300}?\sschrieb)\s*:\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+# Separators of the original message in replies (forwarded messages are kept, they are the context of the email)
+_ORIGINAL_MESSAGE = re.compile(
+    r"^\s*(-{2,}\s*(Original Message|Původní zpráva)\s*-{2,}|_{10,})\s*$",
+    re.IGNORECASE,
+)
+# Separators of a forwarded message (Gmail, Apple Mail), whose header block is part of the forward
+_FORWARDED = re.compile(
+    r"^\s*(-{2,}\s*(Forwarded message|Přeposlaná zpráva|Weitergeleitete Nachricht)\s*-{2,}"
+    r"|Begin forwarded message\s*:)\s*$",
+    re.IGNORECASE,
+)
+# Outlook header block of the quoted message: 'From:' followed by 'Sent:' / 'Odesláno:' and 'To:' / 'Subject:'
+_OUTLOOK_FROM = re.compile(r"^\s*\*?(From|Od)\s*:\*?\s", re.IGNORECASE)
+_OUTLOOK_SENT = re.compile(r"^\s*\*?(Sent|Date|Odesláno|Datum)\s*:\*?\s", re.IGNORECASE)
+_OUTLOOK_TO = re.compile(r"^\s*\*?(To|Subject|Komu|Předmět)\s*:\*?\s", re.IGNORECASE)
+_SIGNATURE_MARKERS = re.compile(
+    r"^\s*(--\s*|Sent from my .{1,40}|Odesláno z (mého )?.{1,40}|Get Outlook for .{1,40})$",
+    re.IGNORECASE,
+)
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """
+    Collects the visible text of an HTML document, skipping hidden elements and the quoted history.
+    """
+
+    def __init__(self, skip_quotes: bool):
+        super().__init__(convert_charrefs=True)
+        self.skip_quotes = skip_quotes
+        self.parts: List[str] = []
+        self._skip_depth = 0  # Depth within a skipped element
+        self._stack: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in ("br", "hr", "img", "meta", "link", "input", "wbr"):  # Void elements
+            if tag in _BLOCK_TAGS and not self._skip_depth:
+                self.parts.append("\n")
+            return
+
+        self._stack.append(tag)
+        if self._skip_depth:
+            self._skip_depth += 1
+            return
+
+        attributes = dict(attrs)
+        if tag in _HIDDEN_TAGS or (
+            self.skip_quotes
+            and (
+                tag == "blockquote"
+                or _QUOTE_CLASSES.search(attributes.get("class") or "")
+                or _QUOTE_CLASSES.search(attributes.get("id") or "")
+            )
+        ):
+            self._skip_depth = 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag not in self._stack:
+            return  # Stray end tag of malformed HTML
+
+        # Close the elements left open in between as well
+        while self._stack:
+            open_tag = self._stack.pop()
+            if self._skip_depth:
+                self._skip_depth -= 1
+            if open_tag == tag:
+                break
+
+        if not self._skip_depth and tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data: str) -> None:
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html: str, skip_quotes: bool = True) -> str:
+    """
+    Converts an HTML email body to plain text, optionally without the quoted history of a reply.
+    """
+    parser = _HTMLTextExtractor(skip_quotes)
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        # Fall back to removing the tags of badly broken markup
+        return unescape(re.sub(r"<[^>]+>", " ", html))
+    return "".join(parser.parts)
+
+
+def is_outlook_header(lines: List[str], index: int) -> bool:
+    """
+    Checks whether a line opens an Outlook header block: a 'From:' line at the start of the body or after
+    a blank line, followed by 'Sent:' (or 'Date:') and 'To:' (or 'Subject:') lines within the block.
+    """
+    if not _OUTLOOK_FROM.match(lines[index]) or (
+        index > 0 and lines[index - 1].strip()
+    ):
+        return False
+
+    block: List[str] = []
+    for following in lines[index + 1 : index + 5]:
+        if not following.strip():
+            break
+        block.append(following)
+    return any(_OUTLOOK_SENT.match(line) for line in block) and any(
+        _OUTLOOK_TO.match(line) for line in block
+    )
+
+
+def strip_quoted_text(text: str) -> str:
+    """
+    Cuts a plain text reply before its quoted history: the attribution line ('On ... wrote:'),
+    an original message separator or an Outlook header block, and drops '>' quoted lines.
+    A bottom-posted reply (nothing written above the attribution) keeps the text below the quote,
+    a forwarded message is kept with its header block.
+    """
+    lines = text.splitlines()
+    kept: List[str] = []
+    skip_to = 0
+    for index, line in enumerate(lines):
+        if index < skip_to:
+            continue
+        # Attribution lines are often wrapped over two lines
+        is_wrapped_attribution = (
+            not _ATTRIBUTION.match(line)
+            and index + 1 < len(lines)
+            and _ATTRIBUTION.match(f"{line} {lines[index + 1]}")
+        )
+        is_attribution = _ATTRIBUTION.match(line) or is_wrapped_attribution
+        previous_line = next(
+            (kept_line for kept_line in reversed(kept) if kept_line.strip()), ""
+        )
+        if is_attribution and not any(kept_line.strip() for kept_line in kept):
+            skip_to = index + (2 if is_wrapped_attribution else 1)
+            continue
+        if (
+            is_attribution
+            or (is_outlook_header(lines, index) and not _FORWARDED.match(previous_line))
+            or _ORIGINAL_MESSAGE.match(line)
+        ):
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        kept.append(line)
+
+    return "\n".join(kept)
+
+
+def strip_signature(text: str) -> str:
+    """
+    Cuts the signature off a plain text body: the standard '-- ' delimiter or a mobile client footer
+    within the last lines of the body.
+    """
+    lines = text.splitlines()
+    start = max(len(lines) - CFG.body_signature_max_lines, 0)
+    for index in range(start, len(lines)):
+        if _SIGNATURE_MARKERS.match(lines[index]):
+            return "\n".join(lines[:index])
+    return text
+
+
+def collapse_whitespace(text: str) -> str:
+    """
+    Removes trailing spaces and collapses runs of blank lines (HTML layouts produce plenty of them).
+    """
+    text = text.replace("\r\n", "\n").replace("\xa0", " ")
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    text = re.sub(r"[ \t]{2,}", " ", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def decode_text_part(data: str, headers: List[dict]) -> str:
+    """
+    Decodes the URL-safe base64 data of a text part with the charset of its Content-Type header
+    (falling back to UTF-8 and replacing undecodable bytes).
+    """
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    content_type = next(
+        (h["value"] for h in headers if h["name"].lower() == "content-type"), ""
+    )
+    charset_match = re.search(
+        r'charset\s*=\s*"?([\w.:-]+)"?', content_type, re.IGNORECASE
+    )
+    charset = charset_match.group(1) if charset_match else "utf-8"
+
+    try:
+        return raw.decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        # Unknown charset label, or a wrong one (e.g. Windows-1250 declared as ISO-8859-2)
+        for fallback in ("utf-8", "cp1250"):
+            try:
+                return raw.decode(fallback)
+            except UnicodeDecodeError:
+                continue
+        return raw.decode("utf-8", errors="replace")
+
+
+def normalize_body(plain_text: str, html_text: Optional[str] = None) -> str:
+    """
+    Returns the body text to be answered: the plain text part (or the converted HTML part if there
+    is no plain one) without the quoted history and the signature.
+    """
+    if not CFG.body_normalizer_enabled:
+        return plain_text or (
+            html_to_text(html_text, skip_quotes=False) if html_text else ""
+        )
+
+    if plain_text.strip():
+        text = collapse_whitespace(plain_text)
+    else:
+        full_text = collapse_whitespace(
+            html_to_text(html_text or "", skip_quotes=False)
+        )
+        # Gmail wraps forwarded messages in the same element as quotes, the text rules keep them
+        if any(_FORWARDED.match(line) for line in full_text.splitlines()):
+            text = full_text
+        else:
+            text = collapse_whitespace(html_to_text(html_text or "")) or full_text
+    # Keep the whole text if nothing but the quote is left (e.g. an unmarked bottom-posted reply)
+    stripped = strip_quoted_text(text)
+    if stripped.strip():
+        text = stripped
+    return collapse_whitespace(strip_signature(text))
@@ -0,0 +1,508 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+from email_agent.config import CFG
+from email_agent.models.ingest import BulkIngestionProgress, IngestionCheckpoint
+from email_agent.services.firestore import db
+from email_agent.services.ingestion import (
+    complete_ingestion,
+    get_multilingual_embeddings,
+    get_storage_client,
+    load_and_chunk_blob,
+    is_superseded,
+    load_and_chunk_file,
+    remove_source,
+    source_lock,
+    to_datapoints,
+    upsert_datapoints,
+)
+from email_agent.services.manifest import (
+    ManifestUpdate,
+    chunk_store,
+    manifest_store,
+)
+from email_agent.utils.logger import logger
+
+
+_END = None  # Closes a pipeline queue, once for every consumer
+
+
+class ObjectDeletedError(Exception):
+    """Raised when a listed (or previously failed) object no longer exists."""
+
+
+class IngestionSource:
+    """
+    A GCS bucket (with an optional prefix) or a local directory whose objects are ingested.
+
+    Local files are uploaded to the configured bucket ('gs://<bucket_name>/<relative path>') and indexed
+    under their object, from which the knowledge base search downloads the contents of the matched documents.
+    """
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.directory: Optional[Path] = None
+        if uri.startswith("gs://"):
+            self.bucket, _, self.prefix = uri.removeprefix("gs://").partition("/")
+        else:
+            self.directory = Path(uri)
+            self.bucket, self.prefix = CFG.bucket_name, ""
+            if not self.directory.is_dir():
+                raise ValueError(f"{uri} is neither a GCS URI nor a directory.")
+
+    def gcs_uri(self, name: str) -> str:
+        return f"gs://{self.bucket}/{name}"
+
+    async def list_objects(
+        self, after: Optional[str]
+    ) -> AsyncIterator[List[Tuple[str, Optional[str]]]]:
+        """
+        Yields pages of (object name, generation) in lexicographic order (the GCS listing order),
+        after the given name. Local files get their generation once they are read.
+        """
+        if self.directory is not None:
+            names = sorted(
+                path.relative_to(self.directory).as_posix()
+                for path in self.directory.rglob("*")
+                if path.is_file()
+            )
+            objects = [(name, None) for name in names if after is None or name > after]
+            for start in range(0, len(objects), CFG.ingest_list_page_size):
+                yield objects[start : start + CFG.ingest_list_page_size]
+            return
+
+        blobs = get_storage_client().list_blobs(
+            self.bucket,
+            prefix=self.prefix or None,
+            start_offset=after,  # Inclusive
+            page_size=CFG.ingest_list_page_size,
+        )
+        pages = iter(blobs.pages)
+        while (page := await asyncio.to_thread(next, pages, None)) is not None:
+            yield [
+                (blob.name, str(blob.generation))
+                for blob in page
+                if (after is None or blob.name > after) and not blob.name.endswith("/")
+            ]
+
+    def upload(self, name: str) -> str:
+        """
+        Uploads a local file to its object in the bucket, unless the object has the same content already,
+        and returns the generation of the object (blocking).
+        """
+        path = self.directory / name
+        if not path.is_file():
+            raise ObjectDeletedError(f"{path} no longer exists.")
+
+        md5_hash = base64.b64encode(hashlib.md5(path.read_bytes()).digest()).decode()
+        blob = get_storage_client().bucket(self.bucket).get_blob(name)
+        if blob is not None and blob.md5_hash == md5_hash:
+            return str(blob.generation)
+
+        if blob is None:
+            blob = get_storage_client().bucket(self.bucket).blob(name)
+            expected_generation = 0  # The object must not exist
+        else:
+            expected_generation = blob.generation
+        blob.upload_from_filename(str(path), if_generation_match=expected_generation)
+        logger.info(f"{path} uploaded to {self.gcs_uri(name)}.")
+        return str(blob.generation)
+
+    def load_chunks(
+        self, name: str, generation: Optional[str]
+    ) -> Tuple[str, List[Document]]:
+        """
+        Reads or downloads one object (the listed generation, or the latest one if that was replaced since)
+        and splits its text into chunks (blocking). Returns the generation as well, that of the uploaded
+        object for local files. Raises 'ObjectDeletedError' if the object no longer exists.
+        """
+        from google.api_core.exceptions import NotFound
+
+        if self.directory is not None:
+            generation = self.upload(name)
+            return generation, load_and_chunk_file(
+                str(self.directory / name), self.gcs_uri(name)
+            )
+
+        bucket = get_storage_client().bucket(self.bucket)
+        if generation is not None:
+            try:
+                blob = bucket.blob(name, generation=int(generation))
+                return generation, load_and_chunk_blob(blob, self.gcs_uri(name))
+            except NotFound:
+                pass  # Replaced or deleted since it was listed
+
+        latest = bucket.get_blob(name)
+        if latest is None:
+            raise ObjectDeletedError(f"{self.gcs_uri(name)} no longer exists.")
+        blob = bucket.blob(name, generation=latest.generation)
+        return str(latest.generation), load_and_chunk_blob(blob, self.gcs_uri(name))
+
+
+class BulkIngestionService:
+    """
+    Ingests all objects of a source into the Vector Search index through a streaming pipeline.
+
+    Object names are listed page by page into bounded queues: concurrent loaders download and chunk
+    the objects, a single embedder embeds the chunks in fixed-size batches (in a worker thread), and
+    concurrent uploaders upsert the datapoints in requests of bounded size. Memory use is bounded by the
+    queue sizes, not by the size of the source.
+
+    An object is settled once all of its chunks are upserted (or it failed). The checkpoint stores the
+    watermark up to which all listed objects are settled, the settled objects beyond it and the failed
+    ones, so that a rerun lists the source from the watermark and retries the failures.
+    """
+
+    def __init__(self):
+        self.progress = BulkIngestionProgress()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _checkpoint_ref(self, uri: str):
+        doc_id = hashlib.sha256(uri.encode()).hexdigest()[:32]
+        return db.collection(CFG.ingest_checkpoint_collection).document(doc_id)
+
+    async def _load_checkpoint(self, uri: str) -> IngestionCheckpoint:
+        doc = await self._checkpoint_ref(uri).get()
+        if doc.exists:
+            return IngestionCheckpoint(**doc.to_dict())
+        return IngestionCheckpoint(source=uri)
+
+    async def _save_checkpoint(self) -> None:
+        async with self._checkpoint_lock:
+            self._unsaved = 0
+            checkpoint = IngestionCheckpoint(
+                source=self._checkpoint.source,
+                watermark=self._checkpoint.watermark,
+                done=sorted(
+                    name
+                    for name in self._settled - self._failed
+                    if self._checkpoint.watermark is None
+                    or name > self._checkpoint.watermark
+                ),
+                failed=sorted(self._failed),
+            )
+            await self._checkpoint_ref(checkpoint.source).set(checkpoint.model_dump())
+
+        self._update_throughput()
+        logger.info(
+            f"Bulk ingestion progress: {self.progress.documents} documents, {self.progress.chunks} chunks, "
+            f"{self.progress.failed} failed ({self.progress.documents_per_s:.2f} documents/s)."
+        )
+
+    def _update_throughput(self) -> None:
+        elapsed = (
+            datetime.now(timezone.utc) - self.progress.started_at
+        ).total_seconds()
+        self.progress.documents_per_s = (
+            self.progress.documents / elapsed if elapsed > 0 else 0.0
+        )
+
+    def _settle(self, name: str, failed: bool = False, deleted: bool = False) -> None:
+        """
+        Records an object as ingested, deleted (dropped from the checkpoint like an ingested one)
+        or failed, and advances the watermark over the settled prefix.
+        """
+        self._pending_chunks.pop(name, None)
+        self._updates.pop(name, None)
+        if failed:
+            self._failed.add(name)
+            self.progress.failed += 1
+        elif deleted:
+            self._failed.discard(name)
+            self.progress.deleted += 1
+        else:
+            self._failed.discard(name)
+            self.progress.documents += 1
+
+        self._settled.add(name)
+        self._unsaved += 1
+        while self._order and self._order[0] in self._settled:
+            head = self._order.popleft()
+            if head in self._failed:
+                continue  # Kept in the checkpoint as failed
+            self._settled.discard(head)
+            # Retried failures are listed first and lie before the watermark
+            if self._checkpoint.watermark is None or head > self._checkpoint.watermark:
+                self._checkpoint.watermark = head
+
+    async def _maybe_save_checkpoint(self) -> None:
+        if self._unsaved >= CFG.ingest_checkpoint_every:
+            await self._save_checkpoint()
+
+    async def _list_stage(self, source: IngestionSource, names: asyncio.Queue) -> None:
+        checkpoint = self._checkpoint
+        done = set(checkpoint.done)
+        # Failures beyond the watermark are listed again anyway
+        retried = [
+            (name, None)
+            for name in checkpoint.failed
+            if checkpoint.watermark is not None and name <= checkpoint.watermark
+        ]
+
+        async def pages() -> AsyncIterator[List[Tuple[str, Optional[str]]]]:
+            if retried:
+                yield retried
+            async for page in source.list_objects(checkpoint.watermark):
+                yield page
+
+        async for page in pages():
+            for name, generation in page:
+                self.progress.listed += 1
+                if name in done:
+                    self.progress.skipped += 1
+                    continue
+                self._order.append(name)
+                await names.put((name, generation))
+
+    async def _load_stage(
+        self, source: IngestionSource, names: asyncio.Queue, chunks: asyncio.Queue
+    ) -> None:
+        while (item := await names.get()) is not _END:
+            name, generation = item
+            uri = source.gcs_uri(name)
+            try:
+                # Objects whose generation (or a newer one) is already ingested are neither downloaded
+                # nor embedded
+                manifest = await manifest_store.get(uri)
+                if not is_superseded(manifest, generation):
+                    generation, documents = await asyncio.to_thread(
+                        source.load_chunks, name, generation
+                    )
+                if is_superseded(manifest, generation):
+                    self.progress.unchanged += 1
+                    self._settle(name)
+                    await self._maybe_save_checkpoint()
+                    continue
+
+                update = ManifestUpdate(uri, generation, documents, manifest)
+                if not update.new_chunks:
+                    # Chunks removed or reordered only
+                    async with source_lock(uri):
+                        await complete_ingestion(update, set())
+                else:
+                    # The texts are stored first, so every upserted datapoint can be resolved by the retrieval
+                    await chunk_store.save(uri, update.new_chunks)
+            except ObjectDeletedError as e:
+                logger.info(f"{e} Removing it from the index.")
+                try:
+                    await remove_source(uri)
+                except Exception as e:
+                    logger.error(f"Bulk ingestion failed to remove {name}: {e}")
+                    self._settle(name, failed=True)
+                    continue
+                self._settle(name, deleted=True)
+                await self._maybe_save_checkpoint()
+                continue
+            except Exception as e:
+                logger.error(f"Bulk ingestion failed to load {name}: {e}")
+                self._settle(name, failed=True)
+                continue
+
+            if not update.new_chunks:
+                self._settle(name)
+            else:
+                self._updates[name] = update
+                self._pending_chunks[name] = len(update.new_chunks)
+                await chunks.put((name, update.new_chunks))
+            await self._maybe_save_checkpoint()
+
+    async def _embed_stage(self, chunks: asyncio.Queue, batches: asyncio.Queue) -> None:
+        batch: List[Tuple[str, Document]] = []
+        finished = False
+        while not finished:
+            item = await chunks.get()
+            if item is _END:
+                finished = True
+            else:
+                name, documents = item
+                batch.extend((name, document) for document in documents)
+
+            # Objects are split across batches, the batches stay of the same size
+            while len(batch) >= CFG.ingest_embed_batch_size or (finished and batch):
+                current = batch[: CFG.ingest_embed_batch_size]
+                batch = batch[CFG.ingest_embed_batch_size :]
+                documents = [document for _, document in current]
+                try:
+                    embeddings = await asyncio.to_thread(
+                        get_multilingual_embeddings, documents
+                    )
+                except Exception as e:
+                    logger.error(f"Bulk ingestion failed to embed a batch: {e}")
+                    for name in {name for name, _ in current}:
+                        if name in self._pending_chunks:
+                            self._settle(name, failed=True)
+                    continue
+
+                datapoints = list(
+                    zip(
+                        (name for name, _ in current),
+                        to_datapoints(embeddings, documents),
+                    )
+                )
+                for start in range(0, len(datapoints), CFG.ingest_upsert_batch_size):
+                    await batches.put(
+                        datapoints[start : start + CFG.ingest_upsert_batch_size]
+                    )
+
+    async def _upsert_stage(self, batches: asyncio.Queue) -> None:
+        while (batch := await batches.get()) is not _END:
+            try:
+                await upsert_datapoints([datapoint for _, datapoint in batch])
+            except Exception as e:
+                logger.error(f"Bulk ingestion failed to upsert a batch: {e}")
+                for name in {name for name, _ in batch}:
+                    if name in self._pending_chunks:
+                        self._settle(name, failed=True)
+                continue
+
+            self.progress.chunks += len(batch)
+            for name, _ in batch:
+                if name not in self._pending_chunks:
+                    continue  # Another chunk of the object failed
+                self._pending_chunks[name] -= 1
+                if self._pending_chunks[name] == 0:
+                    await self._complete(name)
+            await self._maybe_save_checkpoint()
+
+    async def _complete(self, name: str) -> None:
+        """
+        Removes the deleted chunks of a fully upserted object and stores its manifest, reconciled
+        with a concurrent ingestion of the object like the event-driven one.
+        """
+        update = self._updates[name]
+        try:
+            async with source_lock(update.source):
+                await complete_ingestion(
+                    update,
+                    {chunk.metadata["chunk_hash"] for chunk in update.new_chunks},
+                )
+        except Exception as e:
+            logger.error(f"Bulk ingestion failed to complete {name}: {e}")
+            self._settle(name, failed=True)
+            return
+        self._settle(name)
+
+    async def _run_pipeline(self, source: IngestionSource) -> None:
+        names: asyncio.Queue = asyncio.Queue(CFG.ingest_queue_size)
+        chunks: asyncio.Queue = asyncio.Queue(CFG.ingest_queue_size)
+        batches: asyncio.Queue = asyncio.Queue(CFG.ingest_queue_size)
+
+        async def close(
+            stages: List[asyncio.Task], queue: asyncio.Queue, consumers: int
+        ):
+            # A stage is finished once all of its workers returned, its consumers then stop
+            await asyncio.gather(*stages)
+            for _ in range(consumers):
+                await queue.put(_END)
+
+        async with asyncio.TaskGroup() as group:
+            listing = [group.create_task(self._list_stage(source, names))]
+            loaders = [
+                group.create_task(self._load_stage(source, names, chunks))
+                for _ in range(CFG.ingest_load_concurrency)
+            ]
+            embedder = [group.create_task(self._embed_stage(chunks, batches))]
+            for _ in range(CFG.ingest_upsert_concurrency):
+                group.create_task(self._upsert_stage(batches))
+
+            group.create_task(close(listing, names, CFG.ingest_load_concurrency))
+            group.create_task(close(loaders, chunks, 1))
+            group.create_task(close(embedder, batches, CFG.ingest_upsert_concurrency))
+
+    async def run(
+        self, uri: Optional[str] = None, restart: bool = False
+    ) -> BulkIngestionProgress:
+        """
+        Ingests all objects of a GCS bucket (prefix) or a local directory, the RAG bucket by default,
+        resuming from the checkpoint of a previous run of the same source unless restarted.
+        """
+        uri = uri or f"gs://{CFG.bucket_name}"
+        self.progress = BulkIngestionProgress(
+            status="running", source=uri, started_at=datetime.now(timezone.utc)
+        )
+        self._checkpoint = IngestionCheckpoint(source=uri)
+        self._checkpoint_lock = asyncio.Lock()
+        self._order: Deque[str] = deque()  # Listed objects not yet behind the watermark
+        self._settled: Set[str] = set()
+        self._failed: Set[str] = set()
+        # Chunks of an object not yet upserted, and its manifest update
+        self._pending_chunks: Dict[str, int] = {}
+        self._updates: Dict[str, ManifestUpdate] = {}
+        self._unsaved = 0
+
+        started = False
+        try:
+            source = IngestionSource(uri)
+            if not restart:
+                self._checkpoint = await self._load_checkpoint(uri)
+                self._settled = set(self._checkpoint.done)
+                self._failed = set(self._checkpoint.failed)
+            self.progress.resumed_after = self._checkpoint.watermark
+
+            logger.info(
+                f"Bulk ingestion of {uri} started"
+                + (
+                    f" after {self._checkpoint.watermark}."
+                    if self._checkpoint.watermark
+                    else "."
+                )
+            )
+            started = True
+            await self._run_pipeline(source)
+            self.progress.status = "completed"
+
+        except Exception as e:
+            if isinstance(e, ExceptionGroup):
+                e = e.exceptions[0]  # Raised by a pipeline stage
+            logger.error(f"Bulk ingestion of {uri} failed: {e}")
+            self.progress.status = "failed"
+            self.progress.error = str(e)
+
+        if started:
+            try:
+                await self._save_checkpoint()
+            except Exception as e:
+                logger.error(
+                    f"Failed to save the bulk ingestion checkpoint of {uri}: {e}"
+                )
+
+        self.progress.finished_at = datetime.now(timezone.utc)
+        self._update_throughput()
+        logger.info(f"Bulk ingestion of {uri} finished: {self.progress}")
+        return self.progress
+
+    async def start(
+        self, uri: Optional[str] = None, restart: bool = False
+    ) -> BulkIngestionProgress:
+        """
+        Starts a bulk ingestion run in the background, unless one is already running.
+        """
+        if not self.is_running:
+            self._task = asyncio.create_task(self.run(uri, restart))
+            await asyncio.sleep(0)  # Let the run initialize its progress
+        return self.progress
+
+
+bulk_ingestion_service = BulkIngestionService()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Ingests a GCS bucket (gs://bucket/prefix) or a local directory into the index."
+    )
+    parser.add_argument("source", nargs="?", default=None)
+    parser.add_argument("--restart", action="store_true")
+    args = parser.parse_args()
+
+    progress = asyncio.run(bulk_ingestion_service.run(args.source, args.restart))
+    print(progress.model_dump_json(indent=2))
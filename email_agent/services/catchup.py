@@ -0,0 +1,188 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from email_agent.config import CFG
+from email_agent.models.catchup import CatchUpProgress
+from email_agent.services.gmail import (
+    get_current_history_id,
+    iter_unread_message_ids,
+)
+from email_agent.services.inboxes import InboxContext, inbox_registry
+from email_agent.services.outbox import outbox
+from email_agent.services.processing import (
+    INSTANCE_ID,
+    group_by_thread,
+    process_history,
+    process_thread_messages,
+)
+from email_agent.services.reputation import reputation_service
+from email_agent.utils.logger import logger
+
+
+class CatchUpService:
+    """
+    Answers the unread backlog of an inbox independently of the history, e.g. after the service was down
+    for longer than Gmail keeps the history.
+    """
+
+    def __init__(self, inbox: InboxContext):
+        self.inbox = inbox
+        self.progress = CatchUpProgress()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _update_throughput(self) -> None:
+        elapsed = (
+            datetime.now(timezone.utc) - self.progress.started_at
+        ).total_seconds()
+        done = self.progress.processed + self.progress.failed
+        self.progress.messages_per_s = done / elapsed if elapsed > 0 else 0.0
+
+    async def run(self) -> CatchUpProgress:
+        """
+        Enumerates all unread inbox messages, processes them oldest first through the normal pipeline
+        and finally moves the history cursor to the mailbox state from before the enumeration (under the
+        history lease). If any message failed, the cursor stays and the run is reported as failed.
+        """
+        self.progress = CatchUpProgress(
+            status="running", started_at=datetime.now(timezone.utc)
+        )
+        service = self.inbox.get_gmail_service()
+
+        try:
+            # Messages arriving during the catch-up are picked up from this history ID again
+            history_id = await asyncio.to_thread(
+                get_current_history_id, service, self.inbox.email
+            )
+
+            messages: List[Tuple[str, str]] = []
+            async for page in iter_unread_message_ids(service, self.inbox.email):
+                messages.extend(page)
+            messages.reverse()  # Gmail lists the newest messages first
+
+            self.progress.total = len(messages)
+            logger.info(
+                f"Catching up on {len(messages)} unread messages of {self.inbox.email}."
+            )
+
+            await self._process_all(messages)
+
+            if self.progress.failed:
+                # The cursor must not skip the failed messages, they are retried by the next run
+                raise RuntimeError(f"{self.progress.failed} messages failed.")
+
+            await self._advance_cursor(history_id)
+            self.progress.status = "completed"
+
+        except Exception as e:
+            logger.error(f"Catch-up of {self.inbox.email} failed: {e}")
+            self.progress.status = "failed"
+            self.progress.error = str(e)
+
+        self.progress.finished_at = datetime.now(timezone.utc)
+        self._update_throughput()
+        logger.info(f"Catch-up of {self.inbox.email} finished: {self.progress}")
+        return self.progress
+
+    async def _advance_cursor(self, history_id: str) -> None:
+        """
+        Moves the history cursor past the backlog under the history lease, like the history processing.
+        A history pass of this instance that fell back to the catch-up holds the lease already and releases it.
+        Otherwise the lease is handed on to the history processing, which processes the notifications
+        registered meanwhile before releasing it.
+        """
+        state = self.inbox.state
+        if not await state.acquire_history_lease(INSTANCE_ID):
+            raise RuntimeError(
+                "The history lease is held by another instance, the cursor stays."
+            )
+
+        await state.set_last_history_id(history_id)
+        await state.flush_history_id()
+        if not self.inbox.history_lock.locked():
+            await process_history(history_id, self.inbox)
+
+    async def _process_all(self, messages: List[Tuple[str, str]]) -> None:
+        """
+        Processes the (message ID, thread ID) pairs with bounded concurrency, in the given order
+        and in chunks that are claimed (deduplicated) at once. The messages of one thread within
+        a chunk are answered together.
+        """
+        chunk_size = CFG.catchup_concurrency * 4
+        for start in range(0, len(messages), chunk_size):
+            chunk = dict(messages[start : start + chunk_size])
+            claimed = await self.inbox.state.claim_messages(list(chunk))
+            self.progress.processed += len(chunk) - len(claimed)  # Already answered
+            await self._process_chunk(
+                group_by_thread([i for i in chunk if i in claimed], chunk)
+            )
+
+    async def _process_chunk(self, groups: List[List[str]]) -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+        for msg_ids in groups:
+            queue.put_nowait(msg_ids)
+
+        async def worker() -> None:
+            # The Gmail client is not thread-safe, every worker uses its own
+            service = self.inbox.get_gmail_service()
+            while not queue.empty():
+                msg_ids = queue.get_nowait()
+                try:
+                    await process_thread_messages(msg_ids, service, inbox=self.inbox)
+                    self.progress.processed += len(msg_ids)
+                except Exception as e:
+                    logger.error(f"Catch-up failed to process messages {msg_ids}: {e}")
+                    self.progress.failed += len(msg_ids)
+                    for msg_id in msg_ids:
+                        await self.inbox.state.release_message(msg_id)
+
+                self._update_throughput()
+                done = self.progress.processed + self.progress.failed
+                if done // 10 > (done - len(msg_ids)) // 10:
+                    logger.info(
+                        f"Catch-up progress: {done}/{self.progress.total} "
+                        f"({self.progress.messages_per_s:.2f} messages/s)."
+                    )
+
+        await asyncio.gather(*(worker() for _ in range(CFG.catchup_concurrency)))
+
+    async def start(self) -> CatchUpProgress:
+        """
+        Starts a catch-up run in the background, unless one is already running.
+        """
+        if not self.is_running:
+            self._task = asyncio.create_task(self.run())
+            await asyncio.sleep(0)  # Let the run initialize its progress
+        return self.progress
+
+    async def run_exclusive(self) -> CatchUpProgress:
+        """
+        Runs a catch-up and waits for it, joining the running one instead of starting a second.
+        """
+        await self.start()
+        # The run continues if the caller is cancelled, its claims keep it exclusive
+        return await asyncio.shield(self._task)
+
+
+catch_up_services: Dict[str, CatchUpService] = {
+    inbox.email: CatchUpService(inbox) for inbox in inbox_registry.all()
+}
+
+
+async def main() -> None:
+    # The replies are only stored by the processing, they are delivered by the outbox
+    reputation_service.start()
+    outbox.start()
+    try:
+        await catch_up_services[inbox_registry.primary.email].run()
+        await outbox.drain()
+    finally:
+        await outbox.stop()
+        await reputation_service.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
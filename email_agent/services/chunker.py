@@ -0,0 +1,98 @@
+from typing import List, Tuple
+from langchain_core.documents import Document
+from email_agent.config import CFG
+
+
+tokenizer = None
+
+
+def get_tokenizer():
+    """
+    Returns the tokenizer of the embedding model, without truncation and padding (loaded once).
+    """
+    global tokenizer
+
+    if tokenizer is None:
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_pretrained(CFG.embedding_model_name)
+        tokenizer.no_truncation()
+        tokenizer.no_padding()
+
+    return tokenizer
+
+
+def count_tokens(text: str) -> int:
+    return len(get_tokenizer().encode(text, add_special_tokens=False).ids)
+
+
+def _split_scores(text: str, offsets: List[Tuple[int, int]]) -> List[int]:
+    """
+    Scores the split before every token: 3 at a paragraph break, 2 at a line break, 1 after the end
+    of a sentence, 0 between words and -1 within a word.
+    """
+    scores = [3]
+    for index in range(1, len(offsets)):
+        previous_end, start, end = offsets[index - 1][1], *offsets[index]
+        # Subword tokenizers may keep the leading whitespace within the token
+        token = text[start:end]
+        gap = text[previous_end:start] + token[: len(token) - len(token.lstrip())]
+
+        if gap.count("\n") >= 2:
+            scores.append(3)
+        elif "\n" in gap:
+            scores.append(2)
+        elif gap and text[previous_end - 1 : previous_end] in (".", "!", "?"):
+            scores.append(1)
+        elif gap:
+            scores.append(0)
+        else:
+            scores.append(-1)
+
+    return scores
+
+
+def chunk_text(text: str, metadata: dict) -> List[Document]:
+    """
+    Splits a document into chunks of at most 'chunk_max_tokens' tokens of the embedding model,
+    so that no chunk is truncated when embedded.
+
+    The document is tokenized once, the offset mapping of the tokens locates the split points in the text.
+    Every chunk ends at the best boundary (paragraph, line, sentence, word) within the second half of
+    its window and the next one starts 'chunk_overlap_tokens' before it, at a word boundary.
+    """
+    encoding = get_tokenizer().encode(text, add_special_tokens=False)
+    offsets = encoding.offsets
+    scores = _split_scores(text, offsets)
+    max_tokens, overlap = CFG.chunk_max_tokens, CFG.chunk_overlap_tokens
+
+    chunks: List[Document] = []
+    start = 0
+    while start < len(offsets):
+        end = len(offsets)
+        if end - start > max_tokens:
+            # The latest of the best split points
+            end = max(
+                range(start + max_tokens // 2, start + max_tokens + 1),
+                key=lambda index: (scores[index], index),
+            )
+
+        chunk = text[offsets[start][0] : offsets[end - 1][1]].strip()
+        if chunk:
+            chunks.append(Document(page_content=chunk, metadata=dict(metadata)))
+        if end == len(offsets):
+            break
+
+        start = max(end - overlap, start + 1)
+        while start < end and scores[start] < 0:
+            start += 1
+
+    return chunks
+
+
+def chunk_documents(documents: List[Document]) -> List[Document]:
+    return [
+        chunk
+        for document in documents
+        for chunk in chunk_text(document.page_content, document.metadata)
+    ]
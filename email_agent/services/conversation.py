@@ -0,0 +1,137 @@
+import asyncio
+import time
+import weakref
+from email.utils import formatdate
+from typing import List, Optional
+from google.cloud import firestore
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import PromptTemplate
+from email_agent.config import CFG
+from email_agent.models.conversation import Conversation, ConversationTurn
+from email_agent.models.gmail import EmailMessage
+from email_agent.services.firestore import db
+from email_agent.services.limiter import Priority, estimate_tokens, gemini_limiter
+from email_agent.services.llm import MODELS, model_router
+from email_agent.utils.logger import logger
+
+
+with open(CFG.conversation_summary_prompt, "r", encoding="utf-8") as file:
+    SUMMARY_PROMPT = PromptTemplate(
+        input_variables=["summary", "turns", "max_words"],
+        template=file.read(),
+        template_format="jinja2",
+    )
+
+
+class ConversationStore:
+    """
+    Multi-turn memory of the email threads, stored in one Firestore document per thread.
+
+    Every exchange (the customer's message and the agent's reply) is appended as raw turns. Once a thread
+    has more than 'conversation_max_turns' turns, the oldest ones are folded into a rolling summary,
+    so that loading a conversation takes one read and its prompt size stays bounded.
+    """
+
+    def __init__(self):
+        self.collection = db.collection(CFG.conversation_collection)
+        # Serializes the read-modify-write of a thread within this instance
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = (
+            weakref.WeakValueDictionary()
+        )
+
+    async def load(self, thread_id: str) -> Conversation:
+        """
+        Returns the conversation of a thread (empty if the thread is new).
+        """
+        doc = await self.collection.document(thread_id).get()
+        if not doc.exists:
+            return Conversation(thread_id=thread_id)
+
+        data = doc.to_dict()
+        data.pop("updated_at", None)
+        return Conversation(**data)
+
+    async def _summarize(self, summary: str, turns: List[ConversationTurn]) -> str:
+        """
+        Folds the given turns into the summary using the fast model.
+        """
+        prompt_content = SUMMARY_PROMPT.format_prompt(
+            summary=summary or "(empty)",
+            turns=turns,
+            max_words=CFG.conversation_summary_max_words,
+        ).to_string()
+
+        start = time.perf_counter()
+        response = await gemini_limiter.run(
+            lambda: MODELS["fast"].ainvoke([HumanMessage(content=prompt_content)]),
+            priority=Priority.BACKGROUND,
+            tokens=estimate_tokens(prompt_content),
+        )
+        model_router.record_call(
+            "fast", time.perf_counter() - start, response.usage_metadata
+        )
+        return response.text.strip()
+
+    async def record_exchange(
+        self,
+        received_message: EmailMessage,
+        reply_text: str,
+        conversation_id: Optional[str] = None,
+    ) -> None:
+        """
+        Appends a customer message and the agent's reply to the conversation of their thread
+        (stored under 'conversation_id', the thread ID by default). Recording the same message again is a no-op.
+        """
+        thread_id = conversation_id or received_message.thread_id
+        lock = self._locks.setdefault(thread_id, asyncio.Lock())
+        async with lock:
+            conversation = await self.load(thread_id)
+            if any(
+                turn.message_id == received_message.id for turn in conversation.turns
+            ):
+                return
+
+            max_chars = CFG.conversation_max_turn_chars
+            conversation.turns += [
+                ConversationTurn(
+                    role="customer",
+                    message_id=received_message.id,
+                    date=received_message.headers.date,
+                    text=received_message.body.body_text[:max_chars],
+                ),
+                ConversationTurn(
+                    role="agent",
+                    message_id=received_message.id,
+                    date=formatdate(usegmt=True),
+                    text=reply_text[:max_chars],
+                ),
+            ]
+            conversation.references = (
+                conversation.references + [received_message.headers.message_id]
+            )[-CFG.conversation_max_references :]
+
+            overflow = len(conversation.turns) - CFG.conversation_max_turns
+            if overflow > 0:
+                try:
+                    conversation.summary = await self._summarize(
+                        conversation.summary, conversation.turns[:overflow]
+                    )
+                    conversation.turns = conversation.turns[overflow:]
+                    conversation.summarized_turns += overflow
+                except Exception as e:
+                    # Keep the raw turns, they are summarized with the next exchange
+                    logger.error(f"Failed to summarize conversation {thread_id}: {e}")
+
+            await self.collection.document(thread_id).set(
+                {
+                    **conversation.model_dump(),
+                    "updated_at": firestore.SERVER_TIMESTAMP,
+                }
+            )
+            logger.info(
+                f"Conversation {thread_id} recorded ({conversation.summarized_turns} summarized, "
+                f"{len(conversation.turns)} raw turns)."
+            )
+
+
+conversation_store = ConversationStore()
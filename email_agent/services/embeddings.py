@@ -0,0 +1,123 @@
+import json
+from typing import Dict, List, Literal, Optional, Tuple
+import numpy as np
+from email_agent.config import CFG
+from email_agent.utils.logger import logger
+
+
+# Query embedding is on the critical path of a reply, ingestion is throughput-bound background work
+Workload = Literal["query", "ingestion"]
+
+# e5 embeds at most 512 tokens, special tokens included
+MAX_TOKENS = 512
+
+
+def _model_variant(quantized: bool) -> Tuple[str, str]:
+    """
+    Returns the Hugging Face source and ONNX file of the fp32 or int8 model.
+    """
+    if quantized:
+        return CFG.embedding_quantized_model_source, CFG.embedding_quantized_model_file
+    return CFG.embedding_model_name, CFG.embedding_model_file
+
+
+class EmbeddingModel:
+    """
+    The e5 embedding model in an ONNX Runtime session with the thread counts of a workload: the token
+    embeddings are mean pooled over the attention mask and L2-normalized, as by the 'fastembed' model
+    the index was built with.
+    """
+
+    def __init__(self, source: str, model_file: str, workload: Workload):
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        with open(hf_hub_download(source, "tokenizer_config.json")) as config_file:
+            tokenizer_config = json.load(config_file)
+        pad_token = tokenizer_config.get("pad_token") or "<pad>"
+        if isinstance(pad_token, dict):
+            pad_token = pad_token["content"]
+
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(source, "tokenizer.json"))
+        self.tokenizer.enable_truncation(
+            max_length=min(
+                tokenizer_config.get("model_max_length", MAX_TOKENS), MAX_TOKENS
+            )
+        )
+        self.tokenizer.enable_padding(
+            pad_id=self.tokenizer.token_to_id(pad_token), pad_token=pad_token
+        )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = CFG.embedding_intra_op_threads[workload]
+        options.inter_op_num_threads = CFG.embedding_inter_op_threads[workload]
+        if CFG.embedding_inter_op_threads[workload] > 1:
+            # Independent graph branches only run concurrently in the parallel mode
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.session = ort.InferenceSession(
+            hf_hub_download(source, model_file),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def embed(self, texts: List[str], batch_size: int) -> List[np.ndarray]:
+        embeddings: List[np.ndarray] = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start : start + batch_size])
+            input_ids = np.array(
+                [encoding.ids for encoding in encodings], dtype=np.int64
+            )
+            attention_mask = np.array(
+                [encoding.attention_mask for encoding in encodings], dtype=np.int64
+            )
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                inputs["token_type_ids"] = np.zeros_like(input_ids)
+
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(
+                mask.sum(axis=1), 1e-9
+            )
+            norms = np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            embeddings.extend((pooled / norms).astype(np.float32))
+
+        return embeddings
+
+
+embedding_models: Dict[Tuple[Workload, bool], EmbeddingModel] = {}
+
+
+def get_embedding_model(
+    workload: Workload, quantized: Optional[bool] = None
+) -> EmbeddingModel:
+    """
+    Returns the embedding model of a workload, every workload has its own session (loaded once).
+    """
+    quantized = CFG.embedding_quantized if quantized is None else quantized
+    key = (workload, quantized)
+
+    if key not in embedding_models:
+        source, model_file = _model_variant(quantized)
+        embedding_models[key] = EmbeddingModel(source, model_file, workload)
+        logger.info(
+            f"Embedding model {source} ({model_file}) loaded for {workload} with "
+            f"{CFG.embedding_intra_op_threads[workload]} intra-op and "
+            f"{CFG.embedding_inter_op_threads[workload]} inter-op threads."
+        )
+
+    return embedding_models[key]
+
+
+def embed_texts(
+    texts: List[str], workload: Workload, quantized: Optional[bool] = None
+) -> List[List[float]]:
+    """
+    Embeds texts in batches of the workload's batch size (blocking, to be run in a worker thread).
+    """
+    model = get_embedding_model(workload, quantized)
+    return model.embed(texts, CFG.embedding_batch_size[workload])
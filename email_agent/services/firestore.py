@@ -1,5 +1,9 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from google.cloud import firestore
-from typing import Optional
+from typing import Iterable, Optional, Set
 from fastapi import HTTPException
 from email_agent.utils.logger import logger
 from email_agent.config import CFG
@@ -13,26 +17,71 @@ except Exception as e:
     raise HTTPException(status_code=500, detail=msg)
 
 
+class HistoryStateCache:
+    """
+    In-memory copy of the Gmail history cursor.
+
+    While this instance holds the history lease it is the only writer of the cursor, so the cached
+    value is authoritative and served without a Firestore read. Advances of the cursor are then
+    coalesced into a single write after a bounded delay.
+    """
+
+    def __init__(self):
+        self.cursor: Optional[str] = None
+        self.flushed_cursor: Optional[str] = None
+        self.lease_expires_at = 0.0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_authoritative(self) -> bool:
+        # Keep a safety margin before the lease expiry, another instance may take over afterwards
+        margin = CFG.history_lease_ttl_s * 0.1
+        return self.cursor is not None and time.time() < self.lease_expires_at - margin
+
+    def observe(self, history_id: Optional[str]) -> None:
+        """
+        Merges a cursor value read from Firestore, the cursor never moves backwards.
+        """
+        if history_id is not None and (
+            self.cursor is None or int(history_id) > int(self.cursor)
+        ):
+            self.cursor = str(history_id)
+            self.flushed_cursor = self.cursor
+
+
 class FirestoreService:
     """
     Manages all persistent state interaction with Google Firestore.
+    Every inbox has its own instance, with its own state document and message claims.
     """
 
-    def __init__(self):
+    def __init__(
+        self, state_doc_id: str = CFG.gmail_state_doc_id, key_prefix: str = ""
+    ):
         self.db = db
+        self.state_doc_id = state_doc_id
+        self.deduplicator = MessageDeduplicator(key_prefix)
+        self.state_cache = HistoryStateCache()
+
+    def _state_doc_ref(self):
+        return self.db.collection(CFG.firestore_config_collection).document(
+            self.state_doc_id
+        )
 
     async def get_last_history_id(self) -> Optional[str]:
         """
         Retrieves the last successfully processed Gmail history ID.
+        Served from memory while this instance holds the history lease.
         """
+        if self.state_cache.is_authoritative:
+            return self.state_cache.cursor
+
         try:
-            doc_ref = self.db.collection(CFG.firestore_config_collection).document(
-                CFG.gmail_state_doc_id
-            )
-            doc = await doc_ref.get()
+            doc = await self._state_doc_ref().get()
 
             if doc.exists:
                 data = doc.to_dict()
+                self.state_cache.observe(data.get("last_processed_history_id"))
                 return data.get("last_processed_history_id")
             else:
                 return None
@@ -41,52 +90,304 @@ class FirestoreService:
             logger.error(f"Error fetching history ID: {e}")
             return None
 
-    async def set_last_history_id(self, history_id: str) -> None:
+    async def set_last_history_id(self, history_id: str) -> bool:
         """
-        Saves the newest Gmail history ID for the next check.
+        Saves the newest Gmail history ID for the next check, returns whether the cursor advanced.
+
+        IDs that do not advance the cursor are not written at all. While this instance holds the
+        history lease, rapid successive advances are coalesced into one write after a bounded delay.
         """
-        try:
-            doc_ref = self.db.collection(CFG.firestore_config_collection).document(
-                CFG.gmail_state_doc_id
-            )
-            await doc_ref.set(
+        cache = self.state_cache
+        if cache.cursor is not None and int(cache.cursor) >= int(history_id):
+            return False
+
+        if cache.is_authoritative:
+            cache.cursor = str(history_id)
+            if cache.flush_task is None or cache.flush_task.done():
+                cache.flush_task = asyncio.create_task(self._delayed_flush())
+            return True
+
+        return await self._write_history_id(history_id)
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(CFG.history_flush_delay_s)
+        await self.flush_history_id()
+
+    async def flush_history_id(self) -> None:
+        """
+        Writes the cached cursor to Firestore if it advanced since the last write.
+        """
+        cache = self.state_cache
+        if (
+            cache.flush_task is not None
+            and cache.flush_task is not asyncio.current_task()
+        ):
+            cache.flush_task.cancel()
+        cache.flush_task = None
+
+        if cache.cursor is not None and cache.cursor != cache.flushed_cursor:
+            await self._write_history_id(cache.cursor)
+
+    async def _write_history_id(self, history_id: str) -> bool:
+        """
+        Compare-and-set update of the stored cursor that never moves it backwards.
+        """
+
+        @firestore.async_transactional
+        async def update_in_transaction(transaction: firestore.AsyncTransaction):
+            doc = await self._state_doc_ref().get(transaction=transaction)
+            current = (doc.to_dict() or {}) if doc.exists else {}
+            current_id = current.get("last_processed_history_id")
+
+            if current_id is not None and int(current_id) >= int(history_id):
+                return False
+
+            transaction.set(
+                self._state_doc_ref(),
                 {
-                    "last_processed_history_id": history_id,
+                    "last_processed_history_id": str(history_id),
                     "timestamp": firestore.SERVER_TIMESTAMP,
-                }
+                },
+                merge=True,
             )
+            return True
+
+        try:
+            advanced = await update_in_transaction(self.db.transaction())
+            self.state_cache.observe(history_id)
+            return advanced
 
         except Exception as e:
             msg = f"Error saving history ID {history_id}: {e}"
             logger.error(msg)
             raise HTTPException(status_code=500, detail=msg)
 
+    async def initialize_history_id(self, history_id: str) -> bool:
+        """
+        Stores the first cursor of the inbox when its watch is set up, returns False if one exists already
+        (an existing cursor is only advanced by the history processing, under the lease).
+        """
+
+        @firestore.async_transactional
+        async def update_in_transaction(transaction: firestore.AsyncTransaction):
+            doc = await self._state_doc_ref().get(transaction=transaction)
+            current = (doc.to_dict() or {}) if doc.exists else {}
+            if current.get("last_processed_history_id") is not None:
+                return False
+
+            transaction.set(
+                self._state_doc_ref(),
+                {
+                    "last_processed_history_id": str(history_id),
+                    "timestamp": firestore.SERVER_TIMESTAMP,
+                },
+                merge=True,
+            )
+            return True
+
+        initialized = await update_in_transaction(self.db.transaction())
+        if initialized:
+            self.state_cache.observe(history_id)
+        return initialized
+
+    async def register_pending_history_id(self, history_id: str) -> None:
+        """
+        Records the newest notified Gmail history ID, to be processed by the current lease owner.
+        """
+
+        @firestore.async_transactional
+        async def update_in_transaction(transaction: firestore.AsyncTransaction):
+            doc = await self._state_doc_ref().get(transaction=transaction)
+            pending_id = (
+                (doc.to_dict() or {}).get("pending_history_id") if doc.exists else None
+            )
+
+            if pending_id is None or int(pending_id) < int(history_id):
+                transaction.set(
+                    self._state_doc_ref(),
+                    {"pending_history_id": str(history_id)},
+                    merge=True,
+                )
+
+        await update_in_transaction(self.db.transaction())
+
+    async def acquire_history_lease(self, owner: str) -> bool:
+        """
+        Tries to acquire (or renew) the lease that allows one instance at a time to process the inbox history.
+        """
+
+        @firestore.async_transactional
+        async def update_in_transaction(transaction: firestore.AsyncTransaction):
+            doc = await self._state_doc_ref().get(transaction=transaction)
+            state = (doc.to_dict() or {}) if doc.exists else {}
+
+            lease_owner = state.get("lease_owner")
+            if (
+                lease_owner not in (None, owner)
+                and state.get("lease_expires_at", 0) > time.time()
+            ):
+                return False
+
+            transaction.set(
+                self._state_doc_ref(),
+                {"lease_owner": owner, "lease_expires_at": lease_expires_at},
+                merge=True,
+            )
+            self.state_cache.observe(state.get("last_processed_history_id"))
+            return True
+
+        lease_expires_at = time.time() + CFG.history_lease_ttl_s
+        acquired = await update_in_transaction(self.db.transaction())
+        # A lost lease stops serving the cursor from memory right away
+        self.state_cache.lease_expires_at = lease_expires_at if acquired else 0.0
+        return acquired
+
+    async def release_history_lease(self, owner: str, force: bool = False) -> bool:
+        """
+        Releases the history lease, unless a history ID newer than the cursor was registered in the meantime
+        (and the release is not forced). Returns whether the lease was released (False means the owner must keep processing).
+        """
+        # The release compares against the stored cursor, which must be up to date first
+        await self.flush_history_id()
+
+        @firestore.async_transactional
+        async def update_in_transaction(transaction: firestore.AsyncTransaction):
+            doc = await self._state_doc_ref().get(transaction=transaction)
+            state = (doc.to_dict() or {}) if doc.exists else {}
+
+            if state.get("lease_owner") != owner:
+                return True
+
+            pending_id = state.get("pending_history_id")
+            last_id = state.get("last_processed_history_id")
+            if (
+                not force
+                and pending_id is not None
+                and last_id is not None
+                and int(pending_id) > int(last_id)
+            ):
+                return False
+
+            transaction.set(
+                self._state_doc_ref(),
+                {"lease_owner": None, "lease_expires_at": 0},
+                merge=True,
+            )
+            return True
+
+        released = await update_in_transaction(self.db.transaction())
+        if released:
+            self.state_cache.lease_expires_at = 0.0
+        return released
+
     async def check_and_set_processed_message(self, message_id: str) -> bool:
         """
         Checks if a message ID has been processed. If not, sets it as processed
         and returns True. If it has been processed, returns False.
         """
-        doc_ref = self.db.collection("processed_messages").document(message_id)
+        return message_id in await self.deduplicator.claim_messages([message_id])
+
+    async def claim_messages(self, message_ids: Iterable[str]) -> Set[str]:
+        """
+        Marks a burst of message IDs as processed and returns the ones that were not processed before.
+        """
+        return await self.deduplicator.claim_messages(message_ids)
+
+    async def release_message(self, message_id: str) -> None:
+        """
+        Removes the processed mark of a message whose processing failed, so that it is retried.
+        """
+        await self.deduplicator.release_message(message_id)
+
+
+class MessageDeduplicator:
+    """
+    Exactly-once claims of message IDs, backed by a Firestore collection with an in-memory LRU front.
+
+    IDs claimed recently by this instance are rejected without a Firestore round-trip, the remaining
+    ones are checked and claimed in one batched transaction per burst. Claim documents carry an
+    'expires_at' field, deleted by the collection's Firestore TTL policy.
+    """
+
+    def __init__(self, key_prefix: str = ""):
+        self.db = db
+        # Scopes the claim documents of an inbox, message IDs are only unique per mailbox
+        self.key_prefix = key_prefix
+        self._recent: OrderedDict[str, None] = OrderedDict()
+
+    def _doc_id(self, message_id: str) -> str:
+        return f"{self.key_prefix}{message_id}"
+
+    def _remember(self, message_id: str) -> None:
+        self._recent[message_id] = None
+        self._recent.move_to_end(message_id)
+        while len(self._recent) > CFG.dedup_cache_size:
+            self._recent.popitem(last=False)
+
+    async def claim_messages(self, message_ids: Iterable[str]) -> Set[str]:
+        """
+        Claims the given message IDs and returns the ones that were not claimed before.
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        misses = [msg_id for msg_id in message_ids if msg_id not in self._recent]
+        if len(misses) < len(message_ids):
+            logger.info(
+                f"{len(message_ids) - len(misses)} message IDs rejected by the dedup cache."
+            )
+        if not misses:
+            return set()
+
+        collection = self.db.collection(CFG.dedup_collection)
+        doc_refs = {
+            msg_id: collection.document(self._doc_id(msg_id)) for msg_id in misses
+        }
+        expires_at = datetime.now(timezone.utc) + timedelta(days=CFG.dedup_ttl_days)
 
         @firestore.async_transactional
-        async def update_in_transaction(
-            transaction: firestore.AsyncTransaction, operation_data
-        ):
-            doc = await operation_data.get(transaction=transaction)
-            if doc.exists:
-                return False
+        async def claim_in_transaction(transaction: firestore.AsyncTransaction):
+            existing = set()
+            async for doc in await transaction.get_all(list(doc_refs.values())):
+                if doc.exists:
+                    existing.add(doc.id)
 
-            transaction.set(doc_ref, {"timestamp": firestore.SERVER_TIMESTAMP})
-            return True
+            claimed = set()
+            for msg_id, doc_ref in doc_refs.items():
+                if doc_ref.id in existing:
+                    continue
+                transaction.set(
+                    doc_ref,
+                    {"timestamp": firestore.SERVER_TIMESTAMP, "expires_at": expires_at},
+                )
+                claimed.add(msg_id)
+            return claimed
 
         try:
-            transaction = self.db.transaction()
-            return await update_in_transaction(transaction, doc_ref)
+            claimed = await claim_in_transaction(self.db.transaction())
         except Exception as e:
-            logger.error(f"Transaction failed for message {message_id}: {e}")
+            logger.error(f"Transaction failed for messages {misses}: {e}")
             raise HTTPException(
                 status_code=500, detail=f"Failed to process message check: {e}"
             )
 
+        # Only own claims are cached, those of other instances may still be released on a failure
+        for msg_id in claimed:
+            self._remember(msg_id)
+
+        duplicates = len(misses) - len(claimed)
+        if duplicates:
+            logger.warning(f"Skipping {duplicates} already processed message IDs.")
+        return claimed
+
+    async def release_message(self, message_id: str) -> None:
+        """
+        Removes the claim of a message ID.
+        """
+        self._recent.pop(message_id, None)
+        await (
+            self.db.collection(CFG.dedup_collection)
+            .document(self._doc_id(message_id))
+            .delete()
+        )
+
 
 firestore_service = FirestoreService()
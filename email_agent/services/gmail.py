@@ -1,3 +1,4 @@
+import asyncio
 import json
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
@@ -6,14 +7,19 @@ from email_agent.models.gmail import (
     EmailMessage,
     EmailBody,
     EmailAttachment,
+    HistoryPage,
 )
 import base64
 import re
 from email_agent.utils.logger import logger
 from email_agent.config import CFG
 from email.mime.text import MIMEText
+from email.utils import parsedate_to_datetime
 from googleapiclient.errors import HttpError
-from typing import Optional
+from pydantic import SecretStr
+from email_agent.utils.spool import AttachmentBudgetError, AttachmentContent
+from email_agent.services.body_normalizer import decode_text_part, normalize_body
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 
 # Scopes needed for reading and sending
@@ -28,14 +34,16 @@ SCOPES = [
 #######################
 
 
-def get_gmail_service() -> build:
+def get_gmail_service(
+    credentials_json: SecretStr = CFG.gmail_service_acc_json,
+) -> build:
     """
     Authorizes and builds the Gmail API service client by loading credentials
-    from a mounted Secret Manager environment variable.
+    from a mounted Secret Manager environment variable (those of the primary inbox by default).
     """
     try:
         # Load credentials
-        info = json.loads(CFG.gmail_service_acc_json.get_secret_value())
+        info = json.loads(credentials_json.get_secret_value())
         credentials = Credentials.from_authorized_user_info(
             info=info,
             scopes=SCOPES,
@@ -73,6 +81,196 @@ def renew_watch_instruction(service: build, user_id: str = CFG.user_email):
 #####################
 
 
+class HistoryExpiredError(Exception):
+    """Raised when the start history ID is older than the history kept by Gmail."""
+
+
+async def iter_history_pages(
+    service: build, start_history_id: str, user_id: str = CFG.user_email
+) -> AsyncIterator[HistoryPage]:
+    """
+    Streams the newly added message IDs since the given history ID page by page, following 'nextPageToken'.
+
+    Each page carries the history ID up to which it is complete (the newest record of the page,
+    or the current mailbox history ID for the last page), to be used as a checkpoint.
+    """
+    page_token = None
+    while True:
+        request = (
+            service.users()
+            .history()
+            .list(
+                userId=user_id,
+                startHistoryId=start_history_id,
+                labelId="UNREAD",
+                historyTypes=["messageAdded"],
+                maxResults=CFG.history_page_size,
+                pageToken=page_token,
+            )
+        )
+        try:
+            response = await asyncio.to_thread(request.execute)
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpiredError(
+                    f"History ID {start_history_id} is no longer available."
+                ) from e
+            raise
+
+        records = response.get("history", [])
+        added_messages = [
+            msg_data["message"]
+            for record in records
+            for msg_data in record.get("messagesAdded", [])
+        ]
+        # Deduplicate while keeping the history order
+        message_ids = list(dict.fromkeys(message["id"] for message in added_messages))
+        thread_ids = {
+            message["id"]: message.get("threadId", message["id"])
+            for message in added_messages
+        }
+
+        page_token = response.get("nextPageToken")
+        if page_token:
+            checkpoint = max(
+                (record["id"] for record in records),
+                key=int,
+                default=start_history_id,
+            )
+        else:
+            checkpoint = response["historyId"]
+
+        yield HistoryPage(
+            message_ids=message_ids,
+            thread_ids=thread_ids,
+            checkpoint_history_id=checkpoint,
+        )
+
+        if not page_token:
+            break
+
+
+def get_current_history_id(service: build, user_id: str = CFG.user_email) -> str:
+    """
+    Returns the current history ID of the mailbox.
+    """
+    profile = service.users().getProfile(userId=user_id).execute()
+    return profile["historyId"]
+
+
+async def iter_unread_message_ids(
+    service: build, user_id: str = CFG.user_email
+) -> AsyncIterator[List[Tuple[str, str]]]:
+    """
+    Streams the (message ID, thread ID) pairs of all unread inbox messages page by page
+    (newest first, as returned by Gmail).
+    """
+    page_token = None
+    while True:
+        request = (
+            service.users()
+            .messages()
+            .list(
+                userId=user_id,
+                labelIds=["INBOX"],
+                q=CFG.catchup_query,
+                maxResults=CFG.catchup_page_size,
+                pageToken=page_token,
+            )
+        )
+        response = await asyncio.to_thread(request.execute)
+
+        yield [
+            (message["id"], message.get("threadId", message["id"]))
+            for message in response.get("messages", [])
+        ]
+
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+
+# Headers requested by the metadata-only fetch, i.e. the ones parsed into 'EmailHeaders',
+# every header referenced by the bulk / auto-generated mail rules and the content type (admission lane)
+METADATA_HEADERS = sorted(
+    {"Date", "Subject", "From", "Message-ID", "Content-Type"}
+    | set(CFG.bulk_filter_presence_headers)
+    | set(CFG.bulk_filter_header_values)
+)
+BULK_SENDER_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE) for pattern in CFG.bulk_filter_sender_patterns
+]
+
+
+def extract_sender_email(sender: str) -> str:
+    """
+    Extracts the bare email address from a 'From' header value (e.g. 'Name <address>').
+    """
+    email_match = re.search(r"<(.*?)>", sender or "")
+    return email_match.group(1).strip() if email_match else (sender or "").strip()
+
+
+def _get_message_metadata(service: build, msg_id: str, user_id: str) -> dict:
+    """
+    Fetches only the headers relevant for filtering, without the body or attachment parts.
+    """
+    return (
+        service.users()
+        .messages()
+        .get(
+            userId=user_id,
+            id=msg_id,
+            format="metadata",
+            metadataHeaders=METADATA_HEADERS,
+            fields="id,threadId,labelIds,sizeEstimate,payload/headers",
+        )
+        .execute()
+    )
+
+
+def get_bulk_rejection_reason(headers: list, sender_email: str) -> Optional[str]:
+    """
+    Applies the configured rule set to the message headers and returns the reason why the message
+    looks like bulk or auto-generated mail (mailing lists, auto-replies, bounces), or None if it passes.
+    """
+    header_values: Dict[str, str] = {
+        header["name"].lower(): header["value"] for header in headers
+    }
+
+    for name in CFG.bulk_filter_presence_headers:
+        if name.lower() in header_values:
+            return f"header '{name}' present"
+
+    for name, prefixes in CFG.bulk_filter_header_values.items():
+        value = header_values.get(name.lower(), "").strip().lower()
+        if value and any(value.startswith(prefix.lower()) for prefix in prefixes):
+            return f"header '{name}: {value}'"
+
+    for pattern in BULK_SENDER_PATTERNS:
+        if pattern.search(sender_email):
+            return f"sender '{sender_email}' matches '{pattern.pattern}'"
+
+    return None
+
+
+def _mark_as_auto_generated(service: build, msg_id: str, user_id: str):
+    """
+    Labels a rejected bulk / auto-generated message and marks it as read without answering it.
+    """
+    label_id = get_or_create_custom_label_id(
+        service,
+        label_name=CFG.bulk_filter_label,
+        background_color="#999999",
+        text_color="#ffffff",
+        user_id=user_id,
+    )
+    service.users().messages().modify(
+        userId=user_id,
+        id=msg_id,
+        body={"removeLabelIds": ["UNREAD"], "addLabelIds": [label_id]},
+    ).execute()
+
+
 def _parse_headers(headers) -> EmailHeaders:
     """
     Iterate over email headers and assign the required ones to an 'EmailHeaders' instance.
@@ -110,7 +308,46 @@ def _parse_headers(headers) -> EmailHeaders:
     return EmailHeaders(**header_data)
 
 
-def _parse_body_parts(message, service: build) -> EmailBody:
+def _download_attachment(
+    service: build, user_id: str, msg_id: str, part: dict, max_bytes: int
+) -> EmailAttachment:
+    """
+    Downloads an attachment into a spooled 'AttachmentContent', unless it exceeds the remaining
+    per-message byte cap ('max_bytes') or the per-process cap.
+    """
+    filename = part["filename"]
+    size = part["body"].get("size", 0)
+    attachment = EmailAttachment(
+        filename=filename, mime_type=part.get("mimeType"), size=size
+    )
+
+    if size > max_bytes:
+        logger.warning(
+            f"Skipping attachment {filename} ({size} bytes), the message exceeds its byte cap."
+        )
+        attachment.skipped_reason = "exceeds the size limit per email"
+        return attachment
+
+    # Attachments require a separate API call to get the data
+    logger.info(f"Downloading attachment: {filename}...")
+    response = (
+        service.users()
+        .messages()
+        .attachments()
+        .get(userId=user_id, messageId=msg_id, id=part["body"]["attachmentId"])
+        .execute()
+    )
+
+    try:
+        attachment.content = AttachmentContent.from_base64(response.pop("data"), size)
+    except AttachmentBudgetError as e:
+        logger.warning(f"Skipping attachment {filename}: {e}")
+        attachment.skipped_reason = "too many attachments are being processed"
+
+    return attachment
+
+
+def _parse_body_parts(message, service: build, user_id: str) -> EmailBody:
     """
     Recursively parses content parts of the email message.
     """
@@ -118,8 +355,11 @@ def _parse_body_parts(message, service: build) -> EmailBody:
         "body_text": "",
         "attachments": [],
     }
+    html_parts: List[str] = []
+    message_bytes = 0
 
     def parse_parts(parts):
+        nonlocal message_bytes
         for part in parts:
             mime_type = part.get("mimeType")
             body = part.get("body", {})
@@ -136,41 +376,29 @@ def _parse_body_parts(message, service: build) -> EmailBody:
                 "",
             )
 
-            # Handle text body with text/plain type
+            # Handle text body with text/plain type (or text/html, used if there is no plain part)
             if mime_type == "text/plain" and "attachment" not in content_disposition:
                 if data:
-                    decoded_text = base64.urlsafe_b64decode(data).decode("utf-8")
-                    email_data["body_text"] += decoded_text
+                    email_data["body_text"] += decode_text_part(data, part_headers)
+            elif mime_type == "text/html" and "attachment" not in content_disposition:
+                if data:
+                    html_parts.append(decode_text_part(data, part_headers))
 
             # Handle attachments (filename + attachmentId)
             filename = part.get("filename")
             if filename:
                 if "attachmentId" in body:
-                    att_id = body["attachmentId"]
-
-                    # Attachments require a separate API call to get the data
-                    logger.info(f"Downloading attachment: {filename}...")
-                    attachment = (
-                        service.users()
-                        .messages()
-                        .attachments()
-                        .get(userId=CFG.user_email, messageId=message["id"], id=att_id)
-                        .execute()
-                    )
-
-                    file_data_b64 = attachment["data"]
-                    raw_file_bytes = base64.urlsafe_b64decode(file_data_b64)
-
                     email_data["attachments"].append(
-                        EmailAttachment.model_validate(
-                            {
-                                "filename": filename,
-                                "mime_type": mime_type,
-                                "size": body.get("size"),
-                                "data": raw_file_bytes,
-                            }
+                        _download_attachment(
+                            service,
+                            user_id,
+                            message["id"],
+                            part,
+                            CFG.attachment_max_message_bytes - message_bytes,
                         )
                     )
+                    if email_data["attachments"][-1].content is not None:
+                        message_bytes += body.get("size", 0)
 
             # If the part has subparts, recursively add those
             if "parts" in part:
@@ -182,43 +410,79 @@ def _parse_body_parts(message, service: build) -> EmailBody:
     else:
         parse_parts([payload])
 
+    # Strip the quoted history and signature, the conversation memory keeps the earlier messages
+    email_data["body_text"] = normalize_body(
+        email_data["body_text"], "\n".join(html_parts)
+    )
     return EmailBody(**email_data)
 
 
-def read_messages(message_ids: set[str], service: build):
+def screen_messages(
+    message_ids: set[str], service: build, user_id: str = CFG.user_email
+) -> List[dict]:
     """
-    Given a set of message IDs, fetches and processes each email message.
+    Fetches every message in the 'metadata' format (headers only) and rejects self-sent and
+    bulk / auto-generated mail without downloading the body or the attachments.
+    Returns the metadata of the messages to be answered.
     """
-    processed_messages = []
+    accepted = []
 
     for msg_id in message_ids:
         try:
-            message = (
-                service.users()
-                .messages()
-                .get(userId=CFG.user_email, id=msg_id, format="full")
-                .execute()
-            )
-
-            header_data = _parse_headers(message["payload"]["headers"])
-
-            sender_info = header_data.sender
-            email_match = re.search(r"<(.*?)>", sender_info)
-            sender_email = (
-                email_match.group(1).strip() if email_match else sender_info.strip()
+            metadata = _get_message_metadata(service, msg_id, user_id)
+            headers = metadata.get("payload", {}).get("headers", [])
+            sender_email = extract_sender_email(
+                next((h["value"] for h in headers if h["name"] == "From"), "")
             )
 
             # Skip self-sent messages to avoid loops
-            if sender_email.lower() == CFG.user_email:
+            if sender_email.lower() == user_id.lower():
                 logger.info(f"Skipping self-sent message {msg_id}.")
                 service.users().messages().modify(
-                    userId=CFG.user_email,
+                    userId=user_id,
                     id=msg_id,
                     body={"removeLabelIds": ["UNREAD"]},
                 ).execute()
                 continue
 
-            email_data = _parse_body_parts(message, service)
+            # Skip mailing lists, auto-replies and bounces (also prevents reply loops with other autoresponders)
+            if CFG.bulk_filter_enabled:
+                rejection_reason = get_bulk_rejection_reason(headers, sender_email)
+                if rejection_reason:
+                    logger.info(
+                        f"Skipping bulk/auto-generated message {msg_id}: {rejection_reason}."
+                    )
+                    _mark_as_auto_generated(service, msg_id, user_id)
+                    continue
+
+            accepted.append(metadata)
+
+        except Exception as e:
+            logger.error(f"Failed to process message {msg_id}: {e}")
+            raise
+
+    return accepted
+
+
+def fetch_messages(
+    message_ids: List[str], service: build, user_id: str = CFG.user_email
+) -> List[EmailMessage]:
+    """
+    Fetches and parses the full contents (including the attachments) of the given messages.
+    """
+    processed_messages = []
+
+    for msg_id in message_ids:
+        try:
+            message = (
+                service.users()
+                .messages()
+                .get(userId=user_id, id=msg_id, format="full")
+                .execute()
+            )
+
+            header_data = _parse_headers(message["payload"]["headers"])
+            email_data = _parse_body_parts(message, service, user_id)
             email_message = EmailMessage(
                 id=msg_id,
                 thread_id=message.get("threadId", ""),
@@ -243,6 +507,37 @@ def read_messages(message_ids: set[str], service: build):
     return processed_messages
 
 
+def _get_sent_at(message: EmailMessage) -> float:
+    try:
+        return parsedate_to_datetime(message.headers.date).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def merge_thread_messages(messages: List[EmailMessage]) -> EmailMessage:
+    """
+    Merges new messages of one thread into a single message, to be answered with one reply:
+    the bodies (and attachments) are combined in the order the messages were sent, the IDs
+    and headers are those of the latest message, which the reply responds to.
+    """
+    messages = sorted(messages, key=_get_sent_at)
+    if len(messages) == 1:
+        return messages[0]
+
+    body_text = "\n\n".join(
+        f"--- Message sent on {message.headers.date} ---\n{message.body.body_text}"
+        for message in messages
+    )
+    attachments = [
+        attachment
+        for message in messages
+        for attachment in message.body.attachments or []
+    ]
+    return messages[-1].model_copy(
+        update={"body": EmailBody(body_text=body_text, attachments=attachments)}
+    )
+
+
 #####################
 ### Email Sending ###
 #####################
@@ -291,14 +586,19 @@ def get_or_create_custom_label_id(
         raise
 
 
-def send_thread_reply(
-    service: build,
+# Custom labels attached to processed threads: name, background color and text color
+ANSWERED_LABEL = ("Answered by Agent", "#16a766", "#ffffff")
+IRRELEVANT_LABEL = ("Irrelevant", "#cc3a21", "#ffffff")
+
+
+def build_reply_message(
     received_message: EmailMessage,
     body_text: str,
-    user_id: str = CFG.user_email,
-):
+    references: Optional[List[str]] = None,
+) -> dict:
     """
-    Sends a reply message within the original email thread and marks the thread as read.
+    Creates the Gmail API body of a reply message within the original email thread.
+    'references' are the Message-IDs of the earlier messages of the conversation, oldest first.
     """
     message = MIMEText(body_text)
 
@@ -321,62 +621,27 @@ def send_thread_reply(
         message["subject"] = original_subject
 
     message["In-Reply-To"] = received_message.headers.message_id
-    message["References"] = (
-        received_message.headers.message_id
-    )  # Note: For longer threads in multi-turn conversations, this would need to be continuously appended
+    message["References"] = " ".join(
+        dict.fromkeys([*(references or []), received_message.headers.message_id])
+    )
 
     raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    message_body = {"raw": raw_message, "threadId": thread_id}
+    return {"raw": raw_message, "threadId": thread_id}
 
-    try:
-        sent_message = (
-            service.users().messages().send(userId=user_id, body=message_body).execute()
-        )
-
-        # Mark the original thread as read and label it
-        answered_label_id = get_or_create_custom_label_id(
-            service,
-            label_name="Answered by Agent",
-            background_color="#16a766",
-            text_color="#ffffff",
-            user_id=user_id,
-        )
-        service.users().threads().modify(
-            userId=user_id,
-            id=thread_id,
-            body={"removeLabelIds": ["UNREAD"], "addLabelIds": [answered_label_id]},
-        ).execute()
-
-        logger.info(f"Reply sent successfully in thread: {thread_id}")
-        return sent_message
 
-    except HttpError as error:
-        logger.error(f"An error occurred sending reply: {error}")
-        raise
-
-
-def mark_as_irrelevant(
-    service: build,
-    received_message: EmailMessage,
-    user_id: str = CFG.user_email,
-):
+def execute_batch(service: build, requests: Dict[str, object]) -> Dict[str, object]:
     """
-    Marks an email thread that was determined as irrelevant with a corresponding label.
+    Executes Gmail API requests (keyed by an ID) in a single batch HTTP request.
+    Returns the response or the raised exception of each request.
     """
-    thread_id = received_message.thread_id
+    results: Dict[str, object] = {}
 
-    irrelevant_label_id = get_or_create_custom_label_id(
-        service,
-        label_name="Irrelevant",
-        background_color="#cc3a21",
-        text_color="#ffffff",
-        user_id=user_id,
-    )
+    def callback(request_id, response, exception):
+        results[request_id] = exception if exception is not None else response
 
-    service.users().threads().modify(
-        userId=user_id,
-        id=thread_id,
-        body={"removeLabelIds": ["UNREAD"], "addLabelIds": [irrelevant_label_id]},
-    ).execute()
+    batch = service.new_batch_http_request(callback=callback)
+    for request_id, request in requests.items():
+        batch.add(request, request_id=request_id)
+    batch.execute()
 
-    logger.info(f"Message marked as read and labeled irrelevant: {thread_id}")
+    return results
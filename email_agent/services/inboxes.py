@@ -0,0 +1,87 @@
+import asyncio
+from typing import Dict, List, Optional, Set
+from googleapiclient.discovery import build
+from email_agent.config import CFG
+from email_agent.models.inbox import Inbox
+from email_agent.services.firestore import FirestoreService, firestore_service
+from email_agent.services.gmail import (
+    ANSWERED_LABEL,
+    IRRELEVANT_LABEL,
+    get_gmail_service,
+)
+
+
+class InboxContext:
+    """
+    Runtime state of one answered inbox: its persistent state (history cursor, lease and message claims)
+    and the single-flight guard of its history processing.
+    """
+
+    def __init__(self, inbox: Inbox, state: FirestoreService):
+        self.inbox = inbox
+        self.state = state
+        # Single-flight guard for history processing within this instance, callers arriving
+        # while it is held request a re-run from the current holder instead of waiting
+        self.history_lock = asyncio.Lock()
+        self.rerun_requested = asyncio.Event()
+        # Messages that failed in the last history pass, skipped once the notification is dead-lettered
+        self.failed_message_ids: Set[str] = set()
+
+    @property
+    def email(self) -> str:
+        return self.inbox.email
+
+    def get_gmail_service(self) -> build:
+        """
+        Builds a Gmail API client with the inbox's credentials (the client is not thread-safe).
+        """
+        return get_gmail_service(self.inbox.credentials_json)
+
+
+class InboxRegistry:
+    """
+    The inboxes answered by this service: the primary one from 'user_email' and the 'extra_inboxes'.
+    """
+
+    def __init__(self):
+        self.primary = InboxContext(
+            Inbox(
+                email=CFG.user_email,
+                credentials_json=CFG.gmail_service_acc_json,
+                state_doc_id=CFG.gmail_state_doc_id,
+                answered_label=ANSWERED_LABEL[0],
+                irrelevant_label=IRRELEVANT_LABEL[0],
+            ),
+            firestore_service,
+        )
+        self._inboxes: Dict[str, InboxContext] = {self.primary.email: self.primary}
+
+        for inbox in CFG.extra_inboxes:
+            namespace = inbox.namespace or Inbox.namespace_of(inbox.email)
+            inbox = inbox.model_copy(
+                update={
+                    "namespace": namespace,
+                    "state_doc_id": inbox.state_doc_id
+                    or f"{CFG.gmail_state_doc_id}_{namespace}",
+                }
+            )
+            if inbox.email in self._inboxes:
+                raise ValueError(f"Inbox {inbox.email} is configured more than once.")
+
+            self._inboxes[inbox.email] = InboxContext(
+                inbox, FirestoreService(inbox.state_doc_id, key_prefix=f"{namespace}:")
+            )
+
+    def get(self, email: Optional[str] = None) -> Optional[InboxContext]:
+        """
+        Returns the inbox of an address (the primary inbox if none is given), None if it is not answered.
+        """
+        if email is None:
+            return self.primary
+        return self._inboxes.get(email.lower())
+
+    def all(self) -> List[InboxContext]:
+        return list(self._inboxes.values())
+
+
+inbox_registry = InboxRegistry()
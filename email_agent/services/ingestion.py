@@ -1,97 +1,355 @@
-from typing import List
+import asyncio
+import codecs
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set
 from email_agent.config import CFG
 from email_agent.utils.logger import logger
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from email_agent.services.limiter import Priority, vector_search_limiter
+from email_agent.models.ingest import IngestionManifest
+from email_agent.services.manifest import (
+    ManifestConflictError,
+    ManifestUpdate,
+    chunk_datapoint_id,
+    chunk_store,
+    is_newer_generation,
+    manifest_store,
+)
+from email_agent.services.chunker import chunk_text
+from email_agent.services.embeddings import embed_texts
 from langchain_core.documents import Document
-from langchain_google_community import GCSFileLoader
+from google.cloud import storage
 
 from google.cloud.aiplatform_v1 import (
     UpsertDatapointsRequest,
+    RemoveDatapointsRequest,
     IndexServiceAsyncClient,
     IndexDatapoint,
 )
-from fastembed import TextEmbedding
-from fastembed.common.model_description import PoolingType, ModelSource
 
 
 index_service_client = IndexServiceAsyncClient(
     client_options={"api_endpoint": f"{CFG.region}-aiplatform.googleapis.com"}
 )
-embedding_model = None
+storage_client = None
+
+
+def get_storage_client() -> storage.Client:
+    global storage_client
+    if storage_client is None:
+        storage_client = storage.Client(project=CFG.project_id)
+    return storage_client
 
 
-def load_and_chunk_gcs_file(bucket_name: str, file_name: str) -> List[Document]:
+def is_plain_text(name: str, content_type: Optional[str] = None) -> bool:
     """
-    Loads text from GCS using LangChain's loader and splits it recursively.
+    Checks whether an object is plain text or markdown, which is chunked without 'unstructured'.
     """
-    # Use GCSFileLoader to download document blobs
-    loader = GCSFileLoader(
-        project_name=CFG.project_id, bucket=bucket_name, blob=file_name
+    mime_type = (content_type or "").split(";")[0].strip().lower()
+    return (
+        mime_type in ("text/plain", "text/markdown", "text/x-markdown")
+        or os.path.splitext(name)[1].lower() in CFG.plain_text_extensions
     )
-    documents = loader.load()
-
-    # Chunk the documents, prioritizing keeping semantic units together
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=512,
-        chunk_overlap=50,
-        length_function=len,
-        separators=["\n\n", "\n", ". ", " "],
+
+
+def read_blob_text(blob: storage.Blob) -> str:
+    """
+    Streams a text blob in blocks, decoding it incrementally (without a temporary file).
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    parts = []
+    with blob.open("rb", chunk_size=CFG.ingest_stream_block_bytes) as reader:
+        while block := reader.read(CFG.ingest_stream_block_bytes):
+            parts.append(decoder.decode(block))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+
+def load_and_chunk_file(file_path: str, source: str) -> List[Document]:
+    """
+    Loads the text of a local (or already downloaded) file and splits it into token-sized chunks.
+    'source' is the GCS URI the chunks are indexed under. Only formats other than plain text
+    and markdown go through 'unstructured'.
+    """
+    if is_plain_text(file_path):
+        with open(file_path, encoding="utf-8-sig", errors="replace") as file:
+            text = file.read()
+    else:
+        from unstructured.partition.auto import partition
+
+        text = "\n\n".join(str(element) for element in partition(filename=file_path))
+
+    return chunk_text(text, {"source": source})
+
+
+def load_and_chunk_blob(
+    blob: storage.Blob, source: str, content_type: Optional[str] = None
+) -> List[Document]:
+    """
+    Streams a plain text or markdown blob straight into the chunker, other formats are downloaded
+    to a temporary file for 'unstructured'.
+    """
+    if is_plain_text(blob.name, content_type or blob.content_type):
+        return chunk_text(read_blob_text(blob), {"source": source})
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Keep the file name, 'unstructured' detects the format from its extension
+        file_path = os.path.join(temp_dir, os.path.basename(blob.name))
+        blob.download_to_filename(file_path)
+        return load_and_chunk_file(file_path, source)
+
+
+def load_and_chunk_gcs_file(
+    bucket_name: str,
+    file_name: str,
+    content_type: Optional[str] = None,
+    generation: Optional[str] = None,
+) -> List[Document]:
+    """
+    Loads text from GCS (the given generation, the latest by default) and splits it into token-sized chunks.
+    """
+    blob = (
+        get_storage_client()
+        .bucket(bucket_name)
+        .blob(file_name, generation=int(generation) if generation else None)
     )
-    chunks = text_splitter.split_documents(documents)
+    chunks = load_and_chunk_blob(blob, f"gs://{bucket_name}/{file_name}", content_type)
 
     logger.info(f"File {file_name} loaded and split into {len(chunks)} documents.")
     return chunks
 
 
-def get_multilingual_embeddings(chunks: List[str]) -> List[List[float]]:
+def get_multilingual_embeddings(chunks: List[Document]) -> List[List[float]]:
     """
     Generates vector embeddings for a list of document chunks.
     """
-    global embedding_model
+    return embed_texts([chunk.page_content for chunk in chunks], "ingestion")
 
-    if embedding_model is None:
-        try:
-            TextEmbedding.add_custom_model(
-                model=CFG.embedding_model_name,
-                pooling=PoolingType.MEAN,
-                normalization=True,
-                sources=ModelSource(hf=CFG.embedding_model_name),
-                dim=CFG.vector_dimensions,
-                model_file="onnx/model.onnx",
-            )
-        except Exception:
-            logger.info(
-                f"Embedding model {CFG.embedding_model_name} already added to 'fastembed'."
-            )
 
-        embedding_model = embedding_model = TextEmbedding(
-            model_name=CFG.embedding_model_name
+def to_datapoints(embeddings: List[List[float]], documents) -> List[IndexDatapoint]:
+    """
+    Pairs the embeddings with their chunks as Vector Search datapoints.
+    """
+    return [
+        IndexDatapoint(
+            # Later to be returned by the query of the index, the source URI with the chunk hash
+            datapoint_id=chunk_datapoint_id(
+                doc.metadata["source"], doc.metadata["chunk_hash"]
+            ),
+            feature_vector=vector,
         )
+        for vector, doc in zip(embeddings, documents)
+    ]
+
 
-    embeddings = embedding_model.embed([chunk.page_content for chunk in chunks])
+async def upsert_datapoints(datapoints: List[IndexDatapoint]) -> None:
+    """
+    Upserts one request worth of datapoints, transient failures are retried by the limiter.
+    """
+    request = UpsertDatapointsRequest(index=CFG.index_id, datapoints=datapoints)
 
-    return list(embeddings)
+    await vector_search_limiter.run(
+        lambda: index_service_client.upsert_datapoints(request=request),
+        priority=Priority.BACKGROUND,
+    )
 
 
 async def upsert_to_vector_search(embeddings: List[List[float]], documents):
     """
-    Upserts datapoints to the Vertex AI Vector Search Index.
+    Upserts datapoints to the Vertex AI Vector Search Index, in concurrent requests of bounded size.
     """
-    datapoints = []
-    for vector, doc in zip(embeddings, documents):
-        datapoints.append(
-            IndexDatapoint(
-                datapoint_id=doc.metadata[
-                    "source"
-                ],  # Later to be returned by the query of the index
-                feature_vector=vector,
-            )
-        )
+    datapoints = to_datapoints(embeddings, documents)
+    size = CFG.ingest_upsert_batch_size
 
-    request = UpsertDatapointsRequest(index=CFG.index_id, datapoints=datapoints)
-
-    await index_service_client.upsert_datapoints(request=request)
+    await asyncio.gather(
+        *(
+            upsert_datapoints(datapoints[start : start + size])
+            for start in range(0, len(datapoints), size)
+        )
+    )
 
     logger.info(
         f"Successfully upserted {len(datapoints)} datapoints to {CFG.index_id}."
     )
+
+
+async def remove_datapoints(datapoint_ids: List[str]) -> None:
+    """
+    Removes datapoints from the Vector Search index, in requests of bounded size.
+    """
+    size = CFG.ingest_upsert_batch_size
+    for start in range(0, len(datapoint_ids), size):
+        request = RemoveDatapointsRequest(
+            index=CFG.index_id, datapoint_ids=datapoint_ids[start : start + size]
+        )
+        await vector_search_limiter.run(
+            lambda: index_service_client.remove_datapoints(request=request),
+            priority=Priority.BACKGROUND,
+        )
+
+
+async def complete_update(update: ManifestUpdate) -> None:
+    """
+    Stores the new manifest of the object, once the new chunks are upserted, and removes the datapoints
+    (and texts) of the chunks no longer in it. The manifest is compared and set against the one the update
+    was diffed with, 'ManifestConflictError' is raised if another ingestion of the object stored one meanwhile.
+
+    The removals are recorded in the manifest until they are done, so if they fail, the manifest is not
+    current and the retried (or next) ingestion of the object removes them again.
+    """
+    manifest = update.to_manifest()
+    if not await manifest_store.replace(update.manifest, manifest):
+        raise ManifestConflictError(
+            f"Manifest of {update.source} changed during its ingestion."
+        )
+    if update.removed_ids:
+        await remove_datapoints(update.removed_ids)
+        await chunk_store.delete(update.removed_ids)
+        # On a conflict, a newer update carries the removals on (and repeats them harmlessly)
+        await manifest_store.replace(
+            manifest, manifest.model_copy(update={"removed_ids": []})
+        )
+
+
+# Ingestions of one source object run one at a time in this instance
+source_locks: Dict[str, asyncio.Lock] = {}
+# Holders and waiters per lock, a lock is removed once it has none
+source_lock_users: Dict[str, int] = {}
+
+
+@asynccontextmanager
+async def source_lock(source: str):
+    """
+    Holds the ingestion lock of a source object, which exists only while it is held or awaited.
+    """
+    lock = source_locks.setdefault(source, asyncio.Lock())
+    source_lock_users[source] = source_lock_users.get(source, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        source_lock_users[source] -= 1
+        if not source_lock_users[source]:
+            del source_lock_users[source]
+            del source_locks[source]
+
+
+async def remove_source(source: str) -> None:
+    """
+    Removes the datapoints, chunk texts and manifest of a source object deleted from the bucket.
+    The manifest goes last, so a failed removal is retried with the chunks it references.
+    """
+    async with source_lock(source):
+        manifest = await manifest_store.get(source)
+        datapoint_ids = (
+            [chunk_datapoint_id(source, hash_) for hash_ in manifest.chunk_hashes]
+            + manifest.removed_ids
+            if manifest
+            else [
+                source
+            ]  # The single datapoint of an object ingested before the manifests
+        )
+        await remove_datapoints(datapoint_ids)
+        await chunk_store.delete(datapoint_ids)
+        if manifest:
+            await manifest_store.delete(source)
+
+    logger.info(f"{len(datapoint_ids)} datapoints of the deleted {source} removed.")
+
+
+def is_superseded(
+    manifest: Optional[IngestionManifest], generation: Optional[str]
+) -> bool:
+    """
+    Checks whether the stored manifest has the given generation already, or a newer one.
+    """
+    return bool(
+        manifest
+        and (
+            manifest.is_current(generation)
+            or is_newer_generation(manifest.generation, generation)
+        )
+    )
+
+
+async def embed_and_upsert(source: str, chunks: List[Document]) -> None:
+    """
+    Embeds the chunks of a source object, stores their texts and upserts their datapoints.
+    """
+    # Inference blocks, so it runs in a worker thread instead of the event loop
+    embeddings = await asyncio.to_thread(get_multilingual_embeddings, chunks)
+    # The texts are stored first, so every upserted datapoint can be resolved by the retrieval
+    await chunk_store.save(source, chunks)
+    await upsert_to_vector_search(embeddings, chunks)
+
+
+async def complete_ingestion(
+    update: ManifestUpdate, upserted: Set[str]
+) -> Optional[ManifestUpdate]:
+    """
+    Completes the update of a source object once its new chunks (the hashes in 'upserted') are upserted,
+    holding the lock of the object. Returns the completed update.
+
+    Across instances, the compare-and-set of the manifest detects a concurrent ingestion: the chunks are
+    then diffed again against the stored manifest (upserting the chunks it lacks). A generation that is not
+    newer than the stored one is discarded, the datapoints upserted for it that the stored manifest does not
+    reference are removed again and None is returned.
+    """
+    source, generation = update.source, update.generation
+    while True:
+        try:
+            await complete_update(update)
+            return update
+        except ManifestConflictError as e:
+            logger.warning(f"{e} Diffing generation {generation} again.")
+
+        manifest = await manifest_store.get(source)
+        if is_superseded(manifest, generation):
+            orphans = [
+                chunk_datapoint_id(source, hash_)
+                for hash_ in sorted(upserted - set(manifest.chunk_hashes))
+            ]
+            if orphans:
+                await remove_datapoints(orphans)
+                await chunk_store.delete(orphans)
+            logger.info(
+                f"Generation {manifest.generation} of {source} is stored already, "
+                f"discarding generation {generation}."
+            )
+            return None
+
+        update = ManifestUpdate(source, generation, update.chunks, manifest)
+        new_chunks = [
+            chunk
+            for chunk in update.new_chunks
+            if chunk.metadata["chunk_hash"] not in upserted
+        ]
+        if new_chunks:
+            await embed_and_upsert(source, new_chunks)
+            upserted.update(chunk.metadata["chunk_hash"] for chunk in new_chunks)
+
+
+async def ingest_chunks(
+    source: str, generation: Optional[str], chunks: List[Document]
+) -> Optional[ManifestUpdate]:
+    """
+    Embeds and upserts the new chunks of a generation of a source object and completes its update.
+    The ingestions of one object are serialized within the instance, each one diffs against the manifest
+    stored by the previous one. Returns None if the generation is not newer than the stored one.
+    """
+    async with source_lock(source):
+        manifest = await manifest_store.get(source)
+        if is_superseded(manifest, generation):
+            logger.info(
+                f"Generation {manifest.generation} of {source} is stored already, "
+                f"discarding generation {generation}."
+            )
+            return None
+
+        update = ManifestUpdate(source, generation, chunks, manifest)
+        if update.new_chunks:
+            await embed_and_upsert(source, update.new_chunks)
+        return await complete_ingestion(
+            update, {chunk.metadata["chunk_hash"] for chunk in update.new_chunks}
+        )
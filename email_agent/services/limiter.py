@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from enum import IntEnum
+from typing import Awaitable, Callable, List, Optional, Tuple, TypeVar
+from email_agent.config import CFG
+from email_agent.utils.logger import logger
+
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    """Priority of a limited call, lower values are served first."""
+
+    REPLY = 0  # Work on the critical path of answering an email
+    BACKGROUND = 1  # Ingestion, summaries and other deferrable work
+
+
+class TokenBucket:
+    """
+    Continuously refilled token bucket holding at most one minute worth of capacity.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Returns the number of seconds until the requested amount is available (0 if it is available now).
+        """
+        self._refill()
+        amount = min(amount, self.capacity)  # Oversized requests wait for a full bucket
+        return max(amount - self.tokens, 0.0) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """
+    Checks whether an exception signals an exhausted quota (HTTP 429 / RESOURCE_EXHAUSTED).
+    """
+    code = getattr(error, "code", None) or getattr(
+        getattr(error, "resp", None), "status", None
+    )
+    return (
+        code in (429, "429")
+        or "RESOURCE_EXHAUSTED" in str(error).upper()
+        or type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Checks whether an exception is a transient server-side failure worth retrying.
+    """
+    if is_rate_limited(error):
+        return True
+
+    code = getattr(error, "code", None) or getattr(
+        getattr(error, "resp", None), "status", None
+    )
+    return code in (500, 502, 503, 504) or type(error).__name__ in (
+        "ServiceUnavailable",
+        "InternalServerError",
+        "BadGateway",
+        "GatewayTimeout",
+    )
+
+
+class LLMLimiter:
+    """
+    Client-side limiter for one Vertex AI service, shared by all of its callers.
+
+    Combines token buckets for requests and tokens per minute, an AIMD-adapted concurrency limit
+    (additive increase on fast successes, multiplicative decrease on 429s and slow responses),
+    jittered exponential retries and a priority queue that serves reply generation before background work.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        rpm = CFG.limiter_rpm.get(name)
+        tpm = CFG.limiter_tpm.get(name)
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+
+        # Start halfway between the bounds, the AIMD control loop adapts from there
+        self._limit = float(
+            max(CFG.limiter_min_concurrency, CFG.limiter_max_concurrency // 2)
+        )
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    @property
+    def concurrency_limit(self) -> int:
+        return int(self._limit)
+
+    def _dispatch(self) -> None:
+        """
+        Hands free concurrency slots to the waiters with the highest priority.
+        """
+        while self._waiters and self._in_flight < self.concurrency_limit:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():  # Cancelled while waiting
+                continue
+            self._in_flight += 1
+            waiter.set_result(None)
+
+    async def _acquire(self, priority: Priority, tokens: float) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+        # Once a slot is held, wait for the per-minute request and token budgets
+        try:
+            while True:
+                delay = max(
+                    self._requests.wait_time(1) if self._requests else 0.0,
+                    self._tokens.wait_time(tokens) if self._tokens else 0.0,
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._release()
+            raise
+
+        if self._requests:
+            self._requests.consume(1)
+        if self._tokens:
+            self._tokens.consume(tokens)
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    def _on_success(self, latency_s: float) -> None:
+        if latency_s > CFG.limiter_target_latency_s:
+            self._decrease(f"latency {latency_s:.1f}s")
+        else:
+            self._limit = min(
+                self._limit + 1 / self._limit, float(CFG.limiter_max_concurrency)
+            )
+            self._dispatch()
+
+    def _decrease(self, reason: str) -> None:
+        # Decrease at most once per target latency window, all calls of one burst see the same overload
+        now = time.monotonic()
+        if now - self._last_decrease < CFG.limiter_target_latency_s:
+            return
+
+        self._last_decrease = now
+        self._limit = max(self._limit / 2, float(CFG.limiter_min_concurrency))
+        logger.warning(
+            f"Limiter '{self.name}' reduced concurrency to {self.concurrency_limit} ({reason})."
+        )
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.BACKGROUND,
+        tokens: float = 0,
+    ) -> T:
+        """
+        Executes the awaitable returned by 'call' within the limits, retrying transient failures.
+        'tokens' is the estimated token usage of the call, counted towards the tokens per minute.
+        """
+        attempt = 0
+        while True:
+            await self._acquire(priority, tokens)
+            start = time.monotonic()
+            try:
+                result = await call()
+                self._on_success(time.monotonic() - start)
+                return result
+
+            except Exception as e:
+                if is_rate_limited(e):
+                    self._decrease("rate limited")
+
+                if not is_retryable(e) or attempt >= CFG.limiter_max_retries:
+                    raise
+
+                # Full jitter exponential backoff
+                backoff = random.uniform(
+                    0,
+                    min(
+                        CFG.limiter_max_backoff_s,
+                        CFG.limiter_base_backoff_s * 2**attempt,
+                    ),
+                )
+                attempt += 1
+                logger.warning(
+                    f"Limiter '{self.name}' retrying call in {backoff:.1f}s (attempt {attempt}): {e}"
+                )
+
+            finally:
+                self._release()
+
+            await asyncio.sleep(backoff)
+
+
+def estimate_tokens(content: Optional[object]) -> int:
+    """
+    Roughly estimates the token count of a prompt (about 4 characters per token).
+    """
+    return len(str(content or "")) // 4
+
+
+gemini_limiter = LLMLimiter("gemini")
+speech_limiter = LLMLimiter("speech")
+vector_search_limiter = LLMLimiter("vector_search")
@@ -1,10 +1,150 @@
+import re
+from typing import Dict, Literal, Optional
 from langchain_google_vertexai import ChatVertexAI
+from pydantic import BaseModel
 
 from email_agent.config import CFG
+from email_agent.models.gmail import EmailMessage
+from email_agent.utils.logger import logger
 
 
+Route = Literal["fast", "strong"]
+
 llm = ChatVertexAI(
     project=CFG.project_id,
     model=CFG.model_name,
     temperature=CFG.temperature,
 )
+
+fast_llm = ChatVertexAI(
+    project=CFG.project_id,
+    model=CFG.fast_model_name,
+    temperature=CFG.temperature,
+)
+
+MODELS: Dict[Route, ChatVertexAI] = {"fast": fast_llm, "strong": llm}
+
+
+class RoutingFeatures(BaseModel):
+    """Features of an email (and its retrievals) used to pick the model that answers it."""
+
+    body_length: int
+    attachment_count: int
+    question_count: int
+    retrieval_score: Optional[float] = None
+
+    @classmethod
+    def from_email(
+        cls, email: EmailMessage, retrieval_score: Optional[float] = None
+    ) -> "RoutingFeatures":
+        body = email.body.body_text or ""
+        return cls(
+            body_length=len(body),
+            attachment_count=len(email.body.attachments or []),
+            question_count=len(re.findall(r"\?", body)),
+            retrieval_score=retrieval_score,
+        )
+
+
+class RouteStats(BaseModel):
+    """Aggregated latency and token usage of all LLM calls sent to one route."""
+
+    calls: int = 0
+    total_latency_s: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost_usd: float = 0.0
+
+    @property
+    def avg_latency_s(self) -> float:
+        return self.total_latency_s / self.calls if self.calls else 0.0
+
+
+class ModelRouter:
+    """
+    Routes LLM calls between the fast and the strong model and records per-route latency, token cost and escalations.
+    """
+
+    def __init__(self):
+        self._stats: Dict[Route, RouteStats] = {
+            "fast": RouteStats(),
+            "strong": RouteStats(),
+        }
+        self._routed_emails = 0
+        self._escalations = 0
+
+    def route(
+        self, features: RoutingFeatures, previous_route: Optional[Route] = None
+    ) -> Route:
+        """
+        Picks the model for the reply of an email based on the configured feature thresholds.
+        An escalation is sticky, an email answered by the strong model stays with it for the rest of the run.
+        """
+        if not CFG.routing_enabled or previous_route == "strong":
+            return "strong"
+
+        reasons = []
+        if features.body_length > CFG.routing_max_body_chars:
+            reasons.append(f"body length {features.body_length}")
+        if features.attachment_count > CFG.routing_max_attachments:
+            reasons.append(f"{features.attachment_count} attachments")
+        if features.question_count > CFG.routing_max_questions:
+            reasons.append(f"{features.question_count} questions")
+        if (
+            features.retrieval_score is not None
+            and features.retrieval_score < CFG.routing_min_retrieval_score
+        ):
+            reasons.append(f"retrieval score {features.retrieval_score:.2f}")
+
+        if reasons:
+            logger.info(f"Routing to the strong model due to: {', '.join(reasons)}.")
+            return "strong"
+
+        return "fast"
+
+    def record_routing(self, route: Route, previous_route: Optional[Route]) -> None:
+        """
+        Counts a routing decision; a switch from the fast to the strong model within one email is an escalation.
+        """
+        if previous_route is None:
+            self._routed_emails += 1
+        elif previous_route == "fast" and route == "strong":
+            self._escalations += 1
+            logger.info("Escalating the email to the strong model.")
+
+    def record_call(self, route: Route, latency_s: float, usage: Optional[dict]):
+        """
+        Records the latency and token usage (from the message 'usage_metadata') of a single LLM call.
+        """
+        stats = self._stats[route]
+        stats.calls += 1
+        stats.total_latency_s += latency_s
+
+        usage = usage or {}
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        input_price, output_price = CFG.routing_token_prices.get(route, [0.0, 0.0])
+        stats.input_tokens += input_tokens
+        stats.output_tokens += output_tokens
+        stats.cost_usd += (
+            input_tokens * input_price + output_tokens * output_price
+        ) / 1_000_000
+
+    def stats(self) -> dict:
+        """
+        Returns the per-route statistics and the escalation rate.
+        """
+        return {
+            "routes": {
+                route: {**stats.model_dump(), "avg_latency_s": stats.avg_latency_s}
+                for route, stats in self._stats.items()
+            },
+            "routed_emails": self._routed_emails,
+            "escalations": self._escalations,
+            "escalation_rate": (
+                self._escalations / self._routed_emails if self._routed_emails else 0.0
+            ),
+        }
+
+
+model_router = ModelRouter()
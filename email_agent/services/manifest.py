@@ -0,0 +1,216 @@
+import hashlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from langchain_core.documents import Document
+from email_agent.config import CFG
+from email_agent.models.ingest import IngestionManifest
+from email_agent.services.firestore import db
+from email_agent.utils.logger import logger
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def is_newer_generation(generation: Optional[str], other: Optional[str]) -> bool:
+    """
+    Compares two GCS generations (increasing integers), local files ingested before they were uploaded have content hashes instead.
+    """
+    return bool(
+        generation
+        and other
+        and generation.isdigit()
+        and other.isdigit()
+        and int(generation) > int(other)
+    )
+
+
+class ManifestConflictError(Exception):
+    """Raised when the manifest of a source object changed since the update was diffed against it."""
+
+
+def chunk_datapoint_id(source: str, hash_: str) -> str:
+    """
+    Returns the datapoint ID of a chunk, the source URI with the chunk hash as its fragment.
+    """
+    return f"{source}#{hash_}"
+
+
+# Firestore commits at most 500 writes at once
+FIRESTORE_BATCH_SIZE = 500
+
+
+class ManifestUpdate:
+    """
+    The difference between the chunks of a new generation of a source object and its manifest:
+    the chunks to be embedded and upserted, and the datapoints to be removed (including the ones
+    whose removal is still pending in the manifest). If the manifest predates the stored chunk texts,
+    all chunks are new.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        generation: Optional[str],
+        chunks: List[Document],
+        manifest: Optional[IngestionManifest],
+    ):
+        self.source = source
+        self.generation = generation
+        self.manifest = manifest  # Compared and set when the update is stored
+
+        # Identical chunks of one object share a datapoint
+        chunks_by_hash: Dict[str, Document] = {}
+        for chunk in chunks:
+            hash_ = chunk_hash(chunk.page_content)
+            chunk.metadata["chunk_hash"] = hash_
+            chunks_by_hash.setdefault(hash_, chunk)
+
+        self.chunks = list(chunks_by_hash.values())  # Diffed again on a conflict
+        previous = set(manifest.chunk_hashes) if manifest else set()
+        stored = previous if manifest and manifest.chunk_texts else set()
+        self.chunk_hashes = list(chunks_by_hash)
+        self.new_chunks = [
+            chunk for hash_, chunk in chunks_by_hash.items() if hash_ not in stored
+        ]
+        self.removed_ids = [
+            chunk_datapoint_id(source, hash_)
+            for hash_ in sorted(previous - chunks_by_hash.keys())
+        ]
+        if manifest is None:
+            # Objects ingested before the manifests had a single datapoint named by the source URI
+            self.removed_ids.append(source)
+        else:
+            current_ids = {
+                chunk_datapoint_id(source, hash_) for hash_ in chunks_by_hash
+            }
+            self.removed_ids.extend(
+                datapoint_id
+                for datapoint_id in manifest.removed_ids
+                if datapoint_id not in current_ids
+                and datapoint_id not in self.removed_ids
+            )
+
+    def to_manifest(self) -> IngestionManifest:
+        return IngestionManifest(
+            source=self.source,
+            generation=self.generation,
+            chunk_hashes=self.chunk_hashes,
+            chunk_texts=True,
+            removed_ids=self.removed_ids,
+            updated_at=datetime.now(timezone.utc),
+        )
+
+
+class ManifestStore:
+    """
+    Firestore store of the ingestion manifests, one document per source object.
+    """
+
+    def __init__(self):
+        self.db = db
+
+    def _doc_ref(self, source: str):
+        # Source URIs contain slashes, which are not allowed in document IDs
+        doc_id = hashlib.sha256(source.encode()).hexdigest()[:32]
+        return self.db.collection(CFG.ingest_manifest_collection).document(doc_id)
+
+    async def get(self, source: str) -> Optional[IngestionManifest]:
+        doc = await self._doc_ref(source).get()
+        return IngestionManifest(**doc.to_dict()) if doc.exists else None
+
+    async def replace(
+        self, expected: Optional[IngestionManifest], manifest: IngestionManifest
+    ) -> bool:
+        """
+        Compare-and-set of the manifest of a source object: stores it only if the stored manifest still
+        has the expected generation, chunks and pending removals (or there is none, if none is expected).
+        """
+        from google.cloud import firestore
+
+        doc_ref = self._doc_ref(manifest.source)
+
+        @firestore.async_transactional
+        async def replace_in_transaction(transaction) -> bool:
+            doc = await doc_ref.get(transaction=transaction)
+            stored = IngestionManifest(**doc.to_dict()) if doc.exists else None
+            if (stored is None) != (expected is None) or (
+                stored is not None
+                and (stored.generation, stored.chunk_hashes, stored.removed_ids)
+                != (expected.generation, expected.chunk_hashes, expected.removed_ids)
+            ):
+                return False
+
+            transaction.set(doc_ref, manifest.model_dump())
+            return True
+
+        replaced = await replace_in_transaction(self.db.transaction())
+        if replaced:
+            logger.info(
+                f"Manifest of {manifest.source} saved: generation {manifest.generation}, "
+                f"{len(manifest.chunk_hashes)} chunks."
+            )
+        return replaced
+
+    async def delete(self, source: str) -> None:
+        await self._doc_ref(source).delete()
+        logger.info(f"Manifest of {source} deleted.")
+
+
+class ChunkStore:
+    """
+    Firestore store of the chunk texts, one document per datapoint. The index only keeps the IDs and
+    embeddings, the retrieval looks the texts of the neighbours up by their datapoint IDs.
+    """
+
+    def __init__(self):
+        self.db = db
+
+    def _doc_ref(self, datapoint_id: str):
+        # Datapoint IDs contain slashes, which are not allowed in document IDs
+        doc_id = hashlib.sha256(datapoint_id.encode()).hexdigest()[:32]
+        return self.db.collection(CFG.ingest_chunk_collection).document(doc_id)
+
+    async def save(self, source: str, chunks: List[Document]) -> None:
+        """
+        Stores the texts of the chunks of a source object, before their datapoints are upserted.
+        """
+        for start in range(0, len(chunks), FIRESTORE_BATCH_SIZE):
+            batch = self.db.batch()
+            for chunk in chunks[start : start + FIRESTORE_BATCH_SIZE]:
+                datapoint_id = chunk_datapoint_id(source, chunk.metadata["chunk_hash"])
+                batch.set(
+                    self._doc_ref(datapoint_id),
+                    {
+                        "datapoint_id": datapoint_id,
+                        "source": source,
+                        "text": chunk.page_content,
+                    },
+                )
+            await batch.commit()
+
+    async def delete(self, datapoint_ids: List[str]) -> None:
+        for start in range(0, len(datapoint_ids), FIRESTORE_BATCH_SIZE):
+            batch = self.db.batch()
+            for datapoint_id in datapoint_ids[start : start + FIRESTORE_BATCH_SIZE]:
+                batch.delete(self._doc_ref(datapoint_id))
+            await batch.commit()
+
+    async def get_texts(self, datapoint_ids: List[str]) -> Dict[str, str]:
+        """
+        Returns the stored texts of the given datapoints by ID, in one batched read.
+        """
+        if not datapoint_ids:
+            return {}
+
+        texts = {}
+        refs = [self._doc_ref(datapoint_id) for datapoint_id in datapoint_ids]
+        async for doc in self.db.get_all(refs):
+            if doc.exists:
+                data = doc.to_dict()
+                texts[data["datapoint_id"]] = data["text"]
+        return texts
+
+
+manifest_store = ManifestStore()
+chunk_store = ChunkStore()
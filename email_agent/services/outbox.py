@@ -0,0 +1,282 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from email_agent.config import CFG
+from email_agent.models.gmail import EmailMessage
+from email_agent.models.inbox import Inbox
+from email_agent.models.queue import WorkItem
+from email_agent.services.gmail import (
+    ANSWERED_LABEL,
+    IRRELEVANT_LABEL,
+    build_reply_message,
+    execute_batch,
+    get_or_create_custom_label_id,
+)
+from email_agent.services.inboxes import InboxContext, inbox_registry
+from email_agent.services.work_queue import create_queue_backend
+from email_agent.utils.logger import logger
+
+
+class Outbox:
+    """
+    Durable outbox of replies and thread label changes.
+
+    The graph's results are persisted first, keyed by the received message ID (the idempotency key),
+    and a background sender delivers them in Gmail batch requests with retries. An item moves from
+    'pending' to 'sent' once its reply is delivered, so a failed label change never resends the reply.
+    Items are delivered through the inbox that received the message, with that inbox's labels.
+    Delivered items are kept as tombstones for 'outbox_tombstone_ttl_days', so a message processed
+    again (e.g. on a redelivered notification) is not answered twice. A reply that cannot be sent is
+    dead-lettered: it is dropped and the claim of its message is released, so that a later catch-up
+    answers the message (still unread) again.
+    """
+
+    def __init__(self):
+        self.backend = create_queue_backend(
+            collection=CFG.outbox_collection, sqlite_path=CFG.outbox_sqlite_path
+        )
+        self._label_ids: Dict[Tuple[str, str], str] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _put(
+        self, received_message: EmailMessage, payload: dict, inbox: Optional[Inbox]
+    ) -> None:
+        inbox = inbox or inbox_registry.primary.inbox
+        item_id = inbox.scoped(received_message.id)
+        accepted = await self.backend.put(
+            item_id,
+            {**payload, "inbox": inbox.email, "message_id": received_message.id},
+        )
+        if not accepted:
+            raise RuntimeError(f"Outbox is full, cannot store {item_id}.")
+
+        logger.info(f"Stored '{payload['kind']}' for {item_id} in outbox.")
+        self._wakeup.set()
+
+    async def enqueue_reply(
+        self,
+        received_message: EmailMessage,
+        body_text: str,
+        references: Optional[List[str]] = None,
+        inbox: Optional[Inbox] = None,
+    ):
+        """
+        Persists a reply to the received message, labeling its thread as answered after delivery.
+        """
+        await self._put(
+            received_message,
+            {
+                "kind": "reply",
+                "status": "pending",
+                "thread_id": received_message.thread_id,
+                "message": build_reply_message(received_message, body_text, references),
+            },
+            inbox,
+        )
+
+    async def enqueue_irrelevant(
+        self, received_message: EmailMessage, inbox: Optional[Inbox] = None
+    ):
+        """
+        Persists the labeling of the received message's thread as irrelevant.
+        """
+        await self._put(
+            received_message,
+            {
+                "kind": "irrelevant",
+                "status": "sent",  # Nothing to send, only the label change remains
+                "thread_id": received_message.thread_id,
+            },
+            inbox,
+        )
+
+    def _get_label_id(self, service, inbox: Inbox, name: str, label: tuple) -> str:
+        # The label's name is configured per inbox, its colors are shared
+        key = (inbox.email, name)
+        if key not in self._label_ids:
+            self._label_ids[key] = get_or_create_custom_label_id(
+                service, name, *label[1:], user_id=inbox.email
+            )
+        return self._label_ids[key]
+
+    async def _retry_or_drop(
+        self, item: WorkItem, error: object, payload: Optional[dict] = None
+    ) -> None:
+        if item.attempts >= CFG.outbox_max_attempts:
+            logger.error(
+                f"Outbox item {item.id} failed {item.attempts} times, dropping it: {error}"
+            )
+            if item.payload["status"] == "sent":
+                # The reply went out, only its label is missing
+                await self._complete(item)
+            else:
+                await self._dead_letter(item)
+            return
+
+        delay = CFG.outbox_retry_delay_s * 2 ** (item.attempts - 1)
+        logger.warning(
+            f"Outbox item {item.id} failed (attempt {item.attempts}), retrying in {delay}s: {error}"
+        )
+        await self.backend.nack(item.id, delay, payload)
+
+    async def _dead_letter(self, item: WorkItem) -> None:
+        """
+        Drops an undeliverable reply and releases the claim of its message, so it is not left unanswered.
+        """
+        await self.backend.ack(item.id)
+        inbox = inbox_registry.get(item.payload.get("inbox", CFG.user_email))
+        message_id = item.payload.get("message_id")  # Missing in items stored before
+        if inbox is None or message_id is None:
+            logger.error(
+                f"Cannot release the claim of {item.id}, its message stays unanswered."
+            )
+            return
+
+        await inbox.state.release_message(message_id)
+        logger.warning(
+            f"Claim of message {message_id} released, a catch-up of {inbox.email} answers it again."
+        )
+
+    async def _complete(self, item: WorkItem) -> None:
+        await self.backend.complete(
+            item.id, CFG.outbox_tombstone_ttl_days * 24 * 60 * 60
+        )
+
+    async def drain_once(self) -> int:
+        """
+        Delivers one batch of outbox items: per inbox, sends the pending replies in one batch request,
+        then applies the thread label changes in another. Returns the number of claimed items.
+        """
+        items: List[WorkItem] = await self.backend.claim(
+            CFG.outbox_batch_size, CFG.outbox_lease_s
+        )
+        if not items:
+            return 0
+
+        by_inbox: Dict[str, List[WorkItem]] = {}
+        for item in items:
+            by_inbox.setdefault(item.payload.get("inbox", CFG.user_email), []).append(
+                item
+            )
+
+        for email, inbox_items in by_inbox.items():
+            inbox = inbox_registry.get(email)
+            if inbox is None:
+                for item in inbox_items:
+                    await self._retry_or_drop(item, f"Unknown inbox {email}.")
+                continue
+            await self._deliver(inbox, inbox_items)
+
+        return len(items)
+
+    async def _deliver(self, inbox: InboxContext, items: List[WorkItem]) -> None:
+        # The Gmail client is not thread-safe, the sender uses its own
+        service = await asyncio.to_thread(inbox.get_gmail_service)
+        users = service.users()
+
+        # 1. Send the pending replies
+        to_send = [item for item in items if item.payload["status"] == "pending"]
+        if to_send:
+            results = await asyncio.to_thread(
+                execute_batch,
+                service,
+                {
+                    item.id: users.messages().send(
+                        userId=inbox.email, body=item.payload["message"]
+                    )
+                    for item in to_send
+                },
+            )
+            for item in to_send:
+                result = results.get(item.id)
+                if isinstance(result, Exception) or result is None:
+                    await self._retry_or_drop(item, result)
+                    items.remove(item)
+                else:
+                    item.payload["status"] = "sent"
+                    item.payload["sent_message_id"] = result.get("id")
+                    logger.info(f"Reply to {item.id} sent: {result.get('id')}")
+                    # Record the delivery right away (keeping the lease), a crash before
+                    # the label change must not resend the reply
+                    await self.backend.nack(item.id, CFG.outbox_lease_s, item.payload)
+
+        # 2. Mark the threads as read and label them
+        if items:
+            label_ids = await asyncio.to_thread(
+                lambda: {
+                    "reply": self._get_label_id(
+                        service, inbox.inbox, inbox.inbox.answered_label, ANSWERED_LABEL
+                    ),
+                    "irrelevant": self._get_label_id(
+                        service,
+                        inbox.inbox,
+                        inbox.inbox.irrelevant_label,
+                        IRRELEVANT_LABEL,
+                    ),
+                }
+            )
+            results = await asyncio.to_thread(
+                execute_batch,
+                service,
+                {
+                    item.id: users.threads().modify(
+                        userId=inbox.email,
+                        id=item.payload["thread_id"],
+                        body={
+                            "removeLabelIds": ["UNREAD"],
+                            "addLabelIds": [label_ids[item.payload["kind"]]],
+                        },
+                    )
+                    for item in items
+                },
+            )
+            for item in items:
+                result = results.get(item.id)
+                if isinstance(result, Exception) or result is None:
+                    # Keep the 'sent' status, only the label change is retried
+                    await self._retry_or_drop(item, result, item.payload)
+                else:
+                    await self._complete(item)
+                    logger.info(
+                        f"Thread {item.payload['thread_id']} labeled as '{item.payload['kind']}'."
+                    )
+
+    async def drain(self) -> None:
+        """
+        Delivers all items that are available now, e.g. before a one-off script exits.
+        Items waiting for a retry stay in the outbox.
+        """
+        while await self.drain_once():
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self.drain_once():
+                    continue
+            except Exception as e:
+                logger.error(f"Outbox delivery failed: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), CFG.outbox_poll_interval_s)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        """
+        Starts the background sender.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the background sender, undelivered items stay in the outbox.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+outbox = Outbox()
@@ -0,0 +1,429 @@
+import asyncio
+import uuid
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from email_agent.agent.graph import discard_run, run_agent
+from email_agent.config import CFG
+from email_agent.models.gmail import EmailMessage, HistoryPage
+from email_agent.models.inbox import Inbox
+from email_agent.models.queue import WorkItem
+from email_agent.services.firestore import FirestoreService
+from email_agent.services.gmail import (
+    HistoryExpiredError,
+    iter_history_pages,
+    fetch_messages,
+    merge_thread_messages,
+    screen_messages,
+)
+from email_agent.services.admission import admission_controller, classify
+from email_agent.services.conversation import conversation_store
+from email_agent.services.inboxes import InboxContext, inbox_registry
+from email_agent.services.outbox import outbox
+from email_agent.services.work_queue import (
+    DeferredError,
+    WorkQueue,
+    create_queue_backend,
+)
+from email_agent.utils.logger import logger
+
+
+# Identifies this instance as the owner of the history leases
+INSTANCE_ID = str(uuid.uuid4())
+
+
+async def _keep_lease_alive(inbox: InboxContext) -> None:
+    """
+    Renews the history lease of an inbox while this instance is processing its history,
+    returns once the lease is lost.
+    """
+    while True:
+        await asyncio.sleep(CFG.history_lease_ttl_s / 3)
+        if not await inbox.state.acquire_history_lease(INSTANCE_ID):
+            logger.error(
+                f"History lease of {inbox.email} was lost to another instance."
+            )
+            return
+
+
+async def _process_until_released(inbox: InboxContext) -> None:
+    """
+    Processes the inbox history until the lease can be released, i.e. no newer history ID is pending.
+    """
+    try:
+        while True:
+            await _process_new_messages(inbox)
+
+            # Keep going if newer history IDs were registered while processing
+            if await inbox.state.release_history_lease(INSTANCE_ID):
+                return
+            logger.info(
+                f"Newer history ID of {inbox.email} registered meanwhile, processing again."
+            )
+
+    except Exception:
+        await inbox.state.release_history_lease(INSTANCE_ID, force=True)
+        raise
+
+
+async def process_history(
+    new_history_id: str, inbox: Optional[InboxContext] = None
+) -> None:
+    """
+    Coalesces overlapping notifications of an inbox (the primary one by default): registers the notified
+    history ID and, if no other caller (in this or another instance) is processing the inbox history already,
+    processes it until no newer history ID is pending.
+
+    The pass is cancelled as soon as a renewal of the lease fails, another instance may own the cursor
+    by then. The notification is deferred, the cursor is only written under the lease.
+    """
+    inbox = inbox or inbox_registry.primary
+    await inbox.state.register_pending_history_id(new_history_id)
+
+    if inbox.history_lock.locked():
+        logger.info(
+            f"History processing of {inbox.email} is already running in this instance, registered history ID {new_history_id}."
+        )
+        inbox.rerun_requested.set()
+        return
+
+    async with inbox.history_lock:
+        while await inbox.state.acquire_history_lease(INSTANCE_ID):
+            inbox.rerun_requested.clear()
+            passes = asyncio.create_task(_process_until_released(inbox))
+            lease_keeper = asyncio.create_task(_keep_lease_alive(inbox))
+            try:
+                await asyncio.wait(
+                    {passes, lease_keeper}, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                lease_keeper.cancel()
+                if not passes.done():
+                    passes.cancel()
+                    await asyncio.gather(passes, return_exceptions=True)
+
+            if passes.cancelled():
+                raise DeferredError(
+                    f"History lease of {inbox.email} lost, pass cancelled.",
+                    CFG.history_lease_ttl_s,
+                )
+            passes.result()  # Re-raises the failure of the pass
+
+            if not inbox.rerun_requested.is_set():
+                return
+
+        logger.info(
+            f"History lease of {inbox.email} is held by another instance, registered history ID {new_history_id}."
+        )
+
+
+class _PageTracker:
+    """
+    Tracks the completion of streamed history pages and checkpoints the cursor once a page
+    and all pages before it are fully processed.
+    """
+
+    def __init__(self, state: FirestoreService):
+        self.state = state
+        self._remaining: List[int] = []
+        self._checkpoints: List[str] = []
+        self._next_page = 0
+        self.failed = False
+
+    def add_page(self, page: HistoryPage) -> int:
+        self._remaining.append(len(page.message_ids))
+        self._checkpoints.append(page.checkpoint_history_id)
+        return len(self._remaining) - 1
+
+    async def complete(self, page_index: Optional[int] = None, count: int = 1) -> None:
+        """
+        Marks messages of a page as processed (or just re-checks the pages if no index is given).
+        """
+        if page_index is not None:
+            self._remaining[page_index] -= count
+
+        # A failed message stops the checkpoints, it is retried from the last checkpoint
+        checkpoint = None
+        while (
+            not self.failed
+            and self._next_page < len(self._remaining)
+            and self._remaining[self._next_page] == 0
+        ):
+            checkpoint = self._checkpoints[self._next_page]
+            self._next_page += 1
+
+        if checkpoint is not None:
+            await self.state.set_last_history_id(checkpoint)
+            logger.info(f"History checkpointed at {checkpoint}.")
+
+
+def group_by_thread(
+    message_ids: List[str], thread_ids: Dict[str, str]
+) -> List[List[str]]:
+    """
+    Groups message IDs by their thread ID, keeping the order of the first message of every thread.
+    """
+    groups: Dict[str, List[str]] = {}
+    for msg_id in message_ids:
+        groups.setdefault(thread_ids.get(msg_id, msg_id), []).append(msg_id)
+    return list(groups.values())
+
+
+async def process_thread_messages(
+    msg_ids: List[str],
+    service,
+    inbox: Optional[InboxContext] = None,
+) -> None:
+    """
+    Fetches new messages of one thread, runs the agentic workflow once on their combined content
+    and stores a single reply to the latest of them in the outbox.
+    The message IDs must already be claimed (see 'claim_messages').
+
+    The full messages are only downloaded once the admission controller admits them, by the lane
+    and size derived from their metadata. The exchange is recorded in the thread's conversation after
+    the admission slot and the attachments are released, its summarization is another LLM call.
+    """
+    inbox = (inbox or inbox_registry.primary).inbox
+    accepted = await asyncio.to_thread(
+        screen_messages, set(msg_ids), service, inbox.email
+    )
+    if not accepted:
+        return  # All messages were skipped (self-sent or bulk)
+
+    lane, size = await classify(accepted)
+    async with admission_controller.admit(lane, size):
+        answered = await _answer_thread_messages(
+            [metadata["id"] for metadata in accepted],
+            service,
+            inbox,
+        )
+
+    if answered:
+        # Remember the exchange for the next messages of the thread (best effort, the reply is stored)
+        msg, reply_text = answered
+        try:
+            await conversation_store.record_exchange(
+                msg, reply_text, inbox.scoped(msg.thread_id)
+            )
+        except Exception as e:
+            logger.error(f"Failed to record the conversation of {msg.thread_id}: {e}")
+
+
+async def _answer_thread_messages(
+    msg_ids: List[str], service, inbox: Inbox
+) -> Optional[Tuple[EmailMessage, str]]:
+    """
+    Answers the fetched messages of a thread at once, returns the merged message and the reply
+    (None if it was not answered).
+    """
+    processed_messages = await asyncio.to_thread(
+        fetch_messages, msg_ids, service, inbox.email
+    )
+    try:
+        msg = merge_thread_messages(processed_messages)
+        if len(processed_messages) > 1:
+            logger.info(
+                f"Answering {len(processed_messages)} new messages of thread {msg.thread_id} at once."
+            )
+        reply_text = await _run_and_store(msg, inbox)
+        return (msg, reply_text) if reply_text is not None else None
+
+    finally:
+        # Free the spooled attachment contents, a retry downloads them again
+        for message in processed_messages:
+            message.close_attachments()
+
+
+async def _run_and_store(msg: EmailMessage, inbox: Inbox) -> Optional[str]:
+    # If new message, trigger agentic workflow (its deadline starts now that it is admitted)
+    final_state = await run_agent(msg, inbox)
+
+    # Do not respond to irrelevant emails, mark as read and attach dedicated label
+    if not final_state["is_relevant"]:
+        logger.warning(
+            "The agent marked the email message as not relevant, labeling it as such and not sending an automted reply..."
+        )
+        await outbox.enqueue_irrelevant(msg, inbox)
+        reply_text = None
+    else:
+        # For relevant emails, persist the reply to the original sender, it is sent by the outbox
+        reply_text = final_state["reply"]
+        conversation = final_state.get("conversation")
+        await outbox.enqueue_reply(
+            msg, reply_text, conversation.references if conversation else None, inbox
+        )
+
+    # The result is stored, the run no longer needs to be resumable
+    await discard_run(msg.id, inbox)
+    return reply_text
+
+
+async def _process_new_messages(inbox: InboxContext) -> None:
+    """
+    Processes all new messages of an inbox since its last processed history ID: runs the agent once per
+    thread with new messages on a page, sends the replies and checkpoints the history ID after every
+    fully processed page.
+
+    History pages are streamed into a bounded queue drained by a pool of message workers (sized by the
+    inbox's weight), so reading the next page waits while the workers are saturated. Once the admission
+    watermarks are exceeded, no further pages are read and the pass is deferred ('DeferredError').
+    """
+    last_processed_history_id = await inbox.state.get_last_history_id()
+    if last_processed_history_id is None:
+        logger.warning(
+            f"No last history ID found, the Gmail watch of {inbox.email} has not yet been set up."
+        )
+        return
+
+    messages: asyncio.Queue = asyncio.Queue(maxsize=CFG.history_queue_size)
+    tracker = _PageTracker(inbox.state)
+    errors: List[Exception] = []
+    inbox.failed_message_ids.clear()
+
+    async def worker() -> None:
+        # The Gmail client is not thread-safe, every worker uses its own
+        service = inbox.get_gmail_service()
+        while True:
+            item = await messages.get()
+            if item is None:
+                return
+
+            page_index, msg_ids = item
+            try:
+                await process_thread_messages(msg_ids, service, inbox)
+                await tracker.complete(page_index, len(msg_ids))
+            except asyncio.CancelledError:
+                # The pass was cancelled, the messages are left to the next one
+                for msg_id in msg_ids:
+                    await inbox.state.release_message(msg_id)
+                raise
+            except Exception as e:
+                logger.error(f"Failed to process messages {msg_ids}: {e}")
+                tracker.failed = True
+                errors.append(e)
+                if not isinstance(e, DeferredError):
+                    inbox.failed_message_ids.update(msg_ids)
+                for msg_id in msg_ids:
+                    await inbox.state.release_message(msg_id)
+
+    workers = [
+        asyncio.create_task(worker())
+        for _ in range(CFG.history_workers * inbox.inbox.weight)
+    ]
+    message_count = 0
+    deferred = False
+    unqueued: List[
+        List[str]
+    ] = []  # Claimed messages of the current page not handed to a worker yet
+    try:
+        async for page in iter_history_pages(
+            inbox.get_gmail_service(), last_processed_history_id, inbox.email
+        ):
+            if admission_controller.should_defer():
+                # Leave the page unclaimed in the history, it is read again by the deferred retry
+                deferred = True
+                break
+
+            # Perform message deduplication for the whole page at once (PubSub or Gmail push
+            # trigger seem to deliver multiple times), only the newly claimed IDs are processed
+            claimed = await inbox.state.claim_messages(page.message_ids)
+            page = page.model_copy(
+                update={"message_ids": [i for i in page.message_ids if i in claimed]}
+            )
+            page_index = tracker.add_page(page)
+            message_count += len(page.message_ids)
+            logger.info(
+                f"Found {len(page.message_ids)} new messages to process on history page {page_index}."
+            )
+
+            if not page.message_ids:
+                await tracker.complete()
+            # Follow-ups within the page are answered together with one reply per thread
+            unqueued = group_by_thread(page.message_ids, page.thread_ids)
+            while unqueued:
+                await messages.put((page_index, unqueued[0]))
+                unqueued.pop(0)
+
+            if errors:
+                break  # Stop reading further pages, the failed page is retried later
+
+    except HistoryExpiredError as e:
+        # The cursor is older than the history kept by Gmail, answer the unread backlog instead
+        logger.warning(f"{e} Falling back to a full catch-up of unread messages.")
+        from email_agent.services.catchup import catch_up_services
+
+        progress = await catch_up_services[inbox.email].run_exclusive()
+        if progress.status == "failed":
+            raise RuntimeError(f"Catch-up failed: {progress.error}") from e
+        return
+
+    except asyncio.CancelledError:
+        # Stop right away, the claims of the messages that were not answered are released
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        workers = []
+        while not messages.empty():
+            unqueued.append(messages.get_nowait()[1])
+        for msg_ids in unqueued:
+            for msg_id in msg_ids:
+                await inbox.state.release_message(msg_id)
+        raise
+
+    finally:
+        for _ in workers:
+            await messages.put(None)
+        await asyncio.gather(*workers)
+
+    if errors:
+        # A failure counts as an attempt of the notification, deferrals only if nothing failed
+        raise next((e for e in errors if not isinstance(e, DeferredError)), errors[0])
+
+    if deferred:
+        raise DeferredError(
+            f"History of {inbox.email} deferred after {message_count} new messages.",
+            CFG.admission_defer_delay_s,
+        )
+
+    if message_count == 0:
+        logger.info("No new UNREAD history records found since last check.")
+
+
+async def process_history_item(item: WorkItem, inbox: InboxContext) -> None:
+    """
+    Work queue handler of a Gmail push notification.
+    """
+    logger.info(
+        f"Processing history ID {item.payload['history_id']} of {inbox.email} (attempt {item.attempts})."
+    )
+    await process_history(item.payload["history_id"], inbox)
+
+
+async def skip_history_item(item: WorkItem, inbox: InboxContext) -> None:
+    """
+    Dead letter handler of a Gmail push notification that keeps failing.
+
+    The cursor is left alone, it must not skip unprocessed history. Instead, the messages that failed
+    in the last pass are claimed for good, so that the next pass skips them and advances past them.
+    """
+    failed = set(inbox.failed_message_ids)
+    if failed:
+        await inbox.state.claim_messages(failed)
+        logger.error(
+            f"Giving up on messages {sorted(failed)} of {inbox.email}, they are skipped from now on."
+        )
+    inbox.failed_message_ids.clear()
+
+
+# One work queue per inbox, each drained by its own workers, so a burst in one inbox
+# cannot starve the others (they only share the rate limits of the model calls)
+work_queues: Dict[str, WorkQueue] = {
+    inbox.email: WorkQueue(
+        backend=create_queue_backend(
+            collection=inbox.inbox.scoped_name(CFG.work_queue_collection),
+            sqlite_path=inbox.inbox.scoped_name(CFG.work_queue_sqlite_path),
+        ),
+        handler=partial(process_history_item, inbox=inbox),
+        on_dead_letter=partial(skip_history_item, inbox=inbox),
+    )
+    for inbox in inbox_registry.all()
+}
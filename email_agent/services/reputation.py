@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from google.cloud import firestore
+from email_agent.config import CFG
+from email_agent.models.reputation import SenderReputation
+from email_agent.services.firestore import db
+from email_agent.utils.logger import logger
+
+
+class ReputationService:
+    """
+    In-memory store of recent relevance outcomes per sender address and domain, written behind to Firestore.
+
+    Counts decay exponentially with a configurable half-life and entries expire after a TTL,
+    so that a sender's reputation can change over time. The outcomes recorded since the last flush
+    are merged into the stored entries in transactions, so that no instance overwrites another's.
+    The memory holds at most 'reputation_cache_size' entries (least recently used are evicted,
+    reloaded from Firestore when needed), expired entries are evicted on every flush.
+    """
+
+    def __init__(self):
+        self.db = db
+        self._entries: OrderedDict[str, SenderReputation] = OrderedDict()
+        # Outcomes recorded since the last flush, per key
+        self._pending: Dict[str, SenderReputation] = {}
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _doc_ref(self, key: str):
+        # Keys are raw addresses and domains, which may contain characters not allowed in document IDs
+        doc_id = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return self.db.collection(CFG.reputation_collection).document(doc_id)
+
+    def _remember(self, key: str, entry: SenderReputation) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > CFG.reputation_cache_size:
+            self._entries.popitem(last=False)
+
+    def _evict_expired(self, now: float) -> None:
+        for key in [
+            key
+            for key, entry in self._entries.items()
+            if self._is_expired(entry, now) and key not in self._pending
+        ]:
+            del self._entries[key]
+
+    @staticmethod
+    def _keys(sender_email: str) -> List[str]:
+        """
+        Returns the reputation keys of a sender: the address itself and its domain (unless it is a shared provider).
+        """
+        sender_email = sender_email.strip().lower()
+        keys = [sender_email]
+
+        domain = sender_email.rpartition("@")[2]
+        if domain and domain not in CFG.reputation_ignored_domains:
+            keys.append(f"@{domain}")
+
+        return keys
+
+    @staticmethod
+    def _decay(entry: SenderReputation, now: float) -> SenderReputation:
+        """
+        Applies the exponential decay accumulated since the entry was last updated.
+        """
+        elapsed_hours = max(now - entry.updated_at, 0.0) / 3600
+        factor = 0.5 ** (elapsed_hours / CFG.reputation_half_life_hours)
+        return SenderReputation(
+            key=entry.key,
+            relevant=entry.relevant * factor,
+            irrelevant=entry.irrelevant * factor,
+            updated_at=now,
+        )
+
+    @classmethod
+    def _merge(
+        cls, entry: SenderReputation, other: SenderReputation, now: float
+    ) -> SenderReputation:
+        """
+        Sums two entries of a key, both decayed to now.
+        """
+        entry, other = cls._decay(entry, now), cls._decay(other, now)
+        entry.relevant += other.relevant
+        entry.irrelevant += other.irrelevant
+        return entry
+
+    @staticmethod
+    def _is_expired(entry: SenderReputation, now: float) -> bool:
+        return now - entry.updated_at > CFG.reputation_ttl_days * 86400
+
+    async def get(self, key: str) -> Optional[SenderReputation]:
+        """
+        Returns the (decayed) reputation entry for a key, loading it from Firestore on a cache miss.
+        """
+        now = time.time()
+        entry = self._entries.get(key)
+
+        if entry is None:
+            try:
+                doc = await self._doc_ref(key).get()
+            except Exception as e:
+                logger.error(f"Error fetching reputation of {key}: {e}")
+                return None
+
+            if not doc.exists:
+                return None
+            # An outcome recorded while the document was being read is newer, keep it
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = SenderReputation(**{**doc.to_dict(), "key": key})
+                self._remember(key, entry)
+        else:
+            self._entries.move_to_end(key)
+
+        if self._is_expired(entry, now):
+            logger.info(f"Reputation of {key} expired, discarding it.")
+            await self.reset(key)
+            return None
+
+        return self._decay(entry, now)
+
+    async def decide(self, sender_email: str) -> Optional[bool]:
+        """
+        Returns the relevance implied by the sender's history, or None if the history is too short or inconsistent.
+        """
+        if not CFG.reputation_enabled:
+            return None
+
+        for key in self._keys(sender_email):
+            entry = await self.get(key)
+            if entry is None or entry.observations < CFG.reputation_min_observations:
+                continue
+
+            if entry.relevant / entry.observations >= CFG.reputation_consistency:
+                logger.info(f"Reputation of {key} is consistently relevant: {entry}")
+                return True
+            if entry.irrelevant / entry.observations >= CFG.reputation_consistency:
+                logger.info(f"Reputation of {key} is consistently irrelevant: {entry}")
+                return False
+
+        return None
+
+    async def record(self, sender_email: str, is_relevant: bool) -> None:
+        """
+        Records a relevance outcome for the sender address and its domain.
+        """
+        if not CFG.reputation_enabled:
+            return
+
+        for key in self._keys(sender_email):
+            # Loads the entry on a cache miss, the increment itself happens under the lock
+            await self.get(key)
+
+            async with self._lock:
+                now = time.time()
+                outcome = SenderReputation(
+                    key=key,
+                    relevant=1.0 if is_relevant else 0.0,
+                    irrelevant=0.0 if is_relevant else 1.0,
+                    updated_at=now,
+                )
+                entry = self._entries.get(key)
+                self._remember(
+                    key, self._merge(entry, outcome, now) if entry else outcome
+                )
+                pending = self._pending.get(key)
+                self._pending[key] = (
+                    self._merge(pending, outcome, now) if pending else outcome
+                )
+
+    async def list_entries(self) -> List[SenderReputation]:
+        """
+        Returns all reputation entries currently held in memory.
+        """
+        now = time.time()
+        return [
+            self._decay(entry, now)
+            for entry in self._entries.values()
+            if not self._is_expired(entry, now)
+        ]
+
+    async def reset(self, key: str) -> None:
+        """
+        Removes a reputation entry from memory and Firestore.
+        """
+        async with self._lock:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+
+        await self._doc_ref(key).delete()
+
+    async def _flush_entry(self, pending: SenderReputation) -> None:
+        """
+        Merges the outcomes recorded since the last flush into the stored entry of their key.
+        """
+
+        @firestore.async_transactional
+        async def merge_in_transaction(transaction: firestore.AsyncTransaction):
+            doc_ref = self._doc_ref(pending.key)
+            doc = await doc_ref.get(transaction=transaction)
+            now = time.time()
+            entry = pending
+            if doc.exists:
+                stored = SenderReputation(**{**doc.to_dict(), "key": pending.key})
+                if not self._is_expired(stored, now):
+                    entry = self._merge(stored, pending, now)
+            transaction.set(doc_ref, entry.model_dump())
+            return entry
+
+        merged = await merge_in_transaction(self.db.transaction())
+
+        # The stored entry includes the outcomes of other instances
+        async with self._lock:
+            pending = self._pending.get(merged.key)
+            self._remember(
+                merged.key,
+                self._merge(merged, pending, time.time()) if pending else merged,
+            )
+
+    async def flush(self) -> None:
+        """
+        Writes the outcomes recorded since the last flush to Firestore, one transaction per key.
+        """
+        async with self._lock:
+            entries, self._pending = list(self._pending.values()), {}
+            self._evict_expired(time.time())
+
+        if not entries:
+            return
+
+        results = await asyncio.gather(
+            *(self._flush_entry(entry) for entry in entries), return_exceptions=True
+        )
+        failed = [
+            entry
+            for entry, result in zip(entries, results)
+            if isinstance(result, Exception)
+        ]
+        logger.info(
+            f"Flushed {len(entries) - len(failed)} reputation entries to Firestore."
+        )
+
+        if failed:
+            logger.error(
+                f"Error flushing {len(failed)} reputation entries: "
+                f"{next(r for r in results if isinstance(r, Exception))}"
+            )
+            # Retried by the next flush, together with the outcomes recorded since
+            async with self._lock:
+                now = time.time()
+                for entry in failed:
+                    pending = self._pending.get(entry.key)
+                    self._pending[entry.key] = (
+                        self._merge(entry, pending, now) if pending else entry
+                    )
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(CFG.reputation_flush_interval_seconds)
+            await self.flush()
+
+    def start(self) -> None:
+        """
+        Starts the periodic write-behind of modified entries.
+        """
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic write-behind and flushes the remaining modified entries.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+
+reputation_service = ReputationService()
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from typing import Dict, List, Literal, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from pydantic import BaseModel
+from email_agent.config import CFG
+from email_agent.services.chunker import count_tokens
+from email_agent.utils.logger import logger
+
+
+# Stages of a retrieval with re-ranking, in order
+Stage = Literal["embed", "search", "fetch", "rerank", "dedupe", "budget"]
+STAGES: List[Stage] = ["embed", "search", "fetch", "rerank", "dedupe", "budget"]
+
+cross_encoder = None
+
+
+def get_cross_encoder():
+    """
+    Returns the local ONNX cross-encoder of the re-ranking (loaded once).
+    """
+    global cross_encoder
+
+    if cross_encoder is None:
+        from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+        cross_encoder = TextCrossEncoder(
+            model_name=CFG.rerank_model_name, threads=CFG.rerank_threads
+        )
+        logger.info(f"Cross-encoder {CFG.rerank_model_name} loaded.")
+
+    return cross_encoder
+
+
+def score_passages(query: str, passages: List[str]) -> Tuple[List[float], List[int]]:
+    """
+    Scores the relevance of every passage to the query in batches and counts its tokens for the budget
+    (blocking, to be run in a worker thread: the first call loads the cross-encoder and the tokenizer).
+    """
+    scores = list(
+        get_cross_encoder().rerank(query, passages, batch_size=CFG.rerank_batch_size)
+    )
+    return scores, [count_tokens(passage) for passage in passages]
+
+
+class StageStats(BaseModel):
+    """Aggregated latency of one retrieval stage."""
+
+    calls: int = 0
+    total_latency_s: float = 0.0
+    max_latency_s: float = 0.0
+
+    @property
+    def avg_latency_s(self) -> float:
+        return self.total_latency_s / self.calls if self.calls else 0.0
+
+
+class PassageReranker:
+    """
+    Post-retrieval stage: re-ranks the over-fetched passages with a cross-encoder, drops near-duplicates
+    and keeps the best ones within a token budget. Records the latency of every retrieval stage.
+    """
+
+    def __init__(self):
+        self._stats: Dict[Stage, StageStats] = {stage: StageStats() for stage in STAGES}
+
+    def record_stage(self, stage: Stage, latency_s: float) -> None:
+        stats = self._stats[stage]
+        stats.calls += 1
+        stats.total_latency_s += latency_s
+        stats.max_latency_s = max(stats.max_latency_s, latency_s)
+
+    async def rerank(self, query: str, passages: List[Document]) -> List[Document]:
+        """
+        Returns the passages to be used for the query, best first.
+
+        Every passage carries its embedding in the 'vector' metadata (normalized, as returned by the index),
+        the cross-encoder score is added as 'rerank_score' and the token count as 'tokens'.
+        """
+        if not passages:
+            return []
+
+        start = time.perf_counter()
+        scores, token_counts = await asyncio.to_thread(
+            score_passages, query, [passage.page_content for passage in passages]
+        )
+        for passage, score, tokens in zip(passages, scores, token_counts):
+            passage.metadata["rerank_score"] = float(score)
+            passage.metadata["tokens"] = tokens
+        ranked = sorted(
+            passages, key=lambda passage: passage.metadata["rerank_score"], reverse=True
+        )
+        self.record_stage("rerank", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        unique = self._drop_duplicates(ranked)
+        self.record_stage("dedupe", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        selected = self._within_budget(unique)
+        self.record_stage("budget", time.perf_counter() - start)
+
+        logger.info(
+            f"Re-ranked {len(passages)} passages: {len(ranked) - len(unique)} near-duplicates dropped, "
+            f"{len(selected)} kept within {CFG.rerank_token_budget} tokens."
+        )
+        return selected
+
+    @staticmethod
+    def _drop_duplicates(ranked: List[Document]) -> List[Document]:
+        """
+        Drops every passage too similar to a better ranked one that is kept.
+        """
+        kept: List[Document] = []
+        kept_vectors: List[np.ndarray] = []
+        for passage in ranked:
+            vector = np.asarray(passage.metadata["vector"], dtype=np.float32)
+            if any(
+                float(vector @ other) >= CFG.rerank_duplicate_similarity
+                for other in kept_vectors
+            ):
+                continue
+            kept.append(passage)
+            kept_vectors.append(vector)
+
+        return kept
+
+    @staticmethod
+    def _within_budget(ranked: List[Document]) -> List[Document]:
+        """
+        Keeps the best passages up to 'rerank_top_n' while they fit into the token budget,
+        the best passage is always kept.
+        """
+        selected: List[Document] = []
+        tokens = 0
+        for passage in ranked[: CFG.rerank_top_n]:
+            passage_tokens = passage.metadata["tokens"]
+            if selected and tokens + passage_tokens > CFG.rerank_token_budget:
+                break
+            selected.append(passage)
+            tokens += passage_tokens
+
+        return selected
+
+    def stats(self) -> dict:
+        """
+        Returns the calls, average and maximum latency of every retrieval stage.
+        """
+        return {
+            "enabled": CFG.rerank_enabled,
+            "stages": {
+                stage: {**stats.model_dump(), "avg_latency_s": stats.avg_latency_s}
+                for stage, stats in self._stats.items()
+            },
+        }
+
+
+passage_reranker = PassageReranker()
@@ -0,0 +1,436 @@
+import asyncio
+import json
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, List, Optional
+from email_agent.config import CFG
+from email_agent.models.queue import WorkItem
+from email_agent.utils.logger import logger
+
+
+class DeferredError(Exception):
+    """Raised by a work item handler to retry the item later, without counting it as a failure."""
+
+    def __init__(self, message: str, delay_s: float):
+        super().__init__(message)
+        self.delay_s = delay_s
+
+
+class QueueBackend(ABC):
+    """
+    Durable storage of queued work items.
+
+    Claimed items are leased (hidden) until 'available_at' passes, so items that were in flight
+    when an instance stopped become claimable again once their lease expires.
+    """
+
+    @abstractmethod
+    async def put(self, item_id: str, payload: dict) -> bool:
+        """Stores an item (idempotent per 'item_id'), returns False if the queue is full."""
+
+    @abstractmethod
+    async def claim(self, limit: int, lease_s: float) -> List[WorkItem]:
+        """Leases up to 'limit' available items."""
+
+    @abstractmethod
+    async def ack(self, item_id: str) -> None:
+        """Removes a successfully processed item."""
+
+    @abstractmethod
+    async def complete(self, item_id: str, ttl_s: float) -> None:
+        """
+        Keeps a successfully processed item as a tombstone for 'ttl_s', so that putting
+        the same 'item_id' again is ignored until then.
+        """
+
+    @abstractmethod
+    async def nack(
+        self,
+        item_id: str,
+        delay_s: float,
+        payload: Optional[dict] = None,
+        count_attempt: bool = True,
+    ) -> None:
+        """
+        Makes a failed item available again after a delay, optionally updating its payload.
+        Without 'count_attempt', the claim is counted as a deferral instead of an attempt.
+        """
+
+    @abstractmethod
+    async def size(self) -> int:
+        """Returns the number of queued (including leased) items, tombstones excluded."""
+
+
+class SQLiteQueueBackend(QueueBackend):
+    """
+    Queue backend for local development, stored in a SQLite file.
+    """
+
+    def __init__(self, path: str = CFG.work_queue_sqlite_path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # The file is created on first use, not when the app (or a script) imports the queue
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS work_items (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL
+            )
+            """
+        )
+        try:
+            # Files created before tombstones were kept
+            conn.execute(
+                "ALTER TABLE work_items ADD COLUMN done INTEGER NOT NULL DEFAULT 0"
+            )
+        except sqlite3.OperationalError:
+            pass  # The column exists already
+        try:
+            # Files created before deferrals were counted
+            conn.execute(
+                "ALTER TABLE work_items ADD COLUMN deferrals INTEGER NOT NULL DEFAULT 0"
+            )
+        except sqlite3.OperationalError:
+            pass
+        conn.commit()
+        return conn
+
+    async def _execute(self, fn: Callable[[sqlite3.Connection], object]):
+        async with self._lock:
+            if self._conn is None:
+                self._conn = await asyncio.to_thread(self._connect)
+            return await asyncio.to_thread(fn, self._conn)
+
+    async def put(self, item_id: str, payload: dict) -> bool:
+        def _put(conn: sqlite3.Connection) -> bool:
+            conn.execute(
+                "DELETE FROM work_items WHERE done = 1 AND available_at <= ?",
+                (time.time(),),
+            )
+            (count,) = conn.execute(
+                "SELECT COUNT(*) FROM work_items WHERE done = 0"
+            ).fetchone()
+            if count >= CFG.work_queue_max_size:
+                return False
+            conn.execute(
+                "INSERT OR IGNORE INTO work_items (id, payload, available_at) VALUES (?, ?, ?)",
+                (item_id, json.dumps(payload), time.time()),
+            )
+            conn.commit()
+            return True
+
+        return await self._execute(_put)
+
+    async def claim(self, limit: int, lease_s: float) -> List[WorkItem]:
+        def _claim(conn: sqlite3.Connection) -> List[WorkItem]:
+            now = time.time()
+            rows = conn.execute(
+                "SELECT id, payload, attempts, deferrals FROM work_items WHERE done = 0 AND available_at <= ? ORDER BY available_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE work_items SET available_at = ?, attempts = attempts + 1 WHERE id = ?",
+                [(now + lease_s, row[0]) for row in rows],
+            )
+            conn.commit()
+            return [
+                WorkItem(
+                    id=row[0],
+                    payload=json.loads(row[1]),
+                    attempts=row[2] + 1,
+                    deferrals=row[3],
+                )
+                for row in rows
+            ]
+
+        return await self._execute(_claim)
+
+    async def ack(self, item_id: str) -> None:
+        def _ack(conn: sqlite3.Connection) -> None:
+            conn.execute("DELETE FROM work_items WHERE id = ?", (item_id,))
+            conn.commit()
+
+        await self._execute(_ack)
+
+    async def complete(self, item_id: str, ttl_s: float) -> None:
+        def _complete(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "UPDATE work_items SET done = 1, available_at = ? WHERE id = ?",
+                (time.time() + ttl_s, item_id),
+            )
+            conn.commit()
+
+        await self._execute(_complete)
+
+    async def nack(
+        self,
+        item_id: str,
+        delay_s: float,
+        payload: Optional[dict] = None,
+        count_attempt: bool = True,
+    ) -> None:
+        def _nack(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "UPDATE work_items SET available_at = ?, attempts = attempts - ?, deferrals = deferrals + ? WHERE id = ?",
+                (
+                    time.time() + delay_s,
+                    0 if count_attempt else 1,
+                    0 if count_attempt else 1,
+                    item_id,
+                ),
+            )
+            if payload is not None:
+                conn.execute(
+                    "UPDATE work_items SET payload = ? WHERE id = ?",
+                    (json.dumps(payload), item_id),
+                )
+            conn.commit()
+
+        await self._execute(_nack)
+
+    async def size(self) -> int:
+        def _size(conn: sqlite3.Connection) -> int:
+            return conn.execute(
+                "SELECT COUNT(*) FROM work_items WHERE done = 0"
+            ).fetchone()[0]
+
+        return await self._execute(_size)
+
+
+class FirestoreQueueBackend(QueueBackend):
+    """
+    Queue backend for production, stored in a Firestore collection shared by all instances.
+    """
+
+    def __init__(self, collection: str = CFG.work_queue_collection):
+        from email_agent.services.firestore import db
+
+        self.db = db
+        self.collection = db.collection(collection)
+
+    async def put(self, item_id: str, payload: dict) -> bool:
+        from google.api_core.exceptions import AlreadyExists
+
+        if await self.size() >= CFG.work_queue_max_size:
+            return False
+
+        try:
+            await self.collection.document(item_id).create(
+                {"payload": payload, "attempts": 0, "available_at": time.time()}
+            )
+        except AlreadyExists:
+            logger.info(f"Work item {item_id} is already queued (or was processed).")
+
+        return True
+
+    async def claim(self, limit: int, lease_s: float) -> List[WorkItem]:
+        from google.cloud import firestore
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        now = time.time()
+        candidates = (
+            self.collection.where(filter=FieldFilter("available_at", "<=", now))
+            .order_by("available_at")
+            .limit(limit)
+        )
+
+        @firestore.async_transactional
+        async def lease_in_transaction(transaction, doc_ref) -> Optional[WorkItem]:
+            doc = await doc_ref.get(transaction=transaction)
+            data = doc.to_dict() if doc.exists else None
+            if data is None or data["available_at"] > time.time():
+                return None  # Claimed by another instance in the meantime
+            if data.get("done"):
+                transaction.delete(doc_ref)  # Expired tombstone
+                return None
+
+            attempts = data.get("attempts", 0) + 1
+            transaction.update(
+                doc_ref, {"available_at": now + lease_s, "attempts": attempts}
+            )
+            return WorkItem(
+                id=doc.id,
+                payload=data["payload"],
+                attempts=attempts,
+                deferrals=data.get("deferrals", 0),
+            )
+
+        items = []
+        async for doc in candidates.stream():
+            item = await lease_in_transaction(self.db.transaction(), doc.reference)
+            if item is not None:
+                items.append(item)
+
+        return items
+
+    async def ack(self, item_id: str) -> None:
+        await self.collection.document(item_id).delete()
+
+    async def complete(self, item_id: str, ttl_s: float) -> None:
+        await self.collection.document(item_id).update(
+            {"done": True, "available_at": time.time() + ttl_s}
+        )
+
+    async def nack(
+        self,
+        item_id: str,
+        delay_s: float,
+        payload: Optional[dict] = None,
+        count_attempt: bool = True,
+    ) -> None:
+        from google.cloud import firestore
+
+        update = {"available_at": time.time() + delay_s}
+        if payload is not None:
+            update["payload"] = payload
+        if not count_attempt:
+            update["attempts"] = firestore.Increment(-1)
+            update["deferrals"] = firestore.Increment(1)
+        await self.collection.document(item_id).update(update)
+
+    async def size(self) -> int:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        total = await self.collection.count().get()
+        tombstones = (
+            await self.collection.where(filter=FieldFilter("done", "==", True))
+            .count()
+            .get()
+        )
+        return int(total[0][0].value) - int(tombstones[0][0].value)
+
+
+Handler = Callable[[WorkItem], Awaitable[None]]
+
+
+class WorkQueue:
+    """
+    Bounded, durable work queue drained by a pool of background workers inside the app.
+    """
+
+    def __init__(
+        self,
+        backend: QueueBackend,
+        handler: Handler,
+        on_dead_letter: Optional[Handler] = None,
+    ):
+        self.backend = backend
+        self.handler = handler
+        self.on_dead_letter = on_dead_letter
+        self._workers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    async def enqueue(self, item_id: str, payload: dict) -> bool:
+        """
+        Durably enqueues an item, returns False if the queue is at capacity.
+        """
+        accepted = await self.backend.put(item_id, payload)
+        if accepted:
+            self._wakeup.set()
+        else:
+            logger.warning(f"Work queue is full, rejecting item {item_id}.")
+        return accepted
+
+    async def _process(self, item: WorkItem) -> None:
+        try:
+            await self.handler(item)
+            await self.backend.ack(item.id)
+
+        except DeferredError as e:
+            if item.deferrals < CFG.work_queue_max_deferrals:
+                logger.info(f"Work item {item.id} deferred for {e.delay_s}s: {e}")
+                await self.backend.nack(item.id, e.delay_s, count_attempt=False)
+            else:
+                # Deferred too often, further deferrals count as attempts
+                await self._fail(item, e)
+
+        except Exception as e:
+            await self._fail(item, e)
+
+    async def _fail(self, item: WorkItem, e: Exception) -> None:
+        """
+        Retries a failed item with an exponential backoff, or gives it up after the maximum attempts.
+        """
+        if item.attempts >= CFG.work_queue_max_attempts:
+            logger.error(
+                f"Work item {item.id} failed {item.attempts} times, giving up: {e}"
+            )
+            if self.on_dead_letter:
+                await self.on_dead_letter(item)
+            await self.backend.ack(item.id)
+        else:
+            delay = CFG.work_queue_retry_delay_s * 2 ** (item.attempts - 1)
+            logger.error(
+                f"Work item {item.id} failed (attempt {item.attempts}), retrying in {delay}s: {e}"
+            )
+            await self.backend.nack(item.id, delay)
+
+    async def _worker(self, worker_id: int) -> None:
+        while not self._stopping:
+            try:
+                items = await self.backend.claim(1, CFG.work_queue_lease_s)
+            except Exception as e:
+                logger.error(f"Worker {worker_id} failed to claim work: {e}")
+                items = []
+
+            if not items:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), CFG.work_queue_poll_interval_s
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for item in items:
+                await self._process(item)
+
+    def start(self, workers: int = CFG.work_queue_workers) -> None:
+        """
+        Starts the worker pool.
+        """
+        self._stopping = False
+        self._workers = [
+            asyncio.create_task(self._worker(worker_id)) for worker_id in range(workers)
+        ]
+        logger.info(f"Started {workers} work queue workers.")
+
+    async def stop(self, timeout_s: float = CFG.work_queue_shutdown_timeout_s) -> None:
+        """
+        Stops claiming new work and waits for in-flight items to finish. Items still running
+        after the timeout are cancelled, they keep their lease and are retried after it expires.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if not self._workers:
+            return
+
+        _, pending = await asyncio.wait(self._workers, timeout=timeout_s)
+        for task in pending:
+            task.cancel()
+
+        logger.info(
+            f"Work queue stopped ({len(pending)} in-flight items left for redelivery)."
+        )
+        self._workers = []
+
+
+def create_queue_backend(
+    collection: str = CFG.work_queue_collection,
+    sqlite_path: str = CFG.work_queue_sqlite_path,
+) -> QueueBackend:
+    """
+    Creates the queue backend selected in the config.
+    """
+    if CFG.work_queue_backend == "firestore":
+        return FirestoreQueueBackend(collection)
+    return SQLiteQueueBackend(sqlite_path)
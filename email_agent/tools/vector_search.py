@@ -1,12 +1,15 @@
+import asyncio
+import time
 from langchain.tools import tool
-from typing import List
+from typing import List, Optional, Tuple
 from email_agent.utils.logger import logger
 from email_agent.config import CFG
-from email_agent.services.ingestion import embedding_model
+from email_agent.services.limiter import Priority, vector_search_limiter
+from email_agent.services.embeddings import embed_texts
+from email_agent.services.manifest import chunk_store
+from email_agent.services.reranker import passage_reranker
 from langchain_core.documents import Document
 from google.cloud import aiplatform
-from fastembed import TextEmbedding
-from fastembed.common.model_description import PoolingType, ModelSource
 from google.cloud import storage
 
 
@@ -25,7 +28,8 @@ def get_gcs_file_content(gcs_path):
             storage_client = storage.Client()
 
         bucket = storage_client.bucket(CFG.bucket_name)
-        blob_name = gcs_path.split(CFG.bucket_name + "/")[-1]
+        # Datapoint IDs of chunks carry the chunk hash as the URI fragment
+        blob_name = gcs_path.partition("#")[0].split(CFG.bucket_name + "/")[-1]
         blob = bucket.blob(blob_name)
         content = blob.download_as_text(encoding="utf-8")
 
@@ -50,61 +54,48 @@ def init_retriever():
         logger.error(f"Error initializing Vertex AI Search Retriever: {e}")
 
 
-def init_model():
-    global embedding_model
-    logger.info("Initializing embedding model.")
-    try:
-        TextEmbedding.add_custom_model(
-            model=CFG.embedding_model_name,
-            pooling=PoolingType.MEAN,
-            normalization=True,
-            sources=ModelSource(hf=CFG.embedding_model_name),
-            dim=CFG.vector_dimensions,
-            model_file="onnx/model.onnx",
-        )
-
-        embedding_model = embedding_model = TextEmbedding(
-            model_name=CFG.embedding_model_name
-        )
-
-    except Exception as e:
-        logger.error(f"Error initializing Vertex AI Search Retriever: {e}")
-
-
 def get_query_embedding(text: str) -> List[float]:
     """
     Converts a string of text into a vector embedding.
     """
-    global embedding_model
-    if not embedding_model:
-        init_model()
-
-    embeddings = embedding_model.embed([text])
-    return list(embeddings)[0]
+    return embed_texts([text], "query")[0]
 
 
 async def retrieve_context(
     query: str,
+    num_neighbors: Optional[int] = None,
+    return_full_datapoint: bool = False,
 ) -> List[Document]:
     """
-    Uses the embedding of the query string to search for nearest neighbours in the vector search index.
+    Uses the embedding of the query string to search for nearest neighbours in the vector search index
+    ('retriever_k' by default, with their embeddings if 'return_full_datapoint').
     """
     global index_endpoint
 
     if not index_endpoint:
         init_retriever()
 
-    logger.info(
-        f"Retrieving context for query: '{query[:50]}...' (k={CFG.retriever_k})"
-    )
+    num_neighbors = num_neighbors or CFG.retriever_k
+    logger.info(f"Retrieving context for query: '{query[:50]}...' (k={num_neighbors})")
     try:
-        query_vector = get_query_embedding(query)
-
-        retrieved_docs = index_endpoint.find_neighbors(
-            deployed_index_id=CFG.index_name,
-            queries=[query_vector],
-            num_neighbors=CFG.retriever_k,
-        )[0]
+        start = time.perf_counter()
+        # Inference blocks, so it runs in a worker thread instead of the event loop
+        query_vector = await asyncio.to_thread(get_query_embedding, query)
+        passage_reranker.record_stage("embed", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        neighbors = await vector_search_limiter.run(
+            lambda: asyncio.to_thread(
+                index_endpoint.find_neighbors,
+                deployed_index_id=CFG.index_name,
+                queries=[query_vector],
+                num_neighbors=num_neighbors,
+                return_full_datapoint=return_full_datapoint,
+            ),
+            priority=Priority.REPLY,
+        )
+        passage_reranker.record_stage("search", time.perf_counter() - start)
+        retrieved_docs = neighbors[0]
 
         logger.info(f"Retrieved {len(retrieved_docs)} documents.")
         return retrieved_docs
@@ -114,8 +105,62 @@ async def retrieve_context(
         return []
 
 
-@tool("knowledge_base_search")
-async def knowledge_base_search(query: str) -> str:
+async def load_passages(neighbors) -> List[Document]:
+    """
+    Looks up the texts of the retrieved chunks, stored by datapoint ID at ingestion time
+    (the index only keeps the IDs and embeddings).
+    """
+    texts = await chunk_store.get_texts(list(dict.fromkeys(n.id for n in neighbors)))
+
+    passages = []
+    for neighbor in neighbors:
+        text = texts.get(neighbor.id)
+        if text is None:
+            # The datapoint was ingested before the chunk texts were stored
+            logger.warning(f"Text of chunk {neighbor.id} not found.")
+            continue
+
+        passages.append(
+            Document(
+                id=neighbor.id,
+                page_content=text,
+                metadata={
+                    "source": neighbor.id.partition("#")[0],
+                    "similarity": neighbor.distance,
+                    "vector": neighbor.feature_vector,
+                },
+            )
+        )
+
+    return passages
+
+
+async def search_reranked(query: str) -> Tuple[str, List[float]]:
+    """
+    Over-fetches 'rerank_candidates' chunks and returns the passages kept by the re-ranking.
+    """
+    neighbors = await retrieve_context(
+        query, CFG.rerank_candidates, return_full_datapoint=True
+    )
+
+    start = time.perf_counter()
+    passages = await load_passages(neighbors)
+    passage_reranker.record_stage("fetch", time.perf_counter() - start)
+
+    passages = await passage_reranker.rerank(query, passages)
+
+    formatted_results = [
+        f"--- Document {i + 1} ---\nID: {passage.id}\nContent: {passage.page_content}\n"
+        for i, passage in enumerate(passages)
+    ]
+    # The routing compares the similarity of the index, the cross-encoder scores are not calibrated
+    scores = [passage.metadata["similarity"] for passage in passages]
+
+    return "\n".join(formatted_results), scores
+
+
+@tool("knowledge_base_search", response_format="content_and_artifact")
+async def knowledge_base_search(query: str) -> Tuple[str, List[float]]:
     """
     Searches the corporate knowledge base/Vector Search index for information
     relevant to the user's email inquiry. The knowledge base contains product
@@ -123,8 +168,17 @@ async def knowledge_base_search(query: str) -> str:
 
     The input query MUST be a single, well-formed question derived from the email.
     """
+    if CFG.rerank_enabled:
+        return await search_reranked(query)
+
     retrieved_docs = await retrieve_context(query)
 
+    # Several chunks of one document may match, the document is included once (best match first)
+    unique_docs = {}
+    for doc in retrieved_docs:
+        unique_docs.setdefault(doc.id.partition("#")[0], doc)
+    retrieved_docs = list(unique_docs.values())
+
     logger.info(f"retrieved docs: {retrieved_docs}")
 
     formatted_results = []
@@ -134,4 +188,7 @@ async def knowledge_base_search(query: str) -> str:
             f"--- Document {i + 1} ---\nID: {doc.id}\nContent: {content}\n"
         )
 
-    return "\n".join(formatted_results)
+    # The neighbour 'distance' of the cosine index is reported as a similarity (higher is better)
+    scores = [doc.distance for doc in retrieved_docs]
+
+    return "\n".join(formatted_results), scores
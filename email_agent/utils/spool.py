@@ -0,0 +1,136 @@
+import base64
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import IO, Iterator
+from email_agent.config import CFG
+
+
+# Base64 characters decoded at once (a multiple of 4, i.e. 768 KiB of decoded bytes)
+DECODE_CHUNK_CHARS = 1024 * 1024
+
+
+class AttachmentBudgetError(Exception):
+    """Raised when an attachment does not fit into the per-message or per-process byte cap."""
+
+
+class _ProcessBudget:
+    """
+    Bytes of attachment contents held by this process (in memory or spooled to disk).
+    """
+
+    def __init__(self):
+        self.used = 0
+        self._lock = threading.Lock()  # Attachments are decoded in worker threads
+
+    def reserve(self, size: int) -> None:
+        with self._lock:
+            if self.used + size > CFG.attachment_max_process_bytes:
+                raise AttachmentBudgetError(
+                    f"{size} attachment bytes exceed the process cap ({self.used} bytes held)."
+                )
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self._lock:
+            self.used -= size
+
+
+process_budget = _ProcessBudget()
+
+
+class AttachmentContent:
+    """
+    Lazily accessed attachment contents.
+
+    The base64 payload from the Gmail API is decoded in chunks into a spooled temporary file, which is
+    kept in memory up to 'attachment_spool_threshold_bytes' and rolled over to disk beyond that. Readers
+    get a memoryview (of the in-memory buffer or of a read-only mmap) or a file object instead of copies
+    of the bytes. The reserved bytes are returned to the process budget once the contents are closed.
+    """
+
+    def __init__(self, size: int):
+        process_budget.reserve(size)
+        self.size = size
+        self._file = tempfile.SpooledTemporaryFile(
+            max_size=CFG.attachment_spool_threshold_bytes
+        )
+        self._closed = False
+
+    @classmethod
+    def from_base64(cls, data: str, size: int) -> "AttachmentContent":
+        """
+        Decodes a URL-safe base64 payload chunk by chunk ('size' is the announced decoded size).
+        """
+        content = cls(size)
+        try:
+            for start in range(0, len(data), DECODE_CHUNK_CHARS):
+                chunk = data[start : start + DECODE_CHUNK_CHARS]
+                # Gmail may omit the padding of the last chunk
+                content._file.write(
+                    base64.urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4))
+                )
+        except Exception:
+            content.close()
+            raise
+        return content
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "AttachmentContent":
+        content = cls(len(data))
+        content._file.write(data)
+        return content
+
+    @property
+    def is_spooled_to_disk(self) -> bool:
+        return bool(getattr(self._file, "_rolled", False))
+
+    @contextmanager
+    def view(self) -> Iterator[memoryview]:
+        """
+        Yields a read-only memoryview of the contents, valid within the block.
+        """
+        self._file.flush()
+        if not self.is_spooled_to_disk:
+            with self._file._file.getbuffer() as buffer:
+                with buffer.toreadonly() as readonly:
+                    yield readonly
+            return
+
+        if os.fstat(self._file.fileno()).st_size == 0:
+            yield memoryview(b"")  # Empty files cannot be mapped
+            return
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as buffer:
+                yield buffer
+
+    @contextmanager
+    def stream(self) -> Iterator[IO[bytes]]:
+        """
+        Yields a file object positioned at the start of the contents (for readers taking a stream).
+        """
+        self._file.seek(0)
+        yield self._file
+        self._file.seek(0, 2)
+
+    def read(self) -> bytes:
+        """
+        Returns a copy of the contents, for APIs that only accept 'bytes'.
+        """
+        with self.view() as buffer:
+            return bytes(buffer)
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._file.close()
+            process_budget.release(self.size)
+
+    def __del__(self):
+        if hasattr(self, "_closed"):  # Not set if the reservation failed
+            self.close()
+
+    def __repr__(self) -> str:
+        return f"AttachmentContent(size={self.size}, on_disk={self.is_spooled_to_disk})"
@@ -88,9 +88,14 @@ resource "google_cloud_run_v2_service" "agent_service" {
         name  = "INDEX_ID"
         value = google_vertex_ai_index.vector_index.id
       }
+      env {
+        name  = "WORK_QUEUE_BACKEND"
+        value = "firestore"
+      }
       
       resources {
-        cpu_idle = true
+        # Emails are processed by background workers after the webhook responds, which needs CPU outside of requests
+        cpu_idle = false
         limits = {
           cpu    = "2"
           memory = "4Gi"
@@ -129,4 +134,36 @@ resource "google_cloud_scheduler_job" "watch_renewal_job" {
       service_account_email = google_service_account.scheduler_sa.email
     }
   }
-}
\ No newline at end of file
+}
+
+# Expire message deduplication claims via the 'expires_at' timestamp
+resource "google_firestore_field" "processed_messages_ttl" {
+  project    = var.project_id
+  database   = data.terraform_remote_state.base.outputs.firestore_database_name
+  collection = "processed_messages"
+  field      = "expires_at"
+
+  ttl_config {}
+  index_config {}
+}
+
+resource "google_firestore_field" "agent_checkpoints_ttl" {
+  project    = var.project_id
+  database   = data.terraform_remote_state.base.outputs.firestore_database_name
+  collection = "agent_checkpoints"
+  field      = "expires_at"
+
+  ttl_config {}
+  index_config {}
+}
+
+# Parts of the large checkpoint values (subcollection of every checkpoint document)
+resource "google_firestore_field" "checkpoint_blobs_ttl" {
+  project    = var.project_id
+  database   = data.terraform_remote_state.base.outputs.firestore_database_name
+  collection = "checkpoint_blobs"
+  field      = "expires_at"
+
+  ttl_config {}
+  index_config {}
+}
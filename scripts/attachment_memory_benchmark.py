@@ -0,0 +1,92 @@
+# Measures the peak RSS per concurrently processed email with a large attachment, comparing the former
+# handling (attachment decoded into 'bytes', read through an 'io.BytesIO' copy) with the spooled
+# 'AttachmentContent' handles. Every mode runs in a fresh subprocess, so that the peaks do not mix.
+#
+# Usage: uv run python scripts/attachment_memory_benchmark.py --emails 4 --size-mb 25
+# (needs the usual app environment variables, e.g. USER_EMAIL, for the config to load)
+
+import argparse
+import base64
+import io
+import os
+import resource
+import subprocess
+import sys
+import threading
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def _gmail_response(size: int) -> dict:
+    # The Gmail client returns the attachment as a URL-safe base64 string in a JSON response
+    return {
+        "data": base64.urlsafe_b64encode(os.urandom(3)).decode("ascii") * (size // 3)
+    }
+
+
+def _process_bytes(size: int, held: list, barrier: threading.Barrier) -> None:
+    response = _gmail_response(size)
+    data = base64.urlsafe_b64decode(response["data"])
+    stream = io.BytesIO(data)  # As the PDF extraction did
+    held.append((response, data, stream))
+    barrier.wait()  # All emails are in flight at once
+
+
+def _process_spooled(size: int, held: list, barrier: threading.Barrier) -> None:
+    from email_agent.utils.spool import AttachmentContent
+
+    response = _gmail_response(size)
+    content = AttachmentContent.from_base64(response.pop("data"), size)
+    with content.stream() as stream:
+        while stream.read(1024 * 1024):
+            pass
+    held.append(content)
+    barrier.wait()
+
+
+def run_mode(mode: str, emails: int, size: int) -> None:
+    if mode == "spooled":
+        import email_agent.utils.spool  # noqa: F401, imported before the baseline
+
+    baseline = _peak_rss_mb()
+    held: list = []
+    barrier = threading.Barrier(emails)
+    target = _process_spooled if mode == "spooled" else _process_bytes
+    threads = [
+        threading.Thread(target=target, args=(size, held, barrier))
+        for _ in range(emails)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    peak = _peak_rss_mb() - baseline
+    print(f"{mode:8s} peak RSS +{peak:8.1f} MB, {peak / emails:7.1f} MB per email")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=4)
+    parser.add_argument("--size-mb", type=float, default=25)
+    parser.add_argument("--mode", choices=["bytes", "spooled"])
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+
+    if args.mode:
+        run_mode(args.mode, args.emails, size)
+        return
+
+    print(f"{args.emails} concurrent emails with a {args.size_mb} MB attachment each")
+    for mode in ("bytes", "spooled"):
+        subprocess.run(
+            [sys.executable, __file__, "--mode", mode]
+            + ["--emails", str(args.emails), "--size-mb", str(args.size_mb)],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Reports the prompt tokens of email bodies before and after the body normalization on a sample corpus
+# of .eml files: the former extraction (text/plain parts only, decoded as UTF-8) against the current one
+# (HTML fallback, charset handling, quoted history and signature stripping). The body is part of both
+# the relevance and the reply prompt, so every saved token is saved twice per email.
+#
+# Usage: uv run python scripts/body_token_report.py [scripts/sample_emails]
+# (needs the usual app environment variables, e.g. USER_EMAIL, for the config to load)
+
+import base64
+import email
+import sys
+from email.message import Message
+from pathlib import Path
+from email_agent.services.gmail import _parse_body_parts
+from email_agent.services.limiter import estimate_tokens
+
+
+def _to_gmail_part(part: Message) -> dict:
+    """
+    Converts a MIME part to the structure returned by the Gmail API ('full' format).
+    """
+    gmail_part = {
+        "mimeType": part.get_content_type(),
+        "filename": part.get_filename() or "",
+        "headers": [
+            {"name": name, "value": str(value)} for name, value in part.items()
+        ],
+        "body": {},
+    }
+    if part.is_multipart():
+        gmail_part["parts"] = [_to_gmail_part(sub) for sub in part.get_payload()]
+    else:
+        payload = part.get_payload(decode=True) or b""
+        gmail_part["body"] = {
+            "data": base64.urlsafe_b64encode(payload).decode("ascii"),
+            "size": len(payload),
+        }
+    return gmail_part
+
+
+def _former_body(part: dict) -> str:
+    """
+    The former extraction: every text/plain part decoded as UTF-8.
+    """
+    if "parts" in part:
+        return "".join(_former_body(sub) for sub in part["parts"])
+    if part["mimeType"] != "text/plain" or not part["body"].get("data"):
+        return ""
+    try:
+        return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
+    except UnicodeDecodeError:
+        return "[not decodable as UTF-8]"
+
+
+def main():
+    corpus = Path(sys.argv[1] if len(sys.argv) > 1 else "scripts/sample_emails")
+    totals = [0, 0]
+
+    print(f"{'email':36s} {'before':>7s} {'after':>7s} {'saved':>7s}")
+    for path in sorted(corpus.glob("*.eml")):
+        payload = _to_gmail_part(email.message_from_bytes(path.read_bytes()))
+        before = _former_body(payload)
+        after = _parse_body_parts(
+            {"id": path.stem, "payload": payload}, None, ""
+        ).body_text
+
+        tokens = estimate_tokens(before), estimate_tokens(after)
+        totals[0] += tokens[0]
+        totals[1] += tokens[1]
+        note = " (empty before)" if not before.strip() else ""
+        print(
+            f"{path.stem:36s} {tokens[0]:7d} {tokens[1]:7d} {tokens[0] - tokens[1]:7d}{note}"
+        )
+
+    saved = totals[0] - totals[1]
+    print(
+        f"{'total':36s} {totals[0]:7d} {totals[1]:7d} {saved:7d}"
+        f" ({saved / max(totals[0], 1):.0%}, x2 per email for both prompts)"
+    )
+
+
+if __name__ == "__main__":
+    main()
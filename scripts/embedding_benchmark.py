@@ -0,0 +1,115 @@
+# Compares the fp32 embedding model with its int8-quantized variant on a corpus chunked like ingestion does:
+# query latency (p50/p95 with the query workload settings), ingestion throughput (chunks/s with the ingestion
+# settings), the cosine similarity of the fp32 and int8 embeddings of every chunk, and the recall@k drift:
+# the share of the fp32 top-k chunks of every query that the int8 model retrieves in its top-k as well.
+#
+# Usage: uv run python scripts/embedding_benchmark.py [rag_docs] --k 3 --repeat 20 [--queries queries.txt]
+# (needs the usual app environment variables, e.g. USER_EMAIL, for the config to load; threads and batch sizes
+# are taken from the EMBEDDING_* settings, the models are downloaded on the first run)
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Customer questions about the products of 'rag_docs', used unless a queries file is given
+QUERIES = [
+    "How many coffee recipes can the Philips espresso machine make?",
+    "Does the L'Oréa 9000 Pro have a milk frother?",
+    "How do I descale the espresso system?",
+    "What grinder settings does the coffee machine have?",
+    "What is the refresh rate of the Chronos X Pro monitor?",
+    "Can I connect my laptop to the 49-inch monitor with USB-C?",
+    "Is the ViewPoint monitor good for gaming and HDR?",
+    "What is the resolution and curvature of the ultrawide screen?",
+    "How long can the Spectre-Pro drone fly on one battery?",
+    "What is the range of the reconnaissance drone?",
+    "Does the drone camera record in 8K or thermal?",
+    "Is the AD-SPR drone quiet enough for wildlife filming?",
+]
+
+
+def percentile(values: list, share: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(share * len(values)))]
+
+
+def top_k(queries: np.ndarray, passages: np.ndarray, k: int) -> list:
+    # The embeddings are normalized, the dot product is the cosine similarity
+    scores = queries @ passages.T
+    return [set(np.argsort(-row)[:k]) for row in scores]
+
+
+def run(name: str, quantized: bool, queries: list, passages: list, repeat: int):
+    from email_agent.services.embeddings import embed_texts
+
+    # The first calls load the sessions
+    embed_texts(queries[:1], "query", quantized)
+    embed_texts(passages[:1], "ingestion", quantized)
+
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            embed_texts([query], "query", quantized)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        passage_vectors = np.array(embed_texts(passages, "ingestion", quantized))
+    throughput = len(passages) * repeat / (time.perf_counter() - start)
+
+    print(
+        f"{name:5s} query p50 {statistics.median(latencies):6.2f} ms  "
+        f"p95 {percentile(latencies, 0.95):6.2f} ms  ingestion {throughput:7.1f} chunks/s"
+    )
+    return np.array(embed_texts(queries, "query", quantized)), passage_vectors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="?", default="rag_docs")
+    parser.add_argument("--queries", help="a file with one query per line")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    from email_agent.services.ingestion import load_and_chunk_file
+
+    paths = sorted(path for path in Path(args.corpus).rglob("*") if path.is_file())
+    passages = [
+        chunk.page_content
+        for path in paths
+        for chunk in load_and_chunk_file(str(path), str(path))
+    ]
+    queries = (
+        [
+            line.strip()
+            for line in Path(args.queries).read_text().splitlines()
+            if line.strip()
+        ]
+        if args.queries
+        else QUERIES
+    )
+    print(f"{len(paths)} documents, {len(passages)} chunks, {len(queries)} queries")
+
+    fp32_queries, fp32_passages = run("fp32", False, queries, passages, args.repeat)
+    int8_queries, int8_passages = run("int8", True, queries, passages, args.repeat)
+
+    similarity = np.sum(fp32_passages * int8_passages, axis=1)
+    k = min(args.k, len(passages))
+    recall = [
+        len(reference & candidate) / k
+        for reference, candidate in zip(
+            top_k(fp32_queries, fp32_passages, k), top_k(int8_queries, int8_passages, k)
+        )
+    ]
+    print(
+        f"fp32/int8 chunk cosine mean {similarity.mean():.4f} min {similarity.min():.4f}  "
+        f"recall@{k} {statistics.mean(recall):.3f} (min {min(recall):.2f})"
+    )
+
+
+if __name__ == "__main__":
+    main()
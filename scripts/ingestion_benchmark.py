@@ -0,0 +1,89 @@
+# Compares the former ingestion path of text documents ('unstructured' partitioning and the character based
+# 'RecursiveCharacterTextSplitter') with the streaming text path (e5 token-aware chunker) on a corpus:
+# the import time of both stacks (each in a fresh interpreter), documents/s and the chunk sizes in e5 tokens.
+#
+# Usage: uv run python scripts/ingestion_benchmark.py [rag_docs] --repeat 20
+# (needs the usual app environment variables, e.g. USER_EMAIL, for the config to load)
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+IMPORTS = {
+    "former": "from langchain_google_community import GCSFileLoader; "
+    "from langchain_text_splitters import RecursiveCharacterTextSplitter; "
+    "from unstructured.partition.auto import partition",
+    "text": "from tokenizers import Tokenizer",
+}
+
+
+def import_time_s(statement: str) -> float:
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def chunk_former(path: Path) -> list:
+    from langchain_core.documents import Document
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from unstructured.partition.auto import partition
+
+    text = "\n\n".join(str(element) for element in partition(filename=str(path)))
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=512,
+        chunk_overlap=50,
+        length_function=len,
+        separators=["\n\n", "\n", ". ", " "],
+    )
+    return splitter.split_documents(
+        [Document(page_content=text, metadata={"source": str(path)})]
+    )
+
+
+def chunk_text_path(path: Path) -> list:
+    from email_agent.services.ingestion import load_and_chunk_file
+
+    return load_and_chunk_file(str(path), str(path))
+
+
+def run(name: str, chunker, paths: list, repeat: int) -> None:
+    from email_agent.services.chunker import count_tokens
+
+    # The first pass warms up (tokenizer and 'unstructured' models) and collects the chunk sizes
+    chunks = [chunk for path in paths for chunk in chunker(path)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            chunker(path)
+    elapsed = time.perf_counter() - start
+
+    tokens = [count_tokens(chunk.page_content) for chunk in chunks]
+    print(
+        f"{name:8s} {len(paths) * repeat / elapsed:9.1f} docs/s  {len(tokens):5d} chunks  "
+        f"tokens mean {statistics.mean(tokens):6.1f} max {max(tokens):4d}  "
+        f"over 510: {sum(count > 510 for count in tokens)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="?", default="rag_docs")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    paths = sorted(path for path in Path(args.corpus).rglob("*") if path.is_file())
+
+    for name, statement in IMPORTS.items():
+        print(f"{name:8s} import {import_time_s(statement):6.2f} s")
+
+    print(f"{len(paths)} documents, {args.repeat} passes")
+    run("former", chunk_former, paths, args.repeat)
+    run("text", chunk_text_path, paths, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+
+# The settings required by the config, the tested functions do not reach any service
+os.environ.setdefault("USER_EMAIL", "agent@example.com")
+os.environ.setdefault("GMAIL_SERVICE_ACC_JSON", "{}")
@@ -0,0 +1,154 @@
+import base64
+import unittest
+from unittest import mock
+
+from email_agent.config import CFG
+from email_agent.services.body_normalizer import (
+    collapse_whitespace,
+    decode_text_part,
+    html_to_text,
+    normalize_body,
+    strip_quoted_text,
+    strip_signature,
+)
+
+
+def encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+FORWARD = """Hi, please check this confirmation.
+
+---------- Forwarded message ---------
+From: Alza <orders@alza.cz>
+Date: Mon, 1 Jan 2024 at 10:00
+Subject: Order 123 confirmed
+To: <jan@example.com>
+
+Your order 123 (espresso machine) was confirmed."""
+
+
+class TestHtmlToText(unittest.TestCase):
+    def test_skips_hidden_elements_and_breaks_blocks(self):
+        html = "<html><head><title>T</title><style>p {}</style></head><body><p>Hello</p><p>World<br>again</p></body></html>"
+        self.assertEqual(
+            collapse_whitespace(html_to_text(html)), "Hello\n\nWorld\nagain"
+        )
+
+    def test_skips_quotes_unless_asked_not_to(self):
+        html = '<div>Reply</div><div class="gmail_quote">Old <blockquote>older</blockquote></div><blockquote>quoted</blockquote>'
+        self.assertEqual(collapse_whitespace(html_to_text(html)), "Reply")
+        self.assertIn("older", html_to_text(html, skip_quotes=False))
+
+    def test_unescapes_entities_and_survives_stray_end_tags(self):
+        self.assertEqual(
+            collapse_whitespace(html_to_text("<p>a &amp; b</span></p>")), "a & b"
+        )
+
+
+class TestStripQuotedText(unittest.TestCase):
+    def test_cuts_at_attribution(self):
+        text = "Thanks!\n\nOn Mon, 1 Jan 2024 John <j@x.com> wrote:\n> old"
+        self.assertEqual(strip_quoted_text(text).strip(), "Thanks!")
+
+    def test_cuts_at_wrapped_czech_attribution(self):
+        text = "Díky\nDne 1. 1. 2024 v 10:00 Jan\n<j@x.cz> napsal(a):\nstará zpráva"
+        self.assertEqual(strip_quoted_text(text), "Díky")
+
+    def test_cuts_at_original_message_and_outlook_header(self):
+        self.assertEqual(
+            strip_quoted_text("New\n-----Original Message-----\nold"), "New"
+        )
+        self.assertEqual(
+            strip_quoted_text("New\n\nFrom: John\nSent: Monday\nSubject: x\n\nold"),
+            "New\n",
+        )
+
+    def test_keeps_from_and_date_lines_of_the_body(self):
+        text = "Question about order:\nFrom: the shop I bought 3 items\nDate: yesterday they shipped 2.\nCan you check?"
+        self.assertEqual(strip_quoted_text(text), text)
+        text = "Hi\n\nFrom: the shop\nDate: yesterday\nCan you check?"
+        self.assertEqual(strip_quoted_text(text), text)
+
+    def test_drops_quoted_lines(self):
+        self.assertEqual(strip_quoted_text("> quoted\nanswer\n>> more"), "answer")
+
+    def test_keeps_bottom_posted_reply(self):
+        text = "On Mon, 1 Jan 2024 John <j@x.com> wrote:\n> question?\nanswer"
+        self.assertEqual(strip_quoted_text(text), "answer")
+
+    def test_keeps_gmail_forward_with_its_headers(self):
+        self.assertEqual(strip_quoted_text(FORWARD), FORWARD)
+
+    def test_keeps_apple_mail_forward(self):
+        text = "FYI\n\nBegin forwarded message:\n\nFrom: Shop <s@x.com>\nDate: 1 Jan 2024\nSubject: Invoice\n\nTotal 100 CZK"
+        self.assertEqual(strip_quoted_text(text), text)
+
+
+class TestStripSignature(unittest.TestCase):
+    def test_cuts_delimiter_and_mobile_footer(self):
+        self.assertEqual(strip_signature("Hello\n-- \nJohn Doe\nACME"), "Hello")
+        self.assertEqual(strip_signature("Hello\n\nSent from my iPhone"), "Hello\n")
+
+    def test_keeps_delimiter_far_from_the_end(self):
+        text = "Hello\n--\n" + "\n".join(["line"] * (CFG.body_signature_max_lines + 1))
+        self.assertEqual(strip_signature(text), text)
+
+
+class TestCollapseWhitespace(unittest.TestCase):
+    def test_collapses_blank_lines_and_spaces(self):
+        self.assertEqual(collapse_whitespace(" a  b \r\n\n\n\nc\xa0\t\n"), "a b\n\nc")
+
+
+class TestDecodeTextPart(unittest.TestCase):
+    def test_decodes_declared_charset(self):
+        headers = [
+            {"name": "Content-Type", "value": 'text/plain; charset="iso-8859-2"'}
+        ]
+        self.assertEqual(
+            decode_text_part(encode("Žluťoučký".encode("iso-8859-2")), headers),
+            "Žluťoučký",
+        )
+
+    def test_falls_back_on_unknown_charset(self):
+        headers = [{"name": "content-type", "value": "text/plain; charset=x-unknown"}]
+        self.assertEqual(decode_text_part(encode("čaj".encode()), headers), "čaj")
+        self.assertEqual(
+            decode_text_part(encode("čaj".encode("cp1250")), headers), "čaj"
+        )
+
+
+class TestNormalizeBody(unittest.TestCase):
+    def test_plain_reply(self):
+        text = "Is it in stock?\n\nOn Mon, 1 Jan 2024 Shop <s@x.com> wrote:\n> Hello\n\n-- \nJan"
+        self.assertEqual(normalize_body(text), "Is it in stock?")
+
+    def test_plain_forward_is_kept(self):
+        self.assertIn("Your order 123", normalize_body(FORWARD))
+
+    def test_html_only(self):
+        html = '<div>Is it in stock?</div><div class="gmail_quote">On Mon John wrote:<blockquote>Hello</blockquote></div>'
+        self.assertEqual(normalize_body("", html), "Is it in stock?")
+
+    def test_html_forward_is_kept(self):
+        html = (
+            '<div>Please check this.</div><div class="gmail_quote"><div class="gmail_attr">'
+            "---------- Forwarded message ---------<br>From: Alza &lt;orders@alza.cz&gt;<br>"
+            "Date: Mon, 1 Jan 2024<br>Subject: Order 123</div><div>Your order 123 was confirmed.</div></div>"
+        )
+        body = normalize_body("", html)
+        self.assertTrue(body.startswith("Please check this."))
+        self.assertIn("Your order 123 was confirmed.", body)
+
+    def test_quote_only_body_is_kept(self):
+        text = "On Mon, 1 Jan 2024 John <j@x.com> wrote:\n> question?"
+        self.assertEqual(normalize_body(text), text)
+
+    def test_disabled(self):
+        with mock.patch.object(CFG, "body_normalizer_enabled", False):
+            self.assertEqual(normalize_body("a\n> b"), "a\n> b")
+            self.assertEqual(normalize_body("", "<p>a</p>"), "\na\n")
+
+
+if __name__ == "__main__":
+    unittest.main()